@@ -1,11 +1,89 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
 from .models import ChunkedUpload
 
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using the row estimate of PostgreSQL instead of a full
+    `COUNT(*)` when the queryset is not filtered.
+    """
+
+    # Under this estimate, the exact count is cheap enough
+    min_estimate = 10000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            connection = connections[self.object_list.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'SELECT reltuples FROM pg_class WHERE relname = %s',
+                        [self.object_list.model._meta.db_table]
+                    )
+                    row = cursor.fetchone()
+                if row and row[0] >= self.min_estimate:
+                    return int(row[0])
+        return super().count
+
+
+class ExpiredListFilter(admin.SimpleListFilter):
+    title = _('expired')
+    parameter_name = 'expired'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('yes', _('Yes')),
+            ('no', _('No')),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == 'yes':
+            return queryset.filter(expires_at__lte=timezone.now())
+        if self.value() == 'no':
+            return queryset.filter(expires_at__gt=timezone.now())
+        return queryset
+
+
 class ChunkedUploadAdmin(admin.ModelAdmin):
-    list_display = ('upload_id', 'filename', 'status', 'created_on')
-    search_fields = ('filename', 'filename')
-    list_filter = ('status',)
+    list_display = (
+        'upload_id', 'filename', 'user', 'status', 'offset', 'created_on', 'expires_at'
+    )
+    search_fields = ('filename', 'upload_id')
+    list_filter = ('status', ExpiredListFilter)
+    list_select_related = ('user',)
+    ordering = ('-created_on',)
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ('delete_with_files',)
+
+    @admin.action(permissions=['delete'], description=_('Delete selected uploads and their files'))
+    def delete_with_files(self, request, queryset):
+        expired = queryset.with_remote_files().count()
+        count = queryset.delete_with_files()
+        self.message_user(
+            request,
+            _('%(count)s uploads were deleted.') % {'count': sum(count.values())},
+            messages.SUCCESS,
+        )
+        if expired:
+            self.message_user(
+                request,
+                _('%(count)s uploads staged on other nodes were expired, they will be deleted '
+                  'by their node.') % {'count': expired},
+                messages.WARNING,
+            )
+
+    def delete_queryset(self, request, queryset):
+        queryset.delete_with_files()
 
 
 admin.site.register(ChunkedUpload, ChunkedUploadAdmin)
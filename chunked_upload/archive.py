@@ -0,0 +1,236 @@
+"""
+Streaming extraction of archives (tar, tar.gz, tar.bz2, tar.xz and zip) to
+the storage, used by `ChunkedUploadCompleteView` when `extract_archives` is
+enabled. Plain tar archives can be extracted incrementally while the chunks
+are received.
+"""
+import os
+import posixpath
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.files import File
+
+from .constants import http_status
+from .exceptions import ChunkedUploadError
+
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+EXTRACT_DIR_SUFFIX = '.extracted'
+# Members up to this size are read in memory and written by the pool of
+# threads, bigger members are streamed to the storage by the reading thread
+SMALL_MEMBER_SIZE = 1024 * 1024
+
+
+def get_extract_dir(name):
+    """
+    Name of the directory where the archive uploaded in the file `name` is
+    extracted (next to the file).
+    """
+    root, _ext = os.path.splitext(name)
+    return root + EXTRACT_DIR_SUFFIX
+
+
+def is_plain_tar(filename):
+    return filename.lower().endswith('.tar')
+
+
+def is_zip(filename):
+    return filename.lower().endswith('.zip')
+
+
+def is_archive(filename):
+    filename = filename.lower()
+    return filename.endswith((
+        '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.zip'
+    ))
+
+
+def get_safe_name(name):
+    """
+    Returns the normalized relative path of an archive member, or `None` if
+    the path is absolute or goes outside of the extraction directory.
+    """
+    name = name.replace('\\', '/')
+    if name.startswith('/') or (len(name) > 1 and name[1] == ':'):
+        return None
+    name = posixpath.normpath(name)
+    if name in ('.', '') or name == '..' or name.startswith('../'):
+        return None
+    return name
+
+
+class ArchiveExtractor:
+    """
+    Extracts the regular files of an archive to `path` in the storage. The
+    archive is read sequentially; small members are written by a pool of
+    threads, with a bounded number of members in memory.
+    The extraction fails if the archive has more than `max_members` files,
+    if their total size exceeds `max_size` or if a member path is unsafe.
+    """
+
+    def __init__(self, storage, path, max_size=None, max_members=None, workers=4):
+        self.storage = storage
+        self.path = path
+        self.max_size = max_size
+        self.max_members = max_members
+        self.workers = workers
+        self.names = []
+        self.size = 0
+
+    def error(self, detail):
+        return ChunkedUploadError(status=http_status.HTTP_400_BAD_REQUEST, detail=detail)
+
+    def check_member(self, name, size):
+        """
+        Returns the storage name of a member after checking the limits.
+        """
+        safe_name = get_safe_name(name)
+        if safe_name is None:
+            raise self.error('Unsafe path in archive: "%s"' % name)
+        if self.max_members is not None and len(self.names) >= self.max_members:
+            raise self.error('Archive has too many files (max %s)' % self.max_members)
+        self.size += size
+        if self.max_size is not None and self.size > self.max_size:
+            raise self.error('Size of archive content exceeds the limit (%s bytes)' % self.max_size)
+        storage_name = posixpath.join(self.path, safe_name)
+        self.names.append(storage_name)
+        return storage_name
+
+    def write(self, name, file_obj):
+        # Replace the member if it was already extracted (resumed extraction)
+        self.storage.delete(name)
+        self.storage.save(name, File(file_obj, name=posixpath.basename(name)))
+
+    def write_members(self, members):
+        """
+        Writes the (name, size, open) members, `open` being a function
+        returning the file object of the member content.
+        """
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def write_small(name, data):
+            try:
+                self.write(name, BytesIO(data))
+            finally:
+                slots.release()
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                for name, size, open_member in members:
+                    storage_name = self.check_member(name, size)
+                    with open_member() as file_obj:
+                        if size <= SMALL_MEMBER_SIZE:
+                            data = file_obj.read(SMALL_MEMBER_SIZE + 1)
+                            if len(data) > SMALL_MEMBER_SIZE:
+                                raise self.error('Invalid size of archive member "%s"' % name)
+                            slots.acquire()
+                            futures.append(executor.submit(write_small, storage_name, data))
+                        else:
+                            self.write(storage_name, file_obj)
+                    # Raise the write errors early
+                    while futures and futures[0].done():
+                        futures.pop(0).result()
+            finally:
+                for future in futures:
+                    future.result()
+
+    def iter_tar_members(self, tar, available=None):
+        """
+        Yields the regular files of a tar archive. If `available` is given,
+        the iteration stops before the first member which is not fully
+        available yet; `self.position` is then where to resume (`None` once
+        the end of the archive is reached).
+        """
+        while True:
+            if (
+                available is not None
+                and tar.firstmember is None
+                and tar.offset + BLOCK_SIZE > available
+            ):
+                # Next header not received yet
+                return
+            try:
+                member = tar.next()
+            except tarfile.ReadError:
+                if available is not None:
+                    # Truncated extended header
+                    return
+                raise
+            if member is None:
+                self.position = None
+                return
+            if available is not None and member.offset_data + member.size > available:
+                return
+            if member.isfile():
+                yield member.name, member.size, lambda member=member: tar.extractfile(member)
+            # Links and special files are ignored. Members are not kept, so
+            # that the memory usage does not depend on the archive size
+            tar.members.clear()
+            blocks, remainder = divmod(member.size, BLOCK_SIZE)
+            self.position = member.offset_data + (blocks + bool(remainder)) * BLOCK_SIZE
+
+    def extract_tar(self, path, start=0, available=None):
+        """
+        Extracts a tar archive from the position `start`. With `available`
+        (size of the received data), only the fully received members of a
+        plain tar archive are extracted. Returns the position where to
+        resume, or `None` if the archive was fully extracted.
+        """
+        self.position = start
+        if available is not None and start + BLOCK_SIZE > available:
+            return start
+        try:
+            with open(path, mode='rb') as file_obj:
+                file_obj.seek(start)
+                if available is not None:
+                    mode = 'r:'
+                else:
+                    mode = 'r:*' if start else 'r|*'
+                try:
+                    tar = tarfile.open(fileobj=file_obj, mode=mode)
+                except tarfile.ReadError:
+                    if available is not None:
+                        # Truncated extended header
+                        return start
+                    raise
+                with tar:
+                    self.write_members(self.iter_tar_members(tar, available))
+        except (tarfile.TarError, EOFError, OSError) as err:
+            raise self.error('Failed to extract archive (%s)' % err)
+        return self.position
+
+    def extract_zip(self, path):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                self.write_members(
+                    (info.filename, info.file_size, lambda info=info: archive.open(info))
+                    for info in archive.infolist()
+                    if not info.is_dir()
+                )
+        except (zipfile.BadZipFile, EOFError, OSError) as err:
+            raise self.error('Failed to extract archive (%s)' % err)
+
+    def extract(self, path, filename, start=0):
+        """
+        Extracts the archive (zip or tar, compressed or not), whose format is
+        given by the uploaded `filename` (the content is not sniffed: a tar
+        archive can contain a zip file which looks like the end of a zip
+        archive). For a plain tar archive, the extraction can be resumed
+        from `start`.
+        """
+        if is_zip(filename):
+            self.extract_zip(path)
+        else:
+            self.extract_tar(path, start=start)
+
+    def delete(self):
+        """
+        Deletes the extracted files.
+        """
+        for name in self.names:
+            self.storage.delete(name)
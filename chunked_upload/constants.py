@@ -3,9 +3,16 @@ from django.utils.translation import gettext as _
 
 class http_status:
     HTTP_200_OK = 200
+    HTTP_204_NO_CONTENT = 204
+    HTTP_206_PARTIAL_CONTENT = 206
+    HTTP_307_TEMPORARY_REDIRECT = 307
     HTTP_400_BAD_REQUEST = 400
     HTTP_403_FORBIDDEN = 403
+    HTTP_404_NOT_FOUND = 404
+    HTTP_409_CONFLICT = 409
     HTTP_410_GONE = 410
+    HTTP_415_UNSUPPORTED_MEDIA_TYPE = 415
+    HTTP_416_RANGE_NOT_SATISFIABLE = 416
 
 
 UPLOADING = 1
@@ -0,0 +1,188 @@
+"""
+Content-addressed store of uploaded chunks, used to deduplicate the chunks
+of uploads when `CHUNKED_UPLOAD_DEDUP` is enabled.
+
+The chunks of a deduplicated upload are referenced in its manifest, a file
+next to the upload file to which an entry is appended for each chunk.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+
+from .settings import upload_settings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+MANIFEST_SUFFIX = '.manifest'
+# Manifest entries are the digest of the chunk and the end offset of the
+# chunk in the upload, with a fixed width: the size of the upload is read
+# from the last entry.
+MANIFEST_ENTRY_SIZE = 86
+
+
+def is_valid_digest(digest):
+    return bool(DIGEST_PATTERN.match(digest))
+
+
+class ChunkStore:
+    """
+    Chunks are stored in files named after the SHA-256 digest of their
+    content, so identical chunks are stored only once.
+    """
+
+    hash_name = 'sha256'
+
+    def __init__(self, storage, path):
+        self.root = Path(storage.path(path))
+
+    def get_path(self, digest):
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def has(self, digest):
+        return self.get_path(digest).exists()
+
+    def filter_known(self, digests):
+        """
+        Returns the digests of the given list which are in the store.
+        """
+        return [digest for digest in digests if is_valid_digest(digest) and self.has(digest)]
+
+    def get_size(self, digest):
+        return self.get_path(digest).stat().st_size
+
+    def touch(self, digest):
+        """
+        Mark a chunk as recently used (unused chunks are pruned).
+        """
+        os.utime(self.get_path(digest))
+
+    def add(self, chunk):
+        """
+        Add the content of an uploaded chunk to the store.
+        Returns the digest and the size of the chunk.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        hasher = hashlib.new(self.hash_name)
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, mode='wb') as file_obj:
+                for data in chunk.chunks():
+                    hasher.update(data)
+                    file_obj.write(data)
+                    size += len(data)
+            digest = hasher.hexdigest()
+            path = self.get_path(digest)
+            if path.exists():
+                self.touch(digest)
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # Atomic, concurrent additions of the same chunk are harmless
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest, size
+
+    def open(self, digest):
+        return open(self.get_path(digest), mode='rb')
+
+    def prune(self, max_age):
+        """
+        Remove chunks which have not been used since `max_age` (timedelta).
+        Returns the number of removed chunks.
+        """
+        limit = time.time() - max_age.total_seconds()
+        count = 0
+        if not self.root.exists():
+            return count
+        for dir_path, _dir_names, file_names in os.walk(self.root):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    if os.stat(path).st_mtime < limit:
+                        os.remove(path)
+                        count += 1
+                except FileNotFoundError:
+                    pass
+        return count
+
+
+def get_chunk_store(namespace=None):
+    """
+    Returns the chunk store, or the part of it of the given namespace (e.g.
+    a user). Chunks are only shared within a namespace.
+    """
+    path = upload_settings.CHUNK_STORE_PATH
+    if namespace is not None:
+        path = os.path.join(path, namespace)
+    return ChunkStore(upload_settings.STORAGE, path)
+
+
+def get_manifest_path(path):
+    return os.fspath(path) + MANIFEST_SUFFIX
+
+
+def read_manifest(path):
+    """
+    Returns the list of (digest, size) of the chunks referenced in the
+    manifest (an empty list if there is no manifest).
+    """
+    chunks = []
+    start = 0
+    try:
+        with open(path, mode='rb') as file_obj:
+            while entry := file_obj.read(MANIFEST_ENTRY_SIZE):
+                end = int(entry[65:85])
+                chunks.append((entry[:64].decode('ascii'), end - start))
+                start = end
+    except FileNotFoundError:
+        pass
+    return chunks
+
+
+def _read_end(file_obj):
+    size = file_obj.seek(0, os.SEEK_END)
+    if size < MANIFEST_ENTRY_SIZE:
+        return 0
+    file_obj.seek(size - MANIFEST_ENTRY_SIZE)
+    return int(file_obj.read(MANIFEST_ENTRY_SIZE)[65:85])
+
+
+def get_manifest_size(path):
+    """
+    Returns the size of the chunks referenced in the manifest (0 if there
+    is no manifest).
+    """
+    try:
+        with open(path, mode='rb') as file_obj:
+            return _read_end(file_obj)
+    except FileNotFoundError:
+        return 0
+
+
+def append_manifest_entry(path, digest, size, start=None):
+    """
+    Appends a chunk to the manifest, which is created if needed. The
+    manifest is locked while writing. If `start` is given, the chunk is only
+    added if the size of the manifest is `start`. Returns the size of the
+    manifest before the chunk was added.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    with os.fdopen(fd, mode='r+b') as file_obj:
+        if fcntl is not None:
+            # Released when the file is closed
+            fcntl.flock(file_obj, fcntl.LOCK_EX)
+        end = _read_end(file_obj)
+        if start is None or start == end:
+            file_obj.write(f'{digest} {end + size:020d}\n'.encode('ascii'))
+    return end
@@ -0,0 +1,186 @@
+"""
+Streaming decoding of compressed chunks (Content-Encoding).
+"""
+import zlib
+
+try:
+    from compression import zstd  # Python >= 3.14
+except ImportError:
+    zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .constants import http_status
+from .exceptions import ChunkedUploadError
+
+
+BLOCK_SIZE = 64 * 1024
+
+
+class _CountingReader:
+    """
+    File-like wrapper counting the bytes read from the underlying file.
+    """
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.count += len(data)
+        return data
+
+
+def _iter_zlib(reader, wbits):
+    """
+    Decompresses deflate or gzip data. Gzip data can have several members,
+    which are decompressed one after the other. Any other data after the
+    compressed data is an error.
+    """
+    is_gzip = wbits > zlib.MAX_WBITS
+    decompressor = zlib.decompressobj(wbits)
+    data = b''
+    # Output may be pending in the decompressor when `BLOCK_SIZE` is reached
+    pending = False
+    while True:
+        if not data and not pending:
+            data = reader.read(BLOCK_SIZE)
+            if not data:
+                break
+        output = decompressor.decompress(data, BLOCK_SIZE)
+        data = decompressor.unconsumed_tail
+        pending = len(output) == BLOCK_SIZE
+        if output:
+            yield output
+        if decompressor.eof:
+            data = decompressor.unused_data or reader.read(BLOCK_SIZE)
+            if not data:
+                return
+            if not is_gzip:
+                raise zlib.error('Unexpected data after compressed data')
+            # Next gzip member (its header is checked by the decompressor)
+            decompressor = zlib.decompressobj(wbits)
+            pending = False
+    raise zlib.error('Compressed data is truncated')
+
+
+# The decompressor of `zstandard` has no limit on the size of its output, so
+# it is given small blocks of compressed data to bound the memory used
+ZSTANDARD_BLOCK_SIZE = 1024
+
+
+def _iter_zstd_frame(decompressor, data):
+    if zstd is None:
+        output = decompressor.decompress(data)
+        if output:
+            yield output
+        return
+    output = decompressor.decompress(data, BLOCK_SIZE)
+    while output:
+        yield output
+        if decompressor.eof or decompressor.needs_input:
+            break
+        output = decompressor.decompress(b'', BLOCK_SIZE)
+
+
+def _iter_zstd(reader):
+    """
+    Decompresses zstd data, which can have several frames. Like for gzip,
+    truncated data and any other data after the frames are errors.
+    """
+    if zstd is not None:
+        new_decompressor = zstd.ZstdDecompressor
+        block_size = BLOCK_SIZE
+        error = zstd.ZstdError
+    else:
+        def new_decompressor():
+            return zstandard.ZstdDecompressor().decompressobj()
+        block_size = ZSTANDARD_BLOCK_SIZE
+        error = zstandard.ZstdError
+    decompressor = new_decompressor()
+    while data := reader.read(block_size):
+        while data:
+            yield from _iter_zstd_frame(decompressor, data)
+            data = b''
+            if decompressor.eof:
+                data = decompressor.unused_data or reader.read(block_size)
+                if not data:
+                    return
+                # Next frame (anything else is rejected by the decompressor)
+                decompressor = new_decompressor()
+    raise error('Compressed data is truncated')
+
+
+DECODERS = {
+    'gzip': lambda reader: _iter_zlib(reader, 16 + zlib.MAX_WBITS),
+    'x-gzip': lambda reader: _iter_zlib(reader, 16 + zlib.MAX_WBITS),
+    'deflate': lambda reader: _iter_zlib(reader, zlib.MAX_WBITS),
+}
+DECODING_ERRORS = (zlib.error, EOFError)
+if zstd is not None or zstandard is not None:
+    DECODERS['zstd'] = _iter_zstd
+    DECODING_ERRORS += (zstd.ZstdError if zstd is not None else zstandard.ZstdError,)
+
+
+def get_supported_encodings():
+    return tuple(DECODERS)
+
+
+class DecodedChunk:
+    """
+    Wraps an uploaded chunk whose content is compressed. The content is
+    decompressed in a streaming way when iterating on `chunks()`, so the
+    decompressed data is never fully loaded in memory.
+    If `size` is given, the decompressed data must have exactly this size.
+    The decompression is interrupted if the decompressed data exceeds
+    `max_size` or if the decompression ratio exceeds `max_ratio`.
+    """
+
+    def __init__(self, chunk, encoding, size=None, max_size=None, max_ratio=None):
+        if encoding not in DECODERS:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail='Unsupported content encoding "%s"' % encoding
+            )
+        self.chunk = chunk
+        self.name = chunk.name
+        self.encoding = encoding
+        self.size = size
+        self.max_size = size if size is not None else max_size
+        self.max_ratio = max_ratio
+
+    def chunks(self, chunk_size=None):
+        self.chunk.seek(0)
+        reader = _CountingReader(self.chunk)
+        decoded_size = 0
+        try:
+            for data in DECODERS[self.encoding](reader):
+                decoded_size += len(data)
+                if self.max_size is not None and decoded_size > self.max_size:
+                    raise ChunkedUploadError(
+                        status=http_status.HTTP_400_BAD_REQUEST,
+                        detail="Decompressed size of chunk exceeds the expected size"
+                    )
+                if self.max_ratio and decoded_size > self.max_ratio * max(reader.count, 1):
+                    raise ChunkedUploadError(
+                        status=http_status.HTTP_400_BAD_REQUEST,
+                        detail='Decompression ratio exceeds the limit (%s)' % self.max_ratio
+                    )
+                yield data
+        except DECODING_ERRORS as err:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='Failed to decompress chunk (%s)' % err
+            )
+        if self.size is not None and decoded_size != self.size:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail="File size doesn't match headers"
+            )
+
+    def read(self):
+        return b''.join(self.chunks())
@@ -0,0 +1,197 @@
+"""
+Events of the uploads ("created", "chunk", "completed", "aborted" and
+"expired"), published to the event bus `CHUNKED_UPLOAD_EVENT_BUS`, so that
+clients and other services get the progress of uploads without polling the
+upload table (see `ChunkedUploadEventsView`).
+
+An event bus has a non-blocking `publish(event)` method, events being dicts
+with primitive values. To be used by `ChunkedUploadEventsView`, it also has
+a `subscribe(event_filter)` method returning a subscription with the methods
+`get(timeout)` (returning a list of events) and `close()`.
+"""
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from .settings import upload_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_event_bus():
+    """
+    Returns the event bus, or `None` if events are disabled.
+    """
+    return upload_settings.EVENT_BUS
+
+
+def get_event(event_type, chunked_upload, user_field_name='user', **data):
+    """
+    Builds the event of an upload.
+    """
+    event = {
+        'type': event_type,
+        'upload_id': chunked_upload.upload_id,
+        'user_id': getattr(chunked_upload, user_field_name + '_id', None),
+        'offset': chunked_upload.offset,
+        'time': time.time(),
+    }
+    event.update(data)
+    return event
+
+
+def publish(event):
+    bus = get_event_bus()
+    if bus is not None:
+        bus.publish(event)
+
+
+def flush(timeout=5):
+    """
+    Waits for the published events to be dispatched (before the process
+    exits, for example in management commands).
+    """
+    bus = get_event_bus()
+    if bus is not None and hasattr(bus, 'flush'):
+        bus.flush(timeout)
+
+
+class Subscription:
+    """
+    Events received by a subscriber of the `InProcessEventBus`. If the
+    subscriber is too slow, the oldest events are dropped.
+    """
+
+    def __init__(self, bus, event_filter=None, max_pending=1000):
+        self.bus = bus
+        self.event_filter = event_filter
+        self.events = deque(maxlen=max_pending)
+        self.condition = threading.Condition()
+
+    def put(self, events):
+        if self.event_filter is not None:
+            events = [event for event in events if self.event_filter(event)]
+        if events:
+            with self.condition:
+                self.events.extend(events)
+                self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the pending events, waiting at most `timeout` seconds for
+        new events (an empty list is returned on timeout).
+        """
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+        return events
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class InProcessEventBus:
+    """
+    Event bus delivering the events to the subscribers of the current
+    process. Events are queued by `publish` (never blocking, events are
+    dropped if the queue is full) and dispatched by batches by a background
+    thread, to the subscriptions and to the handlers added with `connect`
+    (for example to forward the events to a message broker).
+    Events are not queued when there is no subscriber and no handler.
+    """
+
+    def __init__(self, max_pending=10000, batch_size=100):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.batch_size = batch_size
+        self.subscriptions = set()
+        self.handlers = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def active(self):
+        return bool(self.subscriptions or self.handlers)
+
+    def publish(self, event):
+        if not self.active:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name='chunked-upload-events', daemon=True
+                )
+                self.thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.dispatch(batch)
+            finally:
+                for _event in batch:
+                    self.queue.task_done()
+
+    def dispatch(self, events):
+        for handler in list(self.handlers):
+            try:
+                handler(events)
+            except Exception:
+                logger.exception('Failed to handle upload events')
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.put(events)
+
+    def flush(self, timeout=5):
+        limit = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < limit:
+            time.sleep(0.01)
+
+    def connect(self, handler):
+        """
+        Adds a function receiving the batches of events (lists).
+        """
+        self.handlers.append(handler)
+
+    def disconnect(self, handler):
+        self.handlers.remove(handler)
+
+    def subscribe(self, event_filter=None, max_pending=1000):
+        """
+        Returns a subscription to the events for which `event_filter(event)`
+        is true (all the events if `None`).
+        """
+        subscription = Subscription(self, event_filter, max_pending)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
@@ -1,9 +1,12 @@
 from django.core.management.base import BaseCommand
-from django.utils import timezone
 from django.utils.translation import gettext as _
 
-from chunked_upload.settings import EXPIRATION_DELTA
-from chunked_upload.models import ChunkedUpload
+from chunked_upload import events
+from chunked_upload.dedup import get_chunk_store
+from chunked_upload.settings import upload_settings
+from chunked_upload.models import (
+    ChunkedUpload, get_max_lifetime, get_upload_dirs, prune_empty_dirs,
+)
 from chunked_upload.constants import UPLOADING, COMPLETE
 
 prompt_msg = _('Do you want to delete {obj}?')
@@ -29,8 +32,8 @@ class Command(BaseCommand):
 
         count = {UPLOADING: 0, COMPLETE: 0}
         deleted = []
-        qs = self.model.objects.all()
-        qs = qs.filter(created_on__lt=(timezone.now() - EXPIRATION_DELTA))
+        # Staged files can only be deleted by the node owning them
+        qs = self.model.objects.expired().with_local_files().order_by('expires_at')
 
         for chunked_upload in qs:
             if interactive:
@@ -45,7 +48,20 @@ class Command(BaseCommand):
             deleted.append(chunked_upload.upload_id)
             # Deleting objects individually to call delete method explicitly
             chunked_upload.delete()
+            events.publish(events.get_event('expired', chunked_upload))
 
+        events.flush()
         self.stdout.write(f'Deleted upload ids: {deleted}.')
         self.stdout.write(f'{count[COMPLETE]} complete uploads were deleted.')
         self.stdout.write(f'{count[UPLOADING]} incomplete uploads were deleted.')
+
+        if upload_settings.DEDUP:
+            # Chunks are only needed by uploads in progress, which all have
+            # been created since less than the max lifetime of uploads
+            pruned = get_chunk_store().prune(get_max_lifetime())
+            self.stdout.write(f'{pruned} unused chunks were deleted from the chunk store.')
+
+        storage = self.model._meta.get_field('file').storage
+        dirs, exclude = get_upload_dirs(storage)
+        pruned = sum(prune_empty_dirs(path, exclude=exclude) for path in dirs)
+        self.stdout.write(f'{pruned} empty directories were deleted.')
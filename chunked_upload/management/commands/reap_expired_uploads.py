@@ -0,0 +1,154 @@
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chunked_upload import events
+from chunked_upload.dedup import get_chunk_store
+from chunked_upload.models import (
+    ChunkedUpload, delete_files, get_max_lifetime, get_upload_dirs, prune_empty_dirs,
+)
+from chunked_upload.settings import upload_settings
+
+
+class Command(BaseCommand):
+
+    # Has to be a ChunkedUpload subclass
+    model = ChunkedUpload
+
+    help = (
+        'Deletes expired chunked uploads by small batches. With --daemon, runs continuously. '
+        'Several instances can run at the same time (rows are locked with SKIP LOCKED).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--daemon',
+            action='store_true',
+            default=False,
+            help='Run continuously instead of stopping when there is no expired upload left.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of uploads deleted per batch.')
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=60,
+            help='Number of seconds to wait when there is no expired upload (daemon mode).')
+        parser.add_argument(
+            '--max-rate',
+            type=float,
+            default=0,
+            help='Max number of uploads deleted per second (0 means no limit).')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Number of threads used to delete files.')
+        parser.add_argument(
+            '--prune-interval',
+            type=float,
+            default=3600,
+            help='Number of seconds between the pruning of the chunk store (deduplication) '
+                 'and of the empty upload directories.')
+
+    def reap_batch(self, batch_size, executor):
+        """
+        Deletes a batch of expired uploads. Rows locked by another reaper
+        are skipped. Files are deleted once the transaction is committed,
+        failures are logged.
+        Returns the number of deleted uploads.
+        """
+        with transaction.atomic():
+            # Staged files can only be deleted by the node owning them
+            qs = self.model.objects.expired().with_local_files()
+            batch = list(
+                qs.order_by('expires_at')
+                .select_for_update(skip_locked=True)
+                .only('pk', 'upload_id', 'user', 'offset', 'file', 'staged')[:batch_size]
+            )
+            if batch:
+                self.model.objects.filter(pk__in=[upload.pk for upload in batch]).delete()
+        storage = self.model._meta.get_field('file').storage
+        failed = delete_files(
+            storage, [(upload.file.name, upload.staged) for upload in batch], executor
+        )
+        if failed:
+            self.stderr.write(
+                f'{failed} files could not be deleted (see the logs), they can be deleted '
+                'with "reconcile_uploads --fix".'
+            )
+        for chunked_upload in batch:
+            events.publish(events.get_event('expired', chunked_upload))
+        return len(batch)
+
+    def prune(self):
+        """
+        Deletes the unused chunks of the chunk store and the empty upload
+        directories.
+        """
+        if upload_settings.DEDUP:
+            pruned = get_chunk_store().prune(get_max_lifetime())
+            self.stdout.write(f'{pruned} unused chunks were deleted from the chunk store.')
+        storage = self.model._meta.get_field('file').storage
+        dirs, exclude = get_upload_dirs(storage)
+        pruned = sum(prune_empty_dirs(path, exclude=exclude) for path in dirs)
+        if pruned:
+            self.stdout.write(f'{pruned} empty directories were deleted.')
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self, options):
+        batch_size = options['batch_size']
+        max_rate = options['max_rate']
+        total = 0
+        last_prune = float('-inf')
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while not self.stopping:
+                start = time.monotonic()
+                count = self.reap_batch(batch_size, executor)
+                total += count
+                if count:
+                    self.stdout.write(f'{count} expired uploads were deleted.')
+                if max_rate and count:
+                    # Spread deletions to avoid I/O spikes
+                    time.sleep(max(count / max_rate - (time.monotonic() - start), 0))
+                if count == batch_size:
+                    continue
+
+                if time.monotonic() - last_prune >= options['prune_interval']:
+                    self.prune()
+                    last_prune = time.monotonic()
+                if not options['daemon']:
+                    break
+                # Sleep by steps to stop quickly when asked
+                end = time.monotonic() + options['interval']
+                while not self.stopping and time.monotonic() < end:
+                    time.sleep(min(1, end - time.monotonic()))
+
+        return total
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        previous_handlers = {}
+        # Signal handlers can only be set in the main thread (the command may
+        # be called with `call_command` in another thread)
+        if threading.current_thread() is threading.main_thread():
+            previous_handlers = {
+                signum: signal.signal(signum, self.stop)
+                for signum in (signal.SIGTERM, signal.SIGINT)
+            }
+        try:
+            total = self.run(options)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            events.flush()
+
+        self.stdout.write(f'{total} expired uploads were deleted in total.')
@@ -0,0 +1,310 @@
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from chunked_upload.archive import EXTRACT_DIR_SUFFIX
+from chunked_upload.dedup import MANIFEST_SUFFIX, get_manifest_path, get_manifest_size
+from chunked_upload.settings import upload_settings
+from chunked_upload.models import ChunkedUpload, get_upload_root, is_storage_root
+from chunked_upload.constants import UPLOADING
+
+_DONE = object()
+
+# Extension of the upload files with the default `CHUNKED_UPLOAD_TO`
+UPLOAD_FILE_EXT = '.part'
+# Number of file names looked up by prefix in a query
+PREFIX_LOOKUP_SIZE = 50
+
+
+def scan_files(root, workers=8, batch_size=1000, exclude=()):
+    """
+    Walks the directory tree with several threads and yields batches of
+    (path, size, mtime) tuples of the files in it. The amount of entries in
+    memory is bounded, even for directories with millions of files.
+    The directories of extracted archives are not walked, they are yielded
+    as a single entry (with a `None` size).
+    """
+    dirs = queue.Queue()
+    results = queue.Queue(maxsize=workers * 2)
+
+    def scan_dir(path):
+        batch = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name.endswith(EXTRACT_DIR_SUFFIX):
+                                stat = entry.stat(follow_symlinks=False)
+                                batch.append((entry.path, None, stat.st_mtime))
+                            elif entry.path not in exclude:
+                                dirs.put(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            stat = entry.stat(follow_symlinks=False)
+                            batch.append((entry.path, stat.st_size, stat.st_mtime))
+                    except FileNotFoundError:
+                        continue
+                    if len(batch) >= batch_size:
+                        results.put(batch)
+                        batch = []
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        if batch:
+            results.put(batch)
+
+    def worker():
+        while True:
+            path = dirs.get()
+            if path is None:
+                break
+            try:
+                scan_dir(path)
+            finally:
+                dirs.task_done()
+
+    def monitor():
+        dirs.join()
+        for _index in range(workers):
+            dirs.put(None)
+        results.put(_DONE)
+
+    dirs.put(root)
+    for _index in range(workers):
+        threading.Thread(target=worker, daemon=True).start()
+    threading.Thread(target=monitor, daemon=True).start()
+
+    while (batch := results.get()) is not _DONE:
+        yield batch
+
+
+class Command(BaseCommand):
+
+    # Has to be a ChunkedUpload subclass
+    model = ChunkedUpload
+
+    help = (
+        'Finds (and optionally fixes) the inconsistencies between the files of chunked uploads '
+        'and the database: files without upload (orphans), uploads without file and uploads '
+        'whose offset does not match the file size.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            default=False,
+            help='Delete orphan files and uploads in progress without file, fix offsets.')
+        parser.add_argument(
+            '--delete-missing-complete',
+            action='store_true',
+            default=False,
+            help='With --fix, also delete the complete uploads whose file is missing (by '
+                 'default they are only reported, their file may be restored from a backup).')
+        parser.add_argument(
+            '--path',
+            default=None,
+            help='Directory to scan, relative to the storage. Default is the static part of '
+                 'CHUNKED_UPLOAD_PATH, which is required if CHUNKED_UPLOAD_PATH has no static '
+                 'part (the storage root contains other files than the uploads).')
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=3600,
+            help='Ignore files modified since less than this number of seconds (files of '
+                 'uploads being created or written).')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='Number of threads used to scan the directories and check the files.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of files or uploads processed at once.')
+
+    def log(self, msg, verbosity=1):
+        if self.verbosity >= verbosity:
+            self.stdout.write(msg)
+
+    def find_orphans(self, storage, root, exclude, mtime_limit):
+        """
+        Yields batches of files which are not referenced by any upload, and
+        of manifests and directories of extracted archives whose upload does
+        not exist.
+        """
+        storage_root = storage.path('')
+        for batch in scan_files(root, self.workers, self.batch_size, exclude):
+            names = {}
+            manifests = {}
+            extract_dirs = {}
+            for path, size, mtime in batch:
+                if mtime >= mtime_limit:
+                    continue
+                name = os.path.relpath(path, storage_root)
+                if size is None:
+                    # Extracted next to the upload file (same name without extension)
+                    extract_dirs[name[:-len(EXTRACT_DIR_SUFFIX)]] = path
+                elif name.endswith(MANIFEST_SUFFIX):
+                    # Manifest of the upload file `name` without the suffix
+                    manifests[name[:-len(MANIFEST_SUFFIX)]] = path
+                else:
+                    names[name] = path
+            orphans = []
+            if names:
+                known = set(
+                    self.model.objects.filter(file__in=list(names)).values_list('file', flat=True)
+                )
+                orphans += [path for name, path in names.items() if name not in known]
+            if manifests:
+                known = set(
+                    self.model.objects.filter(file__in=list(manifests))
+                    .values_list('file', flat=True)
+                )
+                orphans += [path for name, path in manifests.items() if name not in known]
+            if extract_dirs:
+                known = self.find_known_roots(list(extract_dirs))
+                orphans += [
+                    path for file_root, path in extract_dirs.items() if file_root not in known
+                ]
+            if orphans:
+                yield orphans
+
+    def find_known_roots(self, file_roots):
+        """
+        Returns the file names without extension (roots) of the given list
+        which are the roots of upload files. Upload files are looked up with
+        the default extension (".part") first, the remaining roots are looked
+        up by prefix, by small groups (custom `CHUNKED_UPLOAD_TO`).
+        """
+        known = {
+            os.path.splitext(name)[0]
+            for name in self.model.objects.filter(
+                file__in=[file_root + UPLOAD_FILE_EXT for file_root in file_roots]
+            ).values_list('file', flat=True)
+        }
+        remaining = [file_root for file_root in file_roots if file_root not in known]
+        for index in range(0, len(remaining), PREFIX_LOOKUP_SIZE):
+            query = Q()
+            for file_root in remaining[index:index + PREFIX_LOOKUP_SIZE]:
+                query |= Q(file__startswith=file_root + '.')
+            known.update(
+                os.path.splitext(name)[0]
+                for name in self.model.objects.filter(query).values_list('file', flat=True)
+            )
+        return known
+
+    def check_upload(self, chunked_upload, mtime_limit):
+        """
+        Returns "missing", "drift" or `None` if the file is consistent.
+        """
+        try:
+            stat = os.stat(chunked_upload.get_path())
+        except FileNotFoundError:
+            return 'missing', None
+        if stat.st_mtime >= mtime_limit:
+            return None, None
+        size = stat.st_size + get_manifest_size(get_manifest_path(chunked_upload.get_path()))
+        if size != chunked_upload.offset:
+            return 'drift', size
+        return None, None
+
+    def find_inconsistent_uploads(self, mtime_limit):
+        """
+        Yields batches of (upload, issue, size) of uploads whose file is
+        missing or has a size which does not match the offset.
+        """
+        # Staged files are only available on the node owning them
+        qs = self.model.objects.with_local_files().exclude(file='').only(
+            'pk', 'upload_id', 'file', 'offset', 'status', 'node', 'staged'
+        ).order_by('pk')
+        uploads = qs.iterator(chunk_size=self.batch_size)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while batch := [upload for _index, upload in zip(range(self.batch_size), uploads)]:
+                checks = executor.map(lambda upload: self.check_upload(upload, mtime_limit), batch)
+                yield [
+                    (upload, issue, size)
+                    for upload, (issue, size) in zip(batch, checks)
+                    if issue
+                ]
+
+    def fix_drift(self, chunked_upload, size):
+        """
+        Extra bytes (written but not acknowledged) are removed. If bytes are
+        missing, the offset is lowered so that the client resumes from there.
+        Returns `True` if the upload was fixed.
+        """
+        if chunked_upload.status != UPLOADING or chunked_upload.has_manifest():
+            return False
+        if size > chunked_upload.offset:
+            os.truncate(chunked_upload.get_path(), chunked_upload.offset)
+        else:
+            self.model.objects.filter(pk=chunked_upload.pk).update(offset=size)
+        return True
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        self.workers = options['workers']
+        self.batch_size = options['batch_size']
+        fix = options['fix']
+        delete_complete = options['delete_missing_complete']
+        mtime_limit = time.time() - options['min_age']
+
+        storage = self.model._meta.get_field('file').storage
+        if options['path'] is not None:
+            root = storage.path(options['path'])
+        else:
+            root = storage.path(get_upload_root())
+            if is_storage_root(storage, root):
+                # All the other files of the storage would be orphans
+                raise CommandError(
+                    'CHUNKED_UPLOAD_PATH has no static part, the directory to scan must be '
+                    'given with --path.'
+                )
+        exclude = {storage.path(upload_settings.CHUNK_STORE_PATH)}
+
+        count = {'orphan': 0, 'missing': 0, 'drift': 0, 'fixed': 0}
+
+        for orphans in self.find_orphans(storage, root, exclude, mtime_limit):
+            count['orphan'] += len(orphans)
+            for path in orphans:
+                self.log(f'Orphan file: {path}', verbosity=2)
+            if fix:
+                for path in orphans:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                        continue
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                count['fixed'] += len(orphans)
+
+        for batch in self.find_inconsistent_uploads(mtime_limit):
+            missing = []
+            for chunked_upload, issue, size in batch:
+                count[issue] += 1
+                if issue == 'missing':
+                    self.log(f'Missing file: {chunked_upload}', verbosity=2)
+                    missing.append(chunked_upload.pk)
+                else:
+                    self.log(f'Size mismatch ({size} bytes): {chunked_upload}', verbosity=2)
+                    if fix and self.fix_drift(chunked_upload, size):
+                        count['fixed'] += 1
+            if fix and missing:
+                qs = self.model.objects.filter(pk__in=missing)
+                if not delete_complete:
+                    qs = qs.filter(status=UPLOADING)
+                count['fixed'] += qs.delete()[1].get(self.model._meta.label, 0)
+
+        self.log(f'{count["orphan"]} orphan files found.')
+        self.log(f'{count["missing"]} uploads without file found.')
+        self.log(f'{count["drift"]} uploads with size mismatch found.')
+        if fix:
+            self.log(f'{count["fixed"]} issues fixed.')
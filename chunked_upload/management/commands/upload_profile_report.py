@@ -0,0 +1,111 @@
+import json
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def read_records(path):
+    """
+    Yields the profiles of a file written by the sink: JSON lines, or log
+    lines containing the JSON record (`log_sink`). Other lines are ignored.
+    """
+    with open(path) as file_obj:
+        for line in file_obj:
+            start = line.find('{')
+            if start < 0:
+                continue
+            try:
+                record = json.loads(line[start:])
+            except ValueError:
+                continue
+            if isinstance(record, dict) and 'sections' in record:
+                yield record
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Aggregates the profiles of upload requests (see CHUNKED_UPLOAD_PROFILING_SINK) and '
+        'shows the steps and functions which take the most time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='+',
+            help='Files containing the profiles (JSON lines or logs of "log_sink").')
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=10,
+            help='Number of steps and functions shown.')
+        parser.add_argument(
+            '--sort',
+            choices=('total', 'mean', 'p95', 'max'),
+            default='total',
+            help='Statistic used to sort the steps.')
+        parser.add_argument(
+            '--view',
+            default=None,
+            help='Only aggregate the profiles of this view (class name).')
+
+    def handle(self, *args, **options):
+        top = options['top']
+        durations = defaultdict(list)
+        functions = defaultdict(lambda: [0, 0.0, 0.0])
+        count = 0
+        try:
+            for path in options['paths']:
+                for record in read_records(path):
+                    if options['view'] and record.get('view') != options['view']:
+                        continue
+                    count += 1
+                    durations['(request)'].append(record.get('duration') or 0)
+                    for name, duration in record['sections'].items():
+                        durations[name].append(duration)
+                    for name, calls, tottime, cumtime in record.get('functions', ()):
+                        stats = functions[name]
+                        stats[0] += calls
+                        stats[1] += tottime
+                        stats[2] += cumtime
+        except OSError as err:
+            raise CommandError(str(err))
+
+        self.stdout.write(f'{count} profiled requests.')
+        if not count:
+            return
+
+        rows = []
+        for name, values in durations.items():
+            rows.append({
+                'name': name,
+                'count': len(values),
+                'total': sum(values),
+                'mean': sum(values) / len(values),
+                'p95': percentile(values, 0.95),
+                'max': max(values),
+            })
+        rows.sort(key=lambda row: row[options['sort']], reverse=True)
+        self.stdout.write('')
+        self.stdout.write(
+            f'{"step":<24} {"count":>8} {"total (s)":>11} {"mean (ms)":>11} '
+            f'{"p95 (ms)":>11} {"max (ms)":>11}'
+        )
+        for row in rows[:top]:
+            self.stdout.write(
+                f'{row["name"]:<24} {row["count"]:>8} {row["total"]:>11.3f} '
+                f'{row["mean"] * 1000:>11.2f} {row["p95"] * 1000:>11.2f} '
+                f'{row["max"] * 1000:>11.2f}'
+            )
+
+        if functions:
+            self.stdout.write('')
+            self.stdout.write(f'{"calls":>10} {"tottime (s)":>12} {"cumtime (s)":>12}  function')
+            items = sorted(functions.items(), key=lambda item: item[1][2], reverse=True)
+            for name, (calls, tottime, cumtime) in items[:top]:
+                self.stdout.write(f'{calls:>10} {tottime:>12.3f} {cumtime:>12.3f}  {name}')
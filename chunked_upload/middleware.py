@@ -0,0 +1,17 @@
+import time
+
+
+class RequestStartMiddleware:
+    """
+    Records when the request started (`request.upload_started`, monotonic
+    clock), so that the upload views measure the transfer of the chunks.
+    Must be the first middleware: other middleware (e.g. the CSRF middleware)
+    may read the request body before the view is called.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.upload_started = time.monotonic()
+        return self.get_response(request)
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chunked_upload', '0002_alter_chunkedupload_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chunkedupload',
+            name='created_on',
+            field=models.DateTimeField(
+                auto_now_add=True,
+                db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='chunkedupload',
+            name='status',
+            field=models.PositiveSmallIntegerField(
+                choices=[(1, 'Uploading'), (2, 'Complete')],
+                db_index=True,
+                default=1),
+        ),
+    ]
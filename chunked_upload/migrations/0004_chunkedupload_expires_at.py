@@ -0,0 +1,29 @@
+import chunked_upload.models
+from django.db import migrations, models
+
+
+def set_expires_at(apps, schema_editor):
+    from chunked_upload.settings import upload_settings
+
+    ChunkedUpload = apps.get_model('chunked_upload', 'ChunkedUpload')
+    ChunkedUpload.objects.update(
+        expires_at=models.F('created_on') + upload_settings.EXPIRATION_DELTA
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chunked_upload', '0003_index_status_created_on'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='expires_at',
+            field=models.DateTimeField(
+                db_index=True,
+                default=chunked_upload.models.default_expires_at),
+        ),
+        migrations.RunPython(set_expires_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chunked_upload', '0004_chunkedupload_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='node',
+            field=models.CharField(
+                blank=True,
+                default='',
+                editable=False,
+                max_length=255),
+        ),
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='staged',
+            field=models.BooleanField(
+                default=False,
+                editable=False),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chunked_upload', '0005_chunkedupload_node_staged'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='validated_bytes',
+            field=models.BigIntegerField(
+                default=0,
+                editable=False),
+        ),
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='validation_error',
+            field=models.TextField(
+                blank=True,
+                default='',
+                editable=False),
+        ),
+    ]
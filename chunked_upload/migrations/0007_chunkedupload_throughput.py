@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chunked_upload', '0006_chunkedupload_validation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='throughput',
+            field=models.FloatField(
+                blank=True,
+                editable=False,
+                null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chunked_upload', '0007_chunkedupload_throughput'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='extracted_offset',
+            field=models.BigIntegerField(
+                default=0,
+                editable=False),
+        ),
+    ]
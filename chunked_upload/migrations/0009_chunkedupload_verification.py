@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chunked_upload', '0008_chunkedupload_extracted_offset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='verification',
+            field=models.JSONField(
+                blank=True,
+                default=dict,
+                editable=False),
+        ),
+    ]
@@ -0,0 +1,22 @@
+import chunked_upload.models
+import chunked_upload.settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chunked_upload', '0009_chunkedupload_verification'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chunkedupload',
+            name='file',
+            field=models.FileField(
+                db_index=True,
+                max_length=255,
+                storage=chunked_upload.models.get_storage,
+                upload_to=chunked_upload.settings.UPLOAD_TO),
+        ),
+    ]
@@ -1,27 +1,246 @@
+import errno
+import logging
+import os
+import shutil
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 from django.db import models
 from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
 from django.utils import timezone
 
-from .settings import (
-    EXPIRATION_DELTA, UPLOAD_TO, STORAGE,
-    DEFAULT_MODEL_USER_FIELD_NULL, DEFAULT_MODEL_USER_FIELD_BLANK
-)
-from .constants import CHUNKED_UPLOAD_CHOICES, UPLOADING
+from . import dedup, verification
+from .archive import get_extract_dir
+from .response import format_datetime
+from .settings import upload_settings
+from .constants import CHUNKED_UPLOAD_CHOICES, UPLOADING, http_status
+from .exceptions import ChunkedUploadError
+
+
+logger = logging.getLogger(__name__)
 
 
 def generate_upload_id():
     return uuid.uuid4().hex
 
 
+def default_expires_at():
+    return timezone.now() + upload_settings.EXPIRATION_DELTA
+
+
+def get_max_lifetime():
+    """
+    Max duration between the creation and the expiration of an upload.
+    """
+    if upload_settings.SLIDING_EXPIRATION:
+        return max(upload_settings.EXPIRATION_DELTA, upload_settings.MAX_EXPIRATION_DELTA)
+    return upload_settings.EXPIRATION_DELTA
+
+
 def get_storage():
     """
     This function is used to avoid having to make a migration on the model
     if the storage setting is customized.
     """
-    return STORAGE
+    return upload_settings.STORAGE
+
+
+def get_upload_root():
+    """
+    Static part of the upload path (before the first date placeholder).
+    """
+    parts = []
+    for part in Path(upload_settings.UPLOAD_PATH).parts:
+        if '%' in part:
+            break
+        parts.append(part)
+    return os.path.join(*parts) if parts else ''
+
+
+def prune_empty_dirs(root, min_age=60, exclude=()):
+    """
+    Removes the empty sub-directories of `root` (bottom-up) which have not
+    been modified since `min_age` seconds, so that directories of new
+    uploads are not removed before their file is created. Directories only
+    containing removed directories are removed too.
+    Returns the number of removed directories.
+    """
+    limit = time.time() - min_age
+    removed = set()
+    for dir_path, dir_names, file_names in os.walk(root, topdown=False):
+        if dir_path == root or file_names or dir_path in exclude:
+            continue
+        sub_dirs = [os.path.join(dir_path, name) for name in dir_names]
+        try:
+            if (sub_dirs and removed.issuperset(sub_dirs)) or os.stat(dir_path).st_mtime < limit:
+                # Fails if a file or a directory has been added meanwhile
+                os.rmdir(dir_path)
+                removed.add(dir_path)
+        except OSError:
+            pass
+    return len(removed)
+
+
+def is_storage_root(storage, path):
+    return os.path.realpath(path) == os.path.realpath(storage.path(''))
+
+
+def get_upload_dirs(storage):
+    """
+    Returns the local directories containing upload files, and the
+    directories to exclude when pruning them. The storage root is never
+    returned (if `CHUNKED_UPLOAD_PATH` has no static part), as it contains
+    other files than the uploads.
+    """
+    dirs = []
+    path = storage.path(get_upload_root())
+    if not is_storage_root(storage, path):
+        dirs.append(path)
+    else:
+        logger.warning(
+            'CHUNKED_UPLOAD_PATH has no static part, the upload directories of the storage '
+            'are not pruned'
+        )
+    if upload_settings.STAGING_ROOT:
+        dirs.append(os.path.join(upload_settings.STAGING_ROOT, get_upload_root()))
+    return dirs, {storage.path(upload_settings.CHUNK_STORE_PATH)}
+
+
+def get_staging_path(name):
+    return os.path.join(upload_settings.STAGING_ROOT, name)
+
+
+def create_empty_file(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='xb'):
+        pass
+
+
+def delete_extract_dir(storage, name):
+    """
+    Deletes the files extracted from the archive uploaded in the file `name`.
+    """
+    path = storage.path(get_extract_dir(name))
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def delete_manifest(storage, name, staged=False):
+    """
+    Deletes the manifest of the upload file `name` (deduplication).
+    """
+    try:
+        path = get_staging_path(name) if staged else storage.path(name)
+    except NotImplementedError:
+        return
+    try:
+        os.remove(dedup.get_manifest_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def delete_upload_file(storage, name, staged=False):
+    """
+    Deletes a file of the storage or of the staging directory, its manifest
+    and the files extracted from it.
+    """
+    if not name:
+        return
+    if staged:
+        try:
+            os.remove(get_staging_path(name))
+        except FileNotFoundError:
+            pass
+    else:
+        storage.delete(name)
+    delete_manifest(storage, name, staged=staged)
+    delete_extract_dir(storage, name)
+
+
+def delete_files(storage, files, executor):
+    """
+    Deletes files, given as (name, staged) tuples, with a pool of threads.
+    The uploads are already deleted, so a failure does not stop the deletion
+    of the other files: it is logged (the file is then an orphan, see the
+    `reconcile_uploads` command).
+    Returns the number of files which could not be deleted.
+    """
+    def delete(file):
+        try:
+            delete_upload_file(storage, *file)
+        except Exception:
+            logger.exception('Failed to delete the upload file %s', file[0])
+            return False
+        return True
+
+    return sum(not deleted for deleted in executor.map(delete, files))
+
+
+class ChunkedUploadQuerySet(models.QuerySet):
+
+    def expired(self):
+        return self.filter(expires_at__lte=timezone.now())
+
+    def with_local_files(self):
+        """
+        Uploads whose file is available on this node (files of uploads
+        staged on other nodes are not).
+        """
+        if not upload_settings.STAGING_ROOT:
+            return self
+        return self.filter(models.Q(staged=False) | models.Q(node=upload_settings.NODE_NAME or ''))
+
+    def with_remote_files(self):
+        """
+        Uploads whose file is staged on another node.
+        """
+        if not upload_settings.STAGING_ROOT:
+            return self.none()
+        return self.filter(staged=True).exclude(node=upload_settings.NODE_NAME or '')
+
+    def expire(self):
+        """
+        Marks the uploads as expired, they will be deleted (with their files)
+        by the next run of the cleaning commands.
+        Returns the number of expired uploads.
+        """
+        return self.update(expires_at=timezone.now())
+
+    def delete_with_files(self, batch_size=1000, workers=8):
+        """
+        Deletes the uploads and their files. Uploads are deleted by batches
+        and the files of each batch are deleted by a pool of threads.
+        Uploads staged on another node are only expired, they are deleted
+        by the cleaning commands running on their node. Failures to delete
+        files are logged.
+        Returns the number of deleted uploads by status.
+        """
+        self.with_remote_files().expire()
+        storage = self.model._meta.get_field('file').storage
+        count = {}
+        last_pk = None
+        qs = self.with_local_files().order_by('pk').values_list('pk', 'file', 'status', 'staged')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch_qs = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+                batch = list(batch_qs[:batch_size])
+                if not batch:
+                    break
+                last_pk = batch[-1][0]
+                self.model.objects.filter(pk__in=[row[0] for row in batch]).delete()
+                for _pk, _name, status, _staged in batch:
+                    count[status] = count.get(status, 0) + 1
+                delete_files(storage, [(name, staged) for _pk, name, _s, staged in batch], executor)
+        return count
 
 
 class AbstractChunkedUpload(models.Model):
@@ -33,48 +252,349 @@ class AbstractChunkedUpload(models.Model):
 
     upload_id = models.CharField(max_length=32, unique=True, editable=False,
                                  default=generate_upload_id)
-    file = models.FileField(max_length=255, upload_to=UPLOAD_TO,
-                            storage=get_storage)
+    # Indexed for the lookups of files by name (reconcile_uploads)
+    file = models.FileField(max_length=255, upload_to=upload_settings.UPLOAD_TO,
+                            storage=get_storage, db_index=True)
     filename = models.CharField(max_length=255)
     offset = models.BigIntegerField(default=0)
-    created_on = models.DateTimeField(auto_now_add=True)
+    created_on = models.DateTimeField(auto_now_add=True, db_index=True)
     status = models.PositiveSmallIntegerField(choices=CHUNKED_UPLOAD_CHOICES,
-                                              default=UPLOADING)
+                                              default=UPLOADING, db_index=True)
     completed_on = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(default=default_expires_at, db_index=True)
+    # Node owning the upload and whether the file is in its staging directory
+    node = models.CharField(max_length=255, blank=True, default='', editable=False)
+    staged = models.BooleanField(default=False, editable=False)
+    # Written by the validation threads (pipelined validation): number of
+    # validated bytes and error of the failed validation
+    validated_bytes = models.BigIntegerField(default=0, editable=False)
+    validation_error = models.TextField(blank=True, default='', editable=False)
+    # Observed throughput of the chunk requests (bytes per second, moving
+    # average), used to recommend a chunk size to the client
+    throughput = models.FloatField(null=True, blank=True, editable=False)
+    # Position of the next member to extract (incremental extraction of
+    # plain tar archives)
+    extracted_offset = models.BigIntegerField(default=0, editable=False)
+    # Cached results of the verification methods (`sniff_type` etc.), with
+    # the size of the file they were computed for
+    verification = models.JSONField(default=dict, blank=True, editable=False)
+
+    objects = ChunkedUploadQuerySet.as_manager()
+
+    # Fields which are only saved explicitly (with `update_fields`), so that
+    # saving an upload does not overwrite the result of a concurrent validation
+    validation_fields = ('validated_bytes', 'validation_error')
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.validation_fields
+            ]
+        super(AbstractChunkedUpload, self).save(*args, **kwargs)
+
+    @property
+    def rejected(self):
+        return bool(self.validation_error)
 
     @property
     def expires_on(self):
-        return self.created_on + EXPIRATION_DELTA
+        return self.expires_at
+
+    @property
+    def expires_on_iso(self):
+        """
+        Expiration date formatted for responses. The formatted value is cached
+        on the instance.
+        """
+        expires_on = self.expires_on
+        cached = self.__dict__.get('_expires_on_iso')
+        if cached is None or cached[0] != expires_on:
+            cached = self._expires_on_iso = (expires_on, format_datetime(expires_on))
+        return cached[1]
 
     @property
     def expired(self):
-        return self.expires_on <= timezone.now()
+        return self.expires_at <= timezone.now()
+
+    def extend_expiration(self):
+        """
+        Push back the expiration date if the sliding expiration is enabled.
+        Returns `True` if the expiration date was changed.
+        """
+        if not upload_settings.SLIDING_EXPIRATION:
+            return False
+        now = timezone.now()
+        expires_at = now + upload_settings.EXPIRATION_DELTA
+        max_expires_at = (self.created_on or now) + upload_settings.MAX_EXPIRATION_DELTA
+        expires_at = min(expires_at, max_expires_at)
+        if expires_at <= self.expires_at:
+            return False
+        self.expires_at = expires_at
+        return True
+
+    def record_throughput(self, size, duration, weight=0.5):
+        """
+        Update the moving average of the throughput with a chunk of `size`
+        bytes received and written in `duration` seconds.
+        """
+        if size <= 0 or duration <= 0:
+            return
+        rate = size / duration
+        if self.throughput is None:
+            self.throughput = rate
+        else:
+            self.throughput = weight * rate + (1 - weight) * self.throughput
 
     def delete(self, delete_file=True, *args, **kwargs):
         if self.file:
-            storage, path = self.file.storage, self.file.path
+            storage, name = self.file.storage, self.file.name
         super(AbstractChunkedUpload, self).delete(*args, **kwargs)
         if self.file and delete_file:
-            storage.delete(path)
+            delete_upload_file(storage, name, staged=self.staged)
+
+    def get_extract_dir(self):
+        """
+        Name (in the storage) of the directory containing the files extracted
+        from the uploaded archive.
+        """
+        return get_extract_dir(self.file.name)
+
+    def get_path(self):
+        """
+        Local path of the file (in the staging directory if staged).
+        """
+        if self.staged:
+            return get_staging_path(self.file.name)
+        return self.file.path
+
+    def stage(self):
+        """
+        Create the (empty) file of a new upload in the staging directory.
+        """
+        name = self.file.field.generate_filename(self, '')
+        create_empty_file(get_staging_path(name))
+        self.file.name = name
+        self.staged = True
+
+    def create_file(self):
+        """
+        Create the (empty) file of a new upload, in the staging directory if
+        `CHUNKED_UPLOAD_STAGING_ROOT` is set. Upload ids are unique, so the
+        name given by `upload_to` is used directly, without looking for an
+        available name in the storage (only for local storages).
+        """
+        if upload_settings.STAGING_ROOT:
+            self.stage()
+            return
+        name = self.file.field.generate_filename(self, '')
+        try:
+            path = self.file.storage.path(name)
+        except NotImplementedError:
+            self.file.save(name='', content=ContentFile(''), save=False)
+            return
+        create_empty_file(path)
+        self.file.name = name
+
+    def delete_file(self):
+        """
+        Delete the file without deleting the upload.
+        """
+        if self.staged:
+            delete_upload_file(self.file.storage, self.file.name, staged=True)
+            self.file.name = None
+        else:
+            delete_manifest(self.file.storage, self.file.name)
+            self.file.delete(save=False)
+
+    def consolidate(self, save=True):
+        """
+        Move the file from the staging directory to the storage.
+        """
+        if not self.staged:
+            return
+        staging_path = self.get_path()
+        storage = self.file.storage
+        try:
+            # Fast path: rename on the same filesystem
+            path = storage.path(self.file.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                raise FileExistsError(path)
+            os.rename(staging_path, path)
+        except NotImplementedError:
+            pass
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EEXIST):
+                raise
+        if os.path.exists(staging_path):
+            with open(staging_path, mode='rb') as file_obj:
+                self.file.name = storage.save(self.file.name, File(file_obj))
+            os.remove(staging_path)
+        self.staged = False
+        if save:
+            self.save(update_fields=['file', 'staged'])
 
     def __str__(self):
         return '<%s - upload_id: %s - bytes: %s - status: %s>' % (
             self.filename, self.upload_id, self.offset, self.status)
 
-    def append_chunk(self, chunk, save=True):
+    def append_chunk(self, chunk, save=True, start=None):
+        """
+        Append the chunk to the file. The file is locked while writing, so
+        that the data of concurrent requests cannot be mixed. If `start` is
+        given, the chunk is only written if the file size is `start`.
+        Raises `FileNotFoundError` if the file was deleted (upload aborted),
+        the file is not created again.
+        """
         self.file.close()
-        with open(self.file.path, mode='ab') as file_obj:  # mode = append+binary
-            # We can use .read() safely because chunk is already in memory
-            file_obj.write(chunk.read())
-        self.offset += chunk.size
+        fd = os.open(self.get_path(), os.O_WRONLY | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+        with os.fdopen(fd, mode='ab') as file_obj:
+            if fcntl is not None:
+                # Released when the file is closed
+                fcntl.flock(file_obj, fcntl.LOCK_EX)
+            position = file_obj.seek(0, os.SEEK_END)
+            if start is not None and position != start:
+                raise ChunkedUploadError(
+                    status=http_status.HTTP_400_BAD_REQUEST,
+                    detail='File has been written by another request',
+                    size=position
+                )
+            start = position
+            try:
+                for data in chunk.chunks():
+                    file_obj.write(data)
+            except BaseException:
+                # Do not leave a partially written chunk
+                file_obj.truncate(start)
+                raise
+            size = file_obj.tell() - start
+        self.offset += size
+        extended = self.extend_expiration()
         if save:
-            self.save(update_fields=['offset'])
+            self.save(update_fields=['offset', 'expires_at'] if extended else ['offset'])
         self.file.close()  # Flush
 
+    def get_manifest_path(self):
+        return dedup.get_manifest_path(self.get_path())
+
+    def has_manifest(self):
+        """
+        Whether chunks of the chunk store are referenced by the upload
+        (deduplication).
+        """
+        return os.path.exists(self.get_manifest_path())
+
+    def get_manifest(self):
+        """
+        Returns the list of (digest, size) of the chunks of the chunk store
+        referenced by the upload.
+        """
+        return dedup.read_manifest(self.get_manifest_path())
+
+    def append_stored_chunk(self, digest, size, save=True, start=None):
+        """
+        Append a chunk of the chunk store. The chunk is only referenced in
+        the manifest, the file is assembled with `assemble()`. If `start` is
+        given, the chunk is only added if the upload size is `start`.
+        Raises `FileNotFoundError` if the file was deleted (upload aborted).
+        """
+        path = self.get_path()
+        manifest_path = dedup.get_manifest_path(path)
+        position = dedup.append_manifest_entry(manifest_path, digest, size, start=start)
+        if not os.path.exists(path):
+            # Deleted while the manifest was written, do not leave the manifest
+            try:
+                os.remove(manifest_path)
+            except FileNotFoundError:
+                pass
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if start is not None and position != start:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='File has been written by another request',
+                size=position
+            )
+        self.offset += size
+        extended = self.extend_expiration()
+        if save:
+            self.save(update_fields=['offset', 'expires_at'] if extended else ['offset'])
+
+    def assemble(self, store):
+        """
+        Write the file from the chunks referenced in the manifest, which is
+        then deleted.
+        """
+        manifest_path = self.get_manifest_path()
+        if not os.path.exists(manifest_path):
+            return
+        self.file.close()
+        with open(self.get_path(), mode='wb') as file_obj:
+            for digest, _size in dedup.read_manifest(manifest_path):
+                with store.open(digest) as chunk_obj:
+                    shutil.copyfileobj(chunk_obj, file_obj)
+        os.remove(manifest_path)
+
+    def get_verification(self, key, compute, save=True):
+        """
+        Returns the result of `compute(path)` cached in `verification`. The
+        cache is cleared if the size of the file changed.
+        """
+        path = self.get_path()
+        size = os.stat(path).st_size
+        cache = self.verification
+        if cache.get('size') != size:
+            cache = {'size': size}
+        if key not in cache:
+            cache[key] = compute(path)
+            self.verification = cache
+            if save and self.pk is not None:
+                self.save(update_fields=['verification'])
+        return cache[key]
+
+    def sniff_type(self, save=True):
+        """
+        Content type of the file, detected from its first bytes (`None` if
+        not recognized).
+        """
+        def compute(path):
+            with open(path, mode='rb') as file_obj:
+                return verification.sniff_type(file_obj.read(verification.SNIFF_SIZE))
+        return self.get_verification('type', compute, save=save)
+
+    def get_sampled_hash(self, samples=16, sample_size=64 * 1024, algorithm='sha256', save=True):
+        """
+        Fingerprint of the file computed from samples of its content (see
+        `verification.sampled_hash`).
+        """
+        return self.get_verification(
+            f'sampled_hash:{algorithm}:{samples}:{sample_size}',
+            lambda path: verification.sampled_hash(
+                path, samples=samples, sample_size=sample_size, algorithm=algorithm
+            ),
+            save=save,
+        )
+
+    def get_tree_hash(self, algorithm='sha256', save=True):
+        """
+        Hash of the file computed from the hashes of its blocks, which are
+        hashed in parallel (see `verification.tree_hash`).
+        """
+        block_size = upload_settings.VERIFICATION_BLOCK_SIZE
+        return self.get_verification(
+            f'tree_hash:{algorithm}:{block_size}',
+            lambda path: verification.tree_hash(
+                path, block_size=block_size, algorithm=algorithm,
+                workers=upload_settings.VERIFICATION_WORKERS,
+            ),
+            save=save,
+        )
+
     def get_size(self):
-        if self.file:
-            return Path(self.file.path).stat().st_size
-        return 0
+        if not self.file:
+            return 0
+        path = self.get_path()
+        return Path(path).stat().st_size + dedup.get_manifest_size(dedup.get_manifest_path(path))
 
     class Meta:
         abstract = True
@@ -88,6 +608,6 @@ class ChunkedUpload(AbstractChunkedUpload):
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
         related_name='chunked_uploads',
-        null=DEFAULT_MODEL_USER_FIELD_NULL,
-        blank=DEFAULT_MODEL_USER_FIELD_BLANK
+        null=upload_settings.DEFAULT_MODEL_USER_FIELD_NULL,
+        blank=upload_settings.DEFAULT_MODEL_USER_FIELD_BLANK
     )
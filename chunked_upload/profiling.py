@@ -0,0 +1,159 @@
+"""
+Opt-in profiling of the upload views. A request is profiled if it is
+sampled (`CHUNKED_UPLOAD_PROFILING_SAMPLE_RATE`) or if a staff user sends
+the "X-Upload-Profile" header. The duration of the main steps of the
+request (and optionally a cProfile report) is sent to the sink
+(`CHUNKED_UPLOAD_PROFILING_SINK`), a function receiving a dict.
+"""
+import cProfile
+import functools
+import json
+import logging
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+# Number of functions kept in the cProfile report
+TOP_FUNCTIONS = 30
+
+# Held while a request is profiled with cProfile
+_cprofile_lock = threading.Lock()
+
+
+def log_sink(record):
+    """
+    Default sink: logs the record as JSON (logger "chunked_upload.profiling").
+    """
+    logger.info('Upload request profile: %s', json.dumps(record, cls=DjangoJSONEncoder))
+
+
+class JSONLinesSink:
+    """
+    Sink appending the records to a file, as JSON lines.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+        with self.lock, open(self.path, mode='a') as file_obj:
+            file_obj.write(line)
+
+
+class RequestProfile:
+    """
+    Measures the duration of the methods of a view during a request.
+    """
+
+    def __init__(self, use_cprofile=False):
+        self.sections = {}
+        self.calls = {}
+        self.start = time.perf_counter()
+        self.duration = None
+        self.profiler = cProfile.Profile() if use_cprofile else None
+        self.cprofile_skipped = False
+
+    def wrap(self, method, name):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.sections[name] = self.sections.get(name, 0) + time.perf_counter() - start
+                self.calls[name] = self.calls.get(name, 0) + 1
+        return wrapper
+
+    def start_profiler(self):
+        """
+        Enables cProfile. Only one profiler can be active in the process
+        (since Python 3.12), so the requests are profiled one at a time: if
+        another request is being profiled, or if another profiling tool is
+        active, only the durations are measured.
+        """
+        if self.profiler is None:
+            return
+        if _cprofile_lock.acquire(blocking=False):
+            try:
+                self.profiler.enable()
+                return
+            except Exception:
+                _cprofile_lock.release()
+                logger.warning('Failed to enable cProfile', exc_info=True)
+        self.profiler = None
+        self.cprofile_skipped = True
+
+    def stop_profiler(self):
+        if self.profiler is None:
+            return
+        try:
+            self.profiler.disable()
+        except Exception:
+            logger.warning('Failed to disable cProfile', exc_info=True)
+        finally:
+            _cprofile_lock.release()
+
+    @contextmanager
+    def enable(self, view, methods):
+        """
+        Profiles the given methods of the view (the instance is specific
+        to the request, so the wrappers are set as instance attributes and
+        removed afterwards). Failures of the profiling are logged and do
+        not affect the request.
+        """
+        wrapped = []
+        try:
+            for name in methods:
+                method = getattr(view, name, None)
+                if method is not None and name not in vars(view):
+                    setattr(view, name, self.wrap(method, name))
+                    wrapped.append(name)
+            self.start_profiler()
+        except Exception:
+            logger.exception('Failed to start the profiling of an upload request')
+        self.start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.stop_profiler()
+            self.duration = time.perf_counter() - self.start
+            for name in wrapped:
+                vars(view).pop(name, None)
+
+    def get_functions(self):
+        """
+        Returns the functions of the cProfile report which have the highest
+        cumulative time, as (function, calls, total time, cumulative time).
+        """
+        stats = pstats.Stats(self.profiler)
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [
+            (f'{filename}:{line}({name})', calls, tottime, cumtime)
+            for (filename, line, name), (_pcalls, calls, tottime, cumtime, _callers)
+            in functions[:TOP_FUNCTIONS]
+        ]
+
+    def get_record(self, view, request, response):
+        record = {
+            'date': timezone.now(),
+            'view': type(view).__name__,
+            'path': request.path,
+            'status': getattr(response, 'status_code', None),
+            'duration': self.duration,
+            'sections': self.sections,
+            'calls': self.calls,
+        }
+        if self.profiler is not None:
+            record['functions'] = self.get_functions()
+        elif self.cprofile_skipped:
+            record['cprofile_skipped'] = True
+        return record
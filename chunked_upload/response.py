@@ -1,6 +1,61 @@
+import functools
+
 from django.http import HttpResponse
 
-from .settings import ENCODER, CONTENT_TYPE
+from .settings import upload_settings
+
+
+def format_datetime(value):
+    """
+    Format a datetime like `DjangoJSONEncoder` (ECMA-262 format).
+    """
+    result = value.isoformat()
+    if value.microsecond:
+        result = result[:23] + result[26:]
+    if result.endswith('+00:00'):
+        result = result[:-6] + 'Z'
+    return result
+
+
+@functools.cache
+def get_fast_encoder():
+    """
+    Returns the fastest available JSON encoder: orjson, msgspec or
+    `DjangoJSONEncoder` if none of them is installed. The types not handled
+    natively are encoded like with `DjangoJSONEncoder`, datetimes included
+    with orjson. msgspec encodes datetimes, times and durations natively
+    (with microseconds).
+    """
+    from django.core.serializers.json import DjangoJSONEncoder
+
+    fallback = DjangoJSONEncoder().default
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        def encode(data):
+            return orjson.dumps(
+                data, default=fallback,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+            )
+        return encode
+    try:
+        import msgspec
+    except ImportError:
+        pass
+    else:
+        return msgspec.json.Encoder(enc_hook=fallback).encode
+    return DjangoJSONEncoder().encode
+
+
+def fast_encode(data):
+    """
+    Encodes response data with the fastest available JSON encoder (see
+    `get_fast_encoder`). Used with
+    `CHUNKED_UPLOAD_ENCODER = 'chunked_upload.response.fast_encode'`.
+    """
+    return get_fast_encoder()(data)
 
 
 class Response(HttpResponse):
@@ -9,8 +64,8 @@ class Response(HttpResponse):
 
     def __init__(self, content, status=None, *args, **kwargs):
         super(Response, self).__init__(
-            content=ENCODER(content),
-            content_type=CONTENT_TYPE,
+            content=upload_settings.ENCODER(content),
+            content_type=upload_settings.CONTENT_TYPE,
             status=status,
             *args, **kwargs
         )
@@ -1,53 +1,304 @@
+"""
+Settings of django-chunked-upload.
+
+Settings are resolved lazily, on first access, and cached in the
+`upload_settings` object. The cache is cleared when a "CHUNKED_UPLOAD_*"
+setting is changed (for example with `override_settings` in tests).
+The settings are also available as attributes of this module for backward
+compatibility (e.g. `chunked_upload.settings.MAX_BYTES`).
+"""
 import os
 import time
 from datetime import timedelta
 
 from django.conf import settings
-from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
 from django.utils.module_loading import import_string
-from django.core.files.storage import FileSystemStorage
 
 
 # How long after creation the upload will expire
 DEFAULT_EXPIRATION_DELTA = timedelta(days=1)
-EXPIRATION_DELTA = getattr(settings, 'CHUNKED_UPLOAD_EXPIRATION_DELTA',
-                           DEFAULT_EXPIRATION_DELTA)
+
+# If `True`, the expiration date is pushed back to `EXPIRATION_DELTA` after
+# each chunk (sliding expiration), without exceeding `MAX_EXPIRATION_DELTA`
+# after creation
+DEFAULT_SLIDING_EXPIRATION = False
+DEFAULT_MAX_EXPIRATION_DELTA = timedelta(days=7)
 
 # Path where uploading files will be stored until completion
 DEFAULT_UPLOAD_PATH = 'chunked_uploads/%Y/%m/%d'
-UPLOAD_PATH = getattr(settings, 'CHUNKED_UPLOAD_PATH', DEFAULT_UPLOAD_PATH)
 
 
 # upload_to function to be used in the FileField
 def default_upload_to(instance, filename):
-    filename = os.path.join(UPLOAD_PATH, instance.upload_id + '.part')
+    filename = os.path.join(upload_settings.UPLOAD_PATH, instance.upload_id + '.part')
+    return time.strftime(filename)
+
+
+# Number of directory levels added by `sharded_upload_to` (2 hexadecimal
+# characters of the upload id per level, so 256 sub-directories per level)
+DEFAULT_SHARD_DEPTH = 2
+
+
+# upload_to function spreading the files of a day in sub-directories named
+# after the first characters of the upload id, to avoid huge directories
+def sharded_upload_to(instance, filename):
+    upload_id = instance.upload_id
+    shards = [upload_id[index * 2:index * 2 + 2] for index in range(upload_settings.SHARD_DEPTH)]
+    filename = os.path.join(upload_settings.UPLOAD_PATH, *shards, upload_id + '.part')
     return time.strftime(filename)
 
 
-UPLOAD_TO = getattr(settings, 'CHUNKED_UPLOAD_TO', default_upload_to)
+DEFAULT_UPLOAD_TO = default_upload_to
 
-# Storage system
-if hasattr(settings, 'CHUNKED_UPLOAD_STORAGE'):
-    if isinstance(settings.CHUNKED_UPLOAD_STORAGE, str):
-        STORAGE = import_string(settings.CHUNKED_UPLOAD_STORAGE)
-    else:
-        STORAGE = settings.CHUNKED_UPLOAD_STORAGE
-else:
-    STORAGE = FileSystemStorage()
+# Storage system. `None` means a `FileSystemStorage` with default options
+DEFAULT_STORAGE = None
 
-# Function used to encode response data. Receives a dict and return a string
-DEFAULT_ENCODER = DjangoJSONEncoder().encode
-ENCODER = getattr(settings, 'CHUNKED_UPLOAD_ENCODER', DEFAULT_ENCODER)
+# Function used to encode response data (or its import path). Receives a dict
+# and return a string (or bytes). `None` means `DjangoJSONEncoder().encode`
+DEFAULT_ENCODER = None
 
 # Content-Type for the response data
 DEFAULT_CONTENT_TYPE = 'application/json'
-CONTENT_TYPE = getattr(settings, 'CHUNKED_UPLOAD_CONTENT_TYPE',
-                       DEFAULT_CONTENT_TYPE)
 
 # Max amount of data (in bytes) that can be uploaded. `None` means no limit
 DEFAULT_MAX_BYTES = None
-MAX_BYTES = getattr(settings, 'CHUNKED_UPLOAD_MAX_BYTES', DEFAULT_MAX_BYTES)
 
-# determine the "null" and "blank" properties of "user" field in the "ChunkedUpload" model
-DEFAULT_MODEL_USER_FIELD_NULL = getattr(settings, 'CHUNKED_UPLOAD_MODEL_USER_FIELD_NULL', True)
-DEFAULT_MODEL_USER_FIELD_BLANK = getattr(settings, 'CHUNKED_UPLOAD_MODEL_USER_FIELD_BLANK', True)
+# If `True`, the chunks are stored in a content-addressed store and are not
+# sent again if they are already known. The files are assembled on completion
+DEFAULT_DEDUP = False
+
+# Path of the content-addressed chunks store (relative to the storage)
+DEFAULT_CHUNK_STORE_PATH = 'chunked_uploads/chunks'
+
+# Max ratio between the decompressed and compressed sizes of a chunk sent with
+# a "Content-Encoding" header (protection against decompression bombs).
+# `None` means no limit
+DEFAULT_MAX_DECOMPRESSION_RATIO = 100
+
+# Header used to delegate the delivery of files to the web server, for example
+# "X-Accel-Redirect" for Nginx or "X-Sendfile" for Apache/Lighttpd. `None` means
+# that files are served by Django
+DEFAULT_SENDFILE_HEADER = None
+
+# URL prefix of the Nginx internal location mapped on the storage root (only
+# used with "X-Accel-Redirect")
+DEFAULT_SENDFILE_URL = '/protected/'
+
+# Name of the node (server) handling the request. When set, uploads record
+# the node owning them and responses include it in the "X-Upload-Node"
+# header, so that a load balancer can route the next chunks to the same node
+DEFAULT_NODE_NAME = None
+
+# Base URL of each node ({node name: URL}), used to redirect the requests
+# received by a node which does not own the (staged) upload
+DEFAULT_NODE_URLS = {}
+
+# Local directory (absolute path) where the files of uploads in progress are
+# written (node-local staging, for example on a fast local disk). Files are
+# moved to the storage when the upload is completed. `None` means that files
+# are directly written in the storage
+DEFAULT_STAGING_ROOT = None
+
+# Chunk size (in bytes) recommended to clients before the throughput of the
+# upload is known. The recommended size is then adapted so that sending a
+# chunk takes about `CHUNK_DURATION` seconds, between `MIN_CHUNK_SIZE` and
+# `MAX_CHUNK_SIZE` (or 64 times `CHUNK_SIZE` if there is no max)
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MIN_CHUNK_SIZE = 256 * 1024
+DEFAULT_CHUNK_DURATION = 5
+
+# Max size (in bytes) of a chunk. `None` means no limit
+DEFAULT_MAX_CHUNK_SIZE = None
+
+# If `True`, uploaded archives (tar, compressed tar or zip) are extracted to
+# the storage on completion (plain tar archives while chunks are received).
+# The extraction fails if the archive contains more than `ARCHIVE_MAX_MEMBERS`
+# files or more than `ARCHIVE_MAX_SIZE` bytes (`None` means no limit)
+DEFAULT_EXTRACT_ARCHIVES = False
+DEFAULT_ARCHIVE_MAX_SIZE = None
+DEFAULT_ARCHIVE_MAX_MEMBERS = 10000
+# Number of threads writing the extracted files
+DEFAULT_ARCHIVE_WORKERS = 4
+
+# If `True`, chunks are validated (`ChunkedUploadView.validate_chunk_data`) by
+# a pool of threads after being written and acknowledged, instead of before
+# being written. A failed validation rejects the upload
+DEFAULT_PIPELINED_VALIDATION = False
+
+# Number of threads of the validation pool and max number of pending
+# validations (further chunks are validated in the request thread)
+DEFAULT_VALIDATION_WORKERS = 4
+DEFAULT_VALIDATION_MAX_PENDING = 64
+
+# If `True`, chunks are acknowledged with an empty "204 No Content" response,
+# the upload state being sent in headers ("Upload-Offset" etc.). Clients can
+# also request it per request with the "Prefer: return=minimal" header
+DEFAULT_HEADER_ONLY_ACK = False
+
+# Event bus receiving the events of the uploads (see `chunked_upload.events`):
+# instance, class or import path. `None` disables the events
+DEFAULT_EVENT_BUS = 'chunked_upload.events.InProcessEventBus'
+
+# Size of the blocks hashed in parallel by `ChunkedUpload.get_tree_hash()` and
+# number of threads (`None` means the number of CPUs)
+DEFAULT_VERIFICATION_BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_VERIFICATION_WORKERS = None
+
+# Fraction of the upload requests which are profiled (0 disables sampling).
+# Staff users can also request profiling with the "X-Upload-Profile" header
+DEFAULT_PROFILING_SAMPLE_RATE = 0
+# If `True`, a cProfile report is added to the profiles (significant overhead)
+DEFAULT_PROFILING_CPROFILE = False
+# Function (or import path) receiving the profiles (dicts)
+DEFAULT_PROFILING_SINK = 'chunked_upload.profiling.log_sink'
+
+
+def _build_upload_to(value):
+    return import_string(value) if isinstance(value, str) else value
+
+
+def _build_profiling_sink(value):
+    return import_string(value) if isinstance(value, str) else value
+
+
+def _build_event_bus(value):
+    if isinstance(value, str):
+        value = import_string(value)
+    if isinstance(value, type):
+        value = value()
+    return value
+
+
+def _build_storage(value):
+    if value is None:
+        from django.core.files.storage import FileSystemStorage
+        return FileSystemStorage()
+    if isinstance(value, str):
+        return import_string(value)
+    return value
+
+
+def _build_encoder(value):
+    if value is None:
+        from django.core.serializers.json import DjangoJSONEncoder
+        return DjangoJSONEncoder().encode
+    if isinstance(value, str):
+        return import_string(value)
+    return value
+
+
+# Name: (Django setting name, default value, function building the value)
+SETTINGS = {
+    'EXPIRATION_DELTA': ('CHUNKED_UPLOAD_EXPIRATION_DELTA', DEFAULT_EXPIRATION_DELTA, None),
+    'SLIDING_EXPIRATION': ('CHUNKED_UPLOAD_SLIDING_EXPIRATION', DEFAULT_SLIDING_EXPIRATION, None),
+    'MAX_EXPIRATION_DELTA': (
+        'CHUNKED_UPLOAD_MAX_EXPIRATION_DELTA', DEFAULT_MAX_EXPIRATION_DELTA, None
+    ),
+    'UPLOAD_PATH': ('CHUNKED_UPLOAD_PATH', DEFAULT_UPLOAD_PATH, None),
+    'UPLOAD_TO': ('CHUNKED_UPLOAD_TO', DEFAULT_UPLOAD_TO, _build_upload_to),
+    'SHARD_DEPTH': ('CHUNKED_UPLOAD_SHARD_DEPTH', DEFAULT_SHARD_DEPTH, None),
+    'STORAGE': ('CHUNKED_UPLOAD_STORAGE', DEFAULT_STORAGE, _build_storage),
+    'ENCODER': ('CHUNKED_UPLOAD_ENCODER', DEFAULT_ENCODER, _build_encoder),
+    'CONTENT_TYPE': ('CHUNKED_UPLOAD_CONTENT_TYPE', DEFAULT_CONTENT_TYPE, None),
+    'MAX_BYTES': ('CHUNKED_UPLOAD_MAX_BYTES', DEFAULT_MAX_BYTES, None),
+    'DEDUP': ('CHUNKED_UPLOAD_DEDUP', DEFAULT_DEDUP, None),
+    'CHUNK_STORE_PATH': ('CHUNKED_UPLOAD_CHUNK_STORE_PATH', DEFAULT_CHUNK_STORE_PATH, None),
+    'MAX_DECOMPRESSION_RATIO': (
+        'CHUNKED_UPLOAD_MAX_DECOMPRESSION_RATIO', DEFAULT_MAX_DECOMPRESSION_RATIO, None
+    ),
+    'SENDFILE_HEADER': ('CHUNKED_UPLOAD_SENDFILE_HEADER', DEFAULT_SENDFILE_HEADER, None),
+    'SENDFILE_URL': ('CHUNKED_UPLOAD_SENDFILE_URL', DEFAULT_SENDFILE_URL, None),
+    'NODE_NAME': ('CHUNKED_UPLOAD_NODE_NAME', DEFAULT_NODE_NAME, None),
+    'NODE_URLS': ('CHUNKED_UPLOAD_NODE_URLS', DEFAULT_NODE_URLS, None),
+    'STAGING_ROOT': ('CHUNKED_UPLOAD_STAGING_ROOT', DEFAULT_STAGING_ROOT, None),
+    'CHUNK_SIZE': ('CHUNKED_UPLOAD_CHUNK_SIZE', DEFAULT_CHUNK_SIZE, None),
+    'MIN_CHUNK_SIZE': ('CHUNKED_UPLOAD_MIN_CHUNK_SIZE', DEFAULT_MIN_CHUNK_SIZE, None),
+    'MAX_CHUNK_SIZE': ('CHUNKED_UPLOAD_MAX_CHUNK_SIZE', DEFAULT_MAX_CHUNK_SIZE, None),
+    'CHUNK_DURATION': ('CHUNKED_UPLOAD_CHUNK_DURATION', DEFAULT_CHUNK_DURATION, None),
+    'HEADER_ONLY_ACK': ('CHUNKED_UPLOAD_HEADER_ONLY_ACK', DEFAULT_HEADER_ONLY_ACK, None),
+    'EXTRACT_ARCHIVES': ('CHUNKED_UPLOAD_EXTRACT_ARCHIVES', DEFAULT_EXTRACT_ARCHIVES, None),
+    'ARCHIVE_MAX_SIZE': ('CHUNKED_UPLOAD_ARCHIVE_MAX_SIZE', DEFAULT_ARCHIVE_MAX_SIZE, None),
+    'ARCHIVE_MAX_MEMBERS': (
+        'CHUNKED_UPLOAD_ARCHIVE_MAX_MEMBERS', DEFAULT_ARCHIVE_MAX_MEMBERS, None
+    ),
+    'ARCHIVE_WORKERS': ('CHUNKED_UPLOAD_ARCHIVE_WORKERS', DEFAULT_ARCHIVE_WORKERS, None),
+    'PIPELINED_VALIDATION': (
+        'CHUNKED_UPLOAD_PIPELINED_VALIDATION', DEFAULT_PIPELINED_VALIDATION, None
+    ),
+    'VALIDATION_WORKERS': ('CHUNKED_UPLOAD_VALIDATION_WORKERS', DEFAULT_VALIDATION_WORKERS, None),
+    'VALIDATION_MAX_PENDING': (
+        'CHUNKED_UPLOAD_VALIDATION_MAX_PENDING', DEFAULT_VALIDATION_MAX_PENDING, None
+    ),
+    'EVENT_BUS': ('CHUNKED_UPLOAD_EVENT_BUS', DEFAULT_EVENT_BUS, _build_event_bus),
+    'VERIFICATION_BLOCK_SIZE': (
+        'CHUNKED_UPLOAD_VERIFICATION_BLOCK_SIZE', DEFAULT_VERIFICATION_BLOCK_SIZE, None
+    ),
+    'VERIFICATION_WORKERS': (
+        'CHUNKED_UPLOAD_VERIFICATION_WORKERS', DEFAULT_VERIFICATION_WORKERS, None
+    ),
+    'PROFILING_SAMPLE_RATE': (
+        'CHUNKED_UPLOAD_PROFILING_SAMPLE_RATE', DEFAULT_PROFILING_SAMPLE_RATE, None
+    ),
+    'PROFILING_CPROFILE': ('CHUNKED_UPLOAD_PROFILING_CPROFILE', DEFAULT_PROFILING_CPROFILE, None),
+    'PROFILING_SINK': (
+        'CHUNKED_UPLOAD_PROFILING_SINK', DEFAULT_PROFILING_SINK, _build_profiling_sink
+    ),
+    # determine the "null" and "blank" properties of "user" field in the "ChunkedUpload" model
+    'DEFAULT_MODEL_USER_FIELD_NULL': ('CHUNKED_UPLOAD_MODEL_USER_FIELD_NULL', True, None),
+    'DEFAULT_MODEL_USER_FIELD_BLANK': ('CHUNKED_UPLOAD_MODEL_USER_FIELD_BLANK', True, None),
+}
+
+
+class ChunkedUploadSettings:
+    """
+    Lazy and cached access to the settings. A setting is read (and built)
+    on first access, then stored as an instance attribute so that the next
+    accesses do not go through `__getattr__`.
+    """
+
+    def __getattr__(self, name):
+        try:
+            setting_name, default, build = SETTINGS[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = getattr(settings, setting_name, default)
+        if build is not None:
+            value = build(value)
+        setattr(self, name, value)
+        return value
+
+    def reload(self):
+        self.__dict__.clear()
+
+
+upload_settings = ChunkedUploadSettings()
+
+
+class SettingAttribute:
+    """
+    Class attribute whose default value is a setting, resolved at access
+    time. The value can still be overridden in subclasses or with the
+    arguments of `as_view()`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        return getattr(upload_settings, self.name)
+
+
+def reload_settings(setting, **kwargs):
+    if setting.startswith('CHUNKED_UPLOAD_'):
+        upload_settings.reload()
+
+
+setting_changed.connect(reload_settings)
+
+
+def __getattr__(name):
+    # Backward compatible access to settings as module attributes
+    if name in SETTINGS:
+        return getattr(upload_settings, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,136 @@
+"""
+Pipelined validation of chunks: chunks are written and acknowledged, then
+validated by a bounded pool of threads (see
+`ChunkedUploadView.pipelined_validation`).
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+from django.db.models import F
+
+from .exceptions import ChunkedUploadError
+from .models import delete_extract_dir
+from .settings import upload_settings
+
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+
+
+class WrittenChunk:
+    """
+    Read-only access to a byte range of a written file, with the interface
+    of an uploaded chunk (`name`, `size`, `chunks()` and `read()`).
+    """
+
+    def __init__(self, path, start, size, name=''):
+        self.path = path
+        self.start = start
+        self.size = size
+        self.name = name
+
+    def chunks(self, chunk_size=None):
+        chunk_size = chunk_size or BLOCK_SIZE
+        remaining = self.size
+        with open(self.path, mode='rb') as file_obj:
+            file_obj.seek(self.start)
+            while remaining > 0:
+                data = file_obj.read(min(chunk_size, remaining))
+                if not data:
+                    raise EOFError(f'{self.path} is truncated')
+                remaining -= len(data)
+                yield data
+
+    def read(self):
+        return b''.join(self.chunks())
+
+
+def get_executor():
+    """
+    Returns the pool of validation threads and the semaphore bounding the
+    number of pending validations (created on first use).
+    """
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            workers = upload_settings.VALIDATION_WORKERS
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='chunked-upload-validation'
+            )
+            _slots = threading.BoundedSemaphore(upload_settings.VALIDATION_MAX_PENDING)
+    return _executor, _slots
+
+
+def validate_chunk(validate, model, pk, chunk):
+    """
+    Runs `validate(chunked_upload, chunk)` and records the result: the
+    validated bytes are added to `validated_bytes`, a failure is stored in
+    `validation_error` (the upload is then rejected and the files
+    extracted from it are deleted).
+    """
+    queryset = model.objects.filter(pk=pk)
+    try:
+        chunked_upload = queryset.get()
+        validate(chunked_upload, chunk)
+    except model.DoesNotExist:
+        # Jobs are submitted once the chunk is committed, so the upload has
+        # been deleted since (aborted or expired)
+        logger.warning('Upload %s not found, chunk validation skipped', pk)
+        return
+    except ChunkedUploadError as err:
+        error = str(err.data.get('detail', 'Chunk validation failed'))
+    except Exception:
+        logger.exception('Failed to validate chunk of upload %s', pk)
+        error = 'Chunk validation failed'
+    else:
+        queryset.update(validated_bytes=F('validated_bytes') + chunk.size)
+        return
+    queryset.filter(validation_error='').update(validation_error=error)
+    if chunked_upload.file:
+        delete_extract_dir(chunked_upload.file.storage, chunked_upload.file.name)
+
+
+def _run(slots, *args):
+    try:
+        validate_chunk(*args)
+    finally:
+        slots.release()
+        close_old_connections()
+
+
+def submit(validate, model, pk, chunk):
+    """
+    Validates the chunk in the pool of threads. If too many validations are
+    pending, the chunk is validated in the current thread (back pressure).
+    Returns `True` if the validation runs in the pool.
+    """
+    executor, slots = get_executor()
+    if not slots.acquire(blocking=False):
+        validate_chunk(validate, model, pk, chunk)
+        return False
+    try:
+        executor.submit(_run, slots, validate, model, pk, chunk)
+    except RuntimeError:
+        # Interpreter shutdown
+        slots.release()
+        validate_chunk(validate, model, pk, chunk)
+        return False
+    return True
+
+
+def get_written_chunk(chunked_upload, start, size, digest=None, store=None):
+    """
+    Returns the written chunk of an upload: the chunk of the chunk store
+    (deduplication) or the byte range of the upload file.
+    """
+    if digest:
+        return WrittenChunk(os.fspath(store.get_path(digest)), 0, size, name=digest)
+    return WrittenChunk(chunked_upload.get_path(), start, size, name=chunked_upload.filename)
@@ -0,0 +1,145 @@
+"""
+Verification of uploaded files: file type sniffing, sampled hash and
+parallel block hash. Files are memory-mapped and hashed by slices, so the
+bytes are not copied through Python loops, and blocks are hashed by a pool
+of threads (hashlib releases the GIL).
+"""
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+SNIFF_SIZE = 512
+
+# (offset, magic bytes, content type), checked in order
+SIGNATURES = (
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'PK\x05\x06', 'application/zip'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'(\xb5/\xfd', 'application/zstd'),
+    (0, b"7z\xbc\xaf'\x1c", 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (257, b'ustar', 'application/x-tar'),
+    (0, b'\x1aE\xdf\xa3', 'video/x-matroska'),
+    (0, b'OggS', 'application/ogg'),
+    (0, b'fLaC', 'audio/flac'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'\x00\x00\x01\xba', 'video/mpeg'),
+)
+
+# Types of ISO base media files ("ftyp" box), by major brand prefix
+FTYP_TYPES = (
+    (b'qt', 'video/quicktime'),
+    (b'M4A', 'audio/mp4'),
+    (b'heic', 'image/heic'),
+    (b'avif', 'image/avif'),
+)
+
+# Types of RIFF files, by format
+RIFF_TYPES = {
+    b'WAVE': 'audio/wav',
+    b'AVI ': 'video/x-msvideo',
+    b'WEBP': 'image/webp',
+}
+
+
+def sniff_type(data):
+    """
+    Returns the content type of a file from its first bytes (at least
+    `SNIFF_SIZE` bytes if available), or `None` if it is not recognized.
+    """
+    data = bytes(data[:SNIFF_SIZE])
+    if data[4:8] == b'ftyp':
+        brand = data[8:12]
+        for prefix, content_type in FTYP_TYPES:
+            if brand.startswith(prefix):
+                return content_type
+        return 'video/mp4'
+    if data[:4] == b'RIFF':
+        return RIFF_TYPES.get(data[8:12])
+    for offset, magic, content_type in SIGNATURES:
+        if data[offset:offset + len(magic)] == magic:
+            return content_type
+    if data[0:1] == data[188:189] == data[376:377] == b'\x47':
+        # MPEG-TS: sync byte every 188 bytes
+        return 'video/mp2t'
+    return None
+
+
+@contextmanager
+def open_view(path):
+    """
+    Context manager returning a read-only memoryview of the file content
+    (memory-mapped).
+    """
+    with open(path, mode='rb') as file_obj:
+        if os.fstat(file_obj.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            yield memoryview(b'')
+            return
+        with mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                yield view
+
+
+def get_sample_ranges(size, samples, sample_size):
+    """
+    Returns the (start, end) ranges of `samples` samples evenly spread over
+    a file of `size` bytes, including the first and last bytes. The whole
+    file is one range if the samples would cover it.
+    """
+    if samples < 2 or size <= samples * sample_size:
+        return [(0, size)]
+    step = (size - sample_size) / (samples - 1)
+    starts = [round(index * step) for index in range(samples)]
+    return [(start, start + sample_size) for start in starts]
+
+
+def sampled_hash(path, samples=16, sample_size=64 * 1024, algorithm='sha256'):
+    """
+    Hash of the size of the file and of samples of its content: a cheap
+    fingerprint of huge files, which does not detect all the changes.
+    """
+    hasher = hashlib.new(algorithm)
+    with open_view(path) as view:
+        hasher.update(len(view).to_bytes(8, 'big'))
+        for start, end in get_sample_ranges(len(view), samples, sample_size):
+            with view[start:end] as sample:
+                hasher.update(sample)
+    return hasher.hexdigest()
+
+
+def hash_blocks(path, block_size=8 * 1024 * 1024, algorithm='sha256', workers=None):
+    """
+    Returns the digests (bytes) of the blocks of `block_size` bytes of the
+    file, hashed in parallel by `workers` threads (number of CPUs by default).
+    """
+    def hash_block(start):
+        with view[start:start + block_size] as block:
+            return hashlib.new(algorithm, block).digest()
+
+    with open_view(path) as view:
+        starts = range(0, len(view), block_size)
+        if len(starts) <= 1:
+            return [hash_block(start) for start in starts]
+        workers = workers or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=min(workers, len(starts))) as executor:
+            return list(executor.map(hash_block, starts))
+
+
+def tree_hash(path, block_size=8 * 1024 * 1024, algorithm='sha256', workers=None):
+    """
+    Hash of the concatenated digests of the blocks of the file (see
+    `hash_blocks`). Depends on the block size, unlike a plain hash.
+    """
+    digests = hash_blocks(path, block_size=block_size, algorithm=algorithm, workers=workers)
+    return hashlib.new(algorithm, b''.join(digests)).hexdigest()
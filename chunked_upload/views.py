@@ -1,18 +1,38 @@
 import errno
+import functools
+import json
+import logging
+import mimetypes
+import random
 import re
+import time
+import uuid
+from pathlib import Path
+from urllib.parse import quote
 
+from django.db import transaction
 from django.views.generic import View
 from django.shortcuts import get_object_or_404
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.http import content_disposition_header
 
-from .settings import MAX_BYTES
-from .models import ChunkedUpload
+from . import events, validation
+from .archive import ArchiveExtractor, is_archive, is_plain_tar
+from .settings import SettingAttribute, upload_settings
+from .models import ChunkedUpload, delete_extract_dir
+from .profiling import RequestProfile
 from .response import Response
-from .constants import http_status, COMPLETE
+from .constants import http_status, COMPLETE, UPLOADING
+from .dedup import get_chunk_store, is_valid_digest
+from .encoding import DecodedChunk, get_supported_encodings
 from .exceptions import ChunkedUploadError
 
 
+logger = logging.getLogger(__name__)
+
+
 class ChunkedUploadBaseView(View):
     """
     Base view for the rest of chunked upload views.
@@ -22,6 +42,21 @@ class ChunkedUploadBaseView(View):
     model = ChunkedUpload
     # The field name that point towards the AUTH_USER in ChunkedUpload class or its subclasses
     user_field_name = 'user'
+    # Header containing the node owning the upload (routing hint for load
+    # balancers, see CHUNKED_UPLOAD_NODE_NAME)
+    node_header = 'X-Upload-Node'
+    # If `extract_archives` is True, uploaded archives are extracted to the
+    # storage (see `get_archive_extractor`)
+    extract_archives = SettingAttribute('EXTRACT_ARCHIVES')
+    # Profiling of the requests (see `get_profile`): methods whose duration
+    # is measured, header with which staff users request a profile ("1", or
+    # "cprofile" to get a cProfile report too)
+    profiling_sample_rate = SettingAttribute('PROFILING_SAMPLE_RATE')
+    profiled_methods = (
+        'check_permissions', 'get_queryset', 'validate', 'validate_chunk_data',
+        'write_chunk', '_save',
+    )
+    profile_header = 'X-Upload-Profile'
 
     def get_queryset(self, request):
         """
@@ -37,6 +72,20 @@ class ChunkedUploadBaseView(View):
             queryset = queryset.filter(**{self.user_field_name: request.user})
         return queryset
 
+    def get_extra_attrs(self, request):
+        """
+        Extra attribute values to be passed to the new ChunkedUpload instance.
+        Should return a dictionary-like object.
+        """
+        attrs = {}
+        if (
+            hasattr(self.model, self.user_field_name)
+            and hasattr(request, 'user')
+            and request.user.is_authenticated
+        ):
+            attrs[self.user_field_name] = request.user
+        return attrs
+
     def validate(self, request):
         """
         Placeholder method to define extra validation.
@@ -78,6 +127,76 @@ class ChunkedUploadBaseView(View):
         self.save(chunked_upload, self.request, new=new)
         self.post_save(chunked_upload, self.request, new=new)
 
+    def check_node(self, chunked_upload, request):
+        """
+        The file of a staged upload is only available on the node owning it.
+        Requests received by another node are redirected to the owning node
+        (if its URL is in CHUNKED_UPLOAD_NODE_URLS) or rejected.
+        Returns a redirection response or `None`.
+        """
+        node = chunked_upload.node
+        if not chunked_upload.staged or not node or node == upload_settings.NODE_NAME:
+            return None
+        url = upload_settings.NODE_URLS.get(node)
+        if not url:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_409_CONFLICT,
+                detail='Upload is handled by another node',
+                node=node
+            )
+        response = HttpResponse(status=http_status.HTTP_307_TEMPORARY_REDIRECT)
+        response['Location'] = url.rstrip('/') + request.get_full_path()
+        response[self.node_header] = node
+        return response
+
+    def get_archive_extractor(self, chunked_upload):
+        """
+        Returns the extractor of the uploaded archive. The files are
+        extracted in the directory `chunked_upload.get_extract_dir()`.
+        """
+        return ArchiveExtractor(
+            chunked_upload.file.storage,
+            chunked_upload.get_extract_dir(),
+            max_size=upload_settings.ARCHIVE_MAX_SIZE,
+            max_members=upload_settings.ARCHIVE_MAX_MEMBERS,
+            workers=upload_settings.ARCHIVE_WORKERS,
+        )
+
+    def reject(self, chunked_upload, error):
+        """
+        Rejects the upload after a failed extraction: further chunks and the
+        completion are refused and the extracted files are deleted.
+        """
+        chunked_upload.validation_error = str(error.data.get('detail', 'Upload rejected'))
+        chunked_upload.save(update_fields=['validation_error'])
+        delete_extract_dir(chunked_upload.file.storage, chunked_upload.file.name)
+
+    def publish_event(self, event_type, chunked_upload, **data):
+        """
+        Publishes an event of the upload to the event bus (see
+        `chunked_upload.events`).
+        """
+        bus = events.get_event_bus()
+        if bus is not None:
+            bus.publish(events.get_event(
+                event_type, chunked_upload, user_field_name=self.user_field_name, **data
+            ))
+
+    def get_chunk_store(self, chunked_upload=None, request=None):
+        """
+        Returns the chunk store of the owner of the upload (or of the user of
+        the request). Chunks are only shared between the uploads of a user,
+        so that other users cannot reference (and read) a chunk whose digest
+        they know.
+        """
+        if chunked_upload is not None:
+            user_id = getattr(chunked_upload, self.user_field_name + '_id', None)
+        else:
+            user_id = getattr(getattr(request, 'user', None), 'pk', None)
+        return get_chunk_store(
+            namespace='anonymous' if user_id is None else f'user-{user_id}'
+        )
+
     def check_permissions(self, request):
         """
         Grants permission to start/continue an upload based on the request.
@@ -88,19 +207,56 @@ class ChunkedUploadBaseView(View):
                 detail='Authentication credentials were not provided'
             )
 
-    def _post(self, request, *args, **kwargs):
-        raise NotImplementedError
+    def get_profile(self, request):
+        """
+        Returns a `RequestProfile` if the request has to be profiled: if it
+        is sampled or if a staff user sent the profiling header.
+        Returns `None` otherwise.
+        """
+        requested = request.headers.get(self.profile_header)
+        if requested and getattr(getattr(request, 'user', None), 'is_staff', False):
+            use_cprofile = requested.lower() == 'cprofile' or upload_settings.PROFILING_CPROFILE
+            return RequestProfile(use_cprofile=use_cprofile)
+        rate = self.profiling_sample_rate
+        if rate and random.random() < rate:
+            return RequestProfile(use_cprofile=upload_settings.PROFILING_CPROFILE)
+        return None
 
-    def post(self, request, *args, **kwargs):
+    def send_profile(self, profile, request, response):
         """
-        Handle POST requests.
+        Sends the profile of the request to the sink (errors are not
+        propagated to the client).
         """
+        try:
+            upload_settings.PROFILING_SINK(profile.get_record(self, request, response))
+        except Exception:
+            logger.exception('Failed to send the profile of an upload request')
+
+    def _post(self, request, *args, **kwargs):
+        raise NotImplementedError
+
+    def handle_post(self, request, *args, **kwargs):
         try:
             self.check_permissions(request)
             return self._post(request, *args, **kwargs)
         except ChunkedUploadError as error:
             return Response(error.data, status=error.status_code)
 
+    def post(self, request, *args, **kwargs):
+        """
+        Handle POST requests.
+        """
+        profile = self.get_profile(request)
+        if profile is None:
+            return self.handle_post(request, *args, **kwargs)
+        response = None
+        try:
+            with profile.enable(self, self.profiled_methods):
+                response = self.handle_post(request, *args, **kwargs)
+        finally:
+            self.send_profile(profile, request, response)
+        return response
+
 
 class ChunkedUploadView(ChunkedUploadBaseView):
     """
@@ -113,25 +269,41 @@ class ChunkedUploadView(ChunkedUploadBaseView):
     content_range_pattern = re.compile(
         r'^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+)$'
     )
-    max_bytes = MAX_BYTES  # Max amount of data that can be uploaded
+    max_bytes = SettingAttribute('MAX_BYTES')  # Max amount of data that can be uploaded
+    # Chunk size recommended to clients, adapted to the observed throughput
+    # of the upload (see `get_chunk_size`), and max size of chunks
+    chunk_size = SettingAttribute('CHUNK_SIZE')
+    min_chunk_size = SettingAttribute('MIN_CHUNK_SIZE')
+    max_chunk_size = SettingAttribute('MAX_CHUNK_SIZE')
+    chunk_duration = SettingAttribute('CHUNK_DURATION')
+    # Chunks sent with a "Content-Encoding" header (gzip, deflate or zstd) are
+    # decompressed while being written. Offsets refer to decompressed bytes.
+    content_encoding_header = 'HTTP_CONTENT_ENCODING'
+    max_decompression_ratio = SettingAttribute('MAX_DECOMPRESSION_RATIO')
+    # If `dedup` is True, chunks are stored in the content-addressed chunk
+    # store. Clients can check which chunks are known with the `hashes_field`
+    # (comma separated SHA-256 digests) and send a known chunk by reference
+    # with the `chunk_hash_field` instead of the chunk file.
+    dedup = SettingAttribute('DEDUP')
+    hashes_field = 'hashes'
+    chunk_hash_field = 'chunk_hash'
+    # If `header_only_ack` is True (or if the request has the header
+    # "Prefer: return=minimal"), chunks are acknowledged with an empty 204
+    # response, the upload state being in the "Upload-*" headers
+    header_only_ack = SettingAttribute('HEADER_ONLY_ACK')
+    prefer_header = 'HTTP_PREFER'
+    # If `pipelined_validation` is True, `validate_chunk_data` is called by a
+    # pool of threads once the chunk is written and acknowledged. A failed
+    # validation rejects the upload (further chunks and completion fail)
+    pipelined_validation = SettingAttribute('PIPELINED_VALIDATION')
     # If `fail_if_no_header` is True, an exception will be raised if the
     # content-range header is not found. Default is False to match Jquery File
     # Upload behavior (doesn't send header if the file is smaller than chunk)
     fail_if_no_header = False
-
-    def get_extra_attrs(self, request):
-        """
-        Extra attribute values to be passed to the new ChunkedUpload instance.
-        Should return a dictionary-like object.
-        """
-        attrs = {}
-        if (
-            hasattr(self.model, self.user_field_name)
-            and hasattr(request, 'user')
-            and request.user.is_authenticated
-        ):
-            attrs[self.user_field_name] = request.user
-        return attrs
+    # Allowance for the multipart encoding (boundaries, headers of the parts
+    # and other fields) when the "Content-Length" header is checked against
+    # the max chunk size, before the body is read
+    multipart_overhead = 64 * 1024
 
     def get_max_bytes(self, request):
         """
@@ -143,14 +315,139 @@ class ChunkedUploadView(ChunkedUploadBaseView):
 
         return self.max_bytes
 
+    def get_max_chunk_size(self, request):
+        """
+        Used to limit the size of chunks. `None` means no limit.
+        You can override this to have a custom `max_chunk_size`, e.g. based
+        on logged user.
+        """
+        return self.max_chunk_size
+
+    def check_content_length(self, request):
+        """
+        Rejects the request if its body is bigger than the max chunk size,
+        before the chunk is read (the chunk size is checked again with the
+        "Content-Range" header).
+        """
+        max_chunk_size = self.get_max_chunk_size(request)
+        if max_chunk_size is None:
+            return
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        if content_length > max_chunk_size + self.multipart_overhead:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='Size of chunk exceeds the limit (%s bytes)' % max_chunk_size,
+                max_chunk_size=max_chunk_size
+            )
+
+    def get_transfer_duration(self, request):
+        """
+        Duration of the transfer of the chunk, used to measure the throughput
+        of the upload. The body of the request may have been read before the
+        view is called (by a middleware), so the start of the request is
+        recorded by `RequestStartMiddleware`. Returns `None` if the start of
+        the request is unknown, in which case the throughput is not measured.
+        """
+        started = getattr(request, 'upload_started', None)
+        if started is None:
+            return None
+        return time.monotonic() - started
+
+    def get_chunk_size(self, chunked_upload, request):
+        """
+        Chunk size recommended to the client: large enough for the overhead
+        of requests to be negligible, small enough for retries to be cheap.
+        Once the throughput of the upload is known, the recommended chunk
+        takes about `chunk_duration` seconds to send.
+        """
+        max_chunk_size = self.get_max_chunk_size(request)
+        if chunked_upload.throughput is None:
+            size = self.chunk_size
+        else:
+            size = int(chunked_upload.throughput * self.chunk_duration)
+            # Multiple of the min size, to avoid odd sizes
+            size -= size % self.min_chunk_size
+            size = min(max(size, self.min_chunk_size), 64 * self.chunk_size)
+        if max_chunk_size is not None:
+            size = min(size, max_chunk_size)
+        return size
+
+    def get_content_encoding(self, request):
+        """
+        Returns the encoding of the chunk content or `None` if the content is
+        not compressed.
+        """
+        encoding = request.META.get(self.content_encoding_header, '').strip().lower()
+        if encoding in ('', 'identity'):
+            return None
+        if encoding not in get_supported_encodings():
+            raise ChunkedUploadError(
+                status=http_status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail='Unsupported content encoding "%s"' % encoding
+            )
+        return encoding
+
+    def check_hashes(self, request):
+        """
+        Responds with the digests of chunks which are already in the chunk
+        store, so that the client only sends the unknown chunks.
+        """
+        digests = request.POST.get(self.hashes_field, '').lower().split(',')
+        store = self.get_chunk_store(request=request)
+        known = store.filter_known([digest.strip() for digest in digests])
+        return Response({'known': known}, status=http_status.HTTP_200_OK)
+
+    def get_stored_chunk(self, request, digest):
+        """
+        Returns the chunk of the chunk store sent by reference.
+        """
+        store = self.get_chunk_store(request=request)
+        if not is_valid_digest(digest) or not store.has(digest):
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='Unknown chunk hash'
+            )
+        return File(store.open(digest), name=request.POST.get('filename') or digest)
+
+    def write_chunk(self, chunked_upload, chunk, digest=None):
+        """
+        Write the chunk data. With deduplication, the chunk is added to the
+        chunk store (unless it was sent by reference with its `digest`) and
+        only referenced by the upload.
+        Returns the digest of the chunk if it is in the chunk store.
+        """
+        if digest:
+            self.get_chunk_store(chunked_upload).touch(digest)
+            chunked_upload.append_stored_chunk(
+                digest, chunk.size, save=False, start=chunked_upload.offset
+            )
+        elif self.dedup:
+            digest, size = self.get_chunk_store(chunked_upload).add(chunk)
+            chunked_upload.append_stored_chunk(
+                digest, size, save=False, start=chunked_upload.offset
+            )
+        else:
+            chunked_upload.append_chunk(chunk, save=False, start=chunked_upload.offset)
+        return digest
+
     def create_chunked_upload(self, save=False, **attrs):
         """
         Creates new chunked upload instance. Called if no 'upload_id' is
         found in the POST data.
         """
         chunked_upload = self.model(**attrs)
-        # file starts empty
-        chunked_upload.file.save(name='', content=ContentFile(''), save=save)
+        chunked_upload.node = upload_settings.NODE_NAME or ''
+        if upload_settings.STAGING_ROOT:
+            # file starts empty, in the local staging directory
+            chunked_upload.stage()
+            if save:
+                chunked_upload.save()
+        else:
+            # file starts empty
+            chunked_upload.file.save(name='', content=ContentFile(''), save=save)
         return chunked_upload
 
     def is_valid_chunked_upload(self, chunked_upload):
@@ -167,13 +464,64 @@ class ChunkedUploadView(ChunkedUploadBaseView):
                 status=http_status.HTTP_400_BAD_REQUEST,
                 detail='Upload has already been marked as "complete"'
             )
+        if chunked_upload.rejected:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='Upload has been rejected',
+                reason=chunked_upload.validation_error
+            )
 
     def validate_chunk_data(self, chunked_upload, chunk):
         """
         Check if the chunk data are correct
         (for example, with an antivirus check).
+        Must raise ChunkedUploadError if validation fails. With pipelined
+        validation, this method is called in another thread, with the chunk
+        read from the written file.
         """
 
+    def extract_received_members(self, chunked_upload):
+        """
+        Extracts the members of a plain tar archive which are fully received,
+        so that the extraction is mostly done when the upload is completed.
+        With pipelined validation, only the validated bytes are extracted.
+        """
+        available = chunked_upload.offset
+        if self.pipelined_validation:
+            chunked_upload.refresh_from_db(fields=['validated_bytes', 'validation_error'])
+            if chunked_upload.rejected:
+                return
+            available = min(available, chunked_upload.validated_bytes)
+        extractor = self.get_archive_extractor(chunked_upload)
+        try:
+            position = extractor.extract_tar(
+                chunked_upload.get_path(),
+                start=chunked_upload.extracted_offset,
+                available=available,
+            )
+        except ChunkedUploadError as err:
+            self.reject(chunked_upload, err)
+            raise
+        chunked_upload.extracted_offset = chunked_upload.offset if position is None else position
+        chunked_upload.save(update_fields=['extracted_offset'])
+
+    def submit_chunk_validation(self, chunked_upload, start, digest=None):
+        """
+        Submits the validation of the written chunk to the validation pool
+        (pipelined validation).
+        """
+        chunk = validation.get_written_chunk(
+            chunked_upload,
+            start,
+            chunked_upload.offset - start,
+            digest=digest,
+            store=self.get_chunk_store(chunked_upload) if digest else None,
+        )
+        # The validation threads must see the upload (ATOMIC_REQUESTS)
+        transaction.on_commit(functools.partial(
+            validation.submit, self.validate_chunk_data, self.model, chunked_upload.pk, chunk
+        ))
+
     def get_response_data(self, chunked_upload, request):
         """
         Data for the response. Should return a dictionary-like object.
@@ -181,31 +529,83 @@ class ChunkedUploadView(ChunkedUploadBaseView):
         return {
             'upload_id': chunked_upload.upload_id,
             'offset': chunked_upload.offset,
-            'expires': chunked_upload.expires_on
+            'expires': chunked_upload.expires_on_iso,
+            'chunk_size': self.get_chunk_size(chunked_upload, request),
+            'max_chunk_size': self.get_max_chunk_size(request),
         }
 
+    def wants_header_only_ack(self, request):
+        if self.header_only_ack:
+            return True
+        prefer = request.META.get(self.prefer_header, '')
+        return 'return=minimal' in prefer.replace(' ', '').lower().split(',')
+
+    def get_header_only_response(self, chunked_upload, request):
+        """
+        Acknowledgement without body, the upload state is sent in headers.
+        """
+        response = HttpResponse(status=http_status.HTTP_204_NO_CONTENT)
+        response['Upload-Id'] = chunked_upload.upload_id
+        response['Upload-Offset'] = str(chunked_upload.offset)
+        response['Upload-Expires'] = chunked_upload.expires_on_iso
+        response['Upload-Chunk-Size'] = str(self.get_chunk_size(chunked_upload, request))
+        max_chunk_size = self.get_max_chunk_size(request)
+        if max_chunk_size is not None:
+            response['Upload-Max-Chunk-Size'] = str(max_chunk_size)
+        return response
+
     def _post(self, request, *args, **kwargs):
+        self.check_content_length(request)
         self.validate(request)
 
         chunk = request.FILES.get(self.field_name)
+        stored_digest = None
+        if chunk is None and self.dedup:
+            if self.hashes_field in request.POST:
+                return self.check_hashes(request)
+            stored_digest = request.POST.get(self.chunk_hash_field, '').lower()
+            if stored_digest:
+                chunk = self.get_stored_chunk(request, stored_digest)
         if chunk is None:
             raise ChunkedUploadError(
                 status=http_status.HTTP_400_BAD_REQUEST,
                 detail='No chunk file was submitted'
             )
 
+        content_encoding = None if stored_digest else self.get_content_encoding(request)
+
         upload_id = request.POST.get('upload_id')
         if upload_id:
             chunked_upload = get_object_or_404(
                 self.get_queryset(request),
                 upload_id=upload_id,
             )
+            redirect = self.check_node(chunked_upload, request)
+            if redirect is not None:
+                return redirect
             self.is_valid_chunked_upload(chunked_upload)
+            if not chunked_upload.filename:
+                # Reserved upload (see ChunkedUploadReserveView)
+                chunked_upload.filename = chunk.name
         else:
             attrs = {'filename': chunk.name}
             attrs.update(self.get_extra_attrs(request))
             chunked_upload = self.create_chunked_upload(save=False, **attrs)
 
+        try:
+            return self._post_chunk(
+                request, chunked_upload, chunk, content_encoding, stored_digest
+            )
+        except ChunkedUploadError:
+            # Do not leave the empty file of a new upload
+            if not chunked_upload.id and chunked_upload.file is not None:
+                chunked_upload.delete_file()
+            raise
+        finally:
+            if stored_digest:
+                chunk.close()
+
+    def _post_chunk(self, request, chunked_upload, chunk, content_encoding, stored_digest):
         content_range = request.META.get(self.content_range_header, '')
         match = self.content_range_pattern.match(content_range)
         if match:
@@ -222,60 +622,80 @@ class ChunkedUploadView(ChunkedUploadBaseView):
                 status=http_status.HTTP_400_BAD_REQUEST,
                 detail='Error in request headers'
             )
+        elif content_encoding:
+            # The size is only known once the chunk is decompressed
+            start = 0
+            end = total = None
         else:
             # Use the whole size when HTTP_CONTENT_RANGE is not provided
             start = 0
             end = chunk.size - 1
             total = chunk.size
 
-        if end > total:
+        if end is not None and end > total:
             raise ChunkedUploadError(
                 status=http_status.HTTP_400_BAD_REQUEST,
                 detail='End offset must be lower than total size'
             )
 
-        chunk_size = end - start + 1
+        chunk_size = end - start + 1 if end is not None else None
         max_bytes = self.get_max_bytes(request)
+        max_chunk_size = self.get_max_chunk_size(request)
 
-        if max_bytes is not None and total > max_bytes:
+        if max_bytes is not None and total is not None and total > max_bytes:
             raise ChunkedUploadError(
                 status=http_status.HTTP_400_BAD_REQUEST,
                 detail='Size of file exceeds the limit (%s bytes)' % max_bytes
             )
+        if max_chunk_size is not None and (chunk_size or chunk.size) > max_chunk_size:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='Size of chunk exceeds the limit (%s bytes)' % max_chunk_size,
+                max_chunk_size=max_chunk_size
+            )
         if chunked_upload.offset != start:
             raise ChunkedUploadError(
                 status=http_status.HTTP_400_BAD_REQUEST,
                 detail='Offsets do not match',
                 offset=chunked_upload.offset
             )
-        if chunk.size != chunk_size:
+        if content_encoding:
+            max_sizes = [size for size in (
+                max_bytes - start if max_bytes is not None else None,
+                max_chunk_size,
+            ) if size is not None]
+            chunk = DecodedChunk(
+                chunk,
+                content_encoding,
+                size=chunk_size,
+                max_size=min(max_sizes) if max_sizes else None,
+                max_ratio=self.max_decompression_ratio,
+            )
+        elif chunk.size != chunk_size:
             raise ChunkedUploadError(
                 status=http_status.HTTP_400_BAD_REQUEST,
                 detail="File size doesn't match headers"
             )
 
-        try:
+        if not self.pipelined_validation:
             self.validate_chunk_data(chunked_upload, chunk)
-        except ChunkedUploadError as err:
-            if not chunked_upload.id and chunked_upload.file is not None:
-                chunked_upload.file.delete(save=False)
-            raise err
 
-        file_size = chunked_upload.get_size()
-        if file_size != start:
-            if not chunked_upload.id and chunked_upload.file is not None:
-                chunked_upload.file.delete(save=False)
+        try:
+            file_size = chunked_upload.get_size()
+            if file_size != start:
+                raise ChunkedUploadError(
+                    status=http_status.HTTP_400_BAD_REQUEST,
+                    detail='File has been written by another request',
+                    size=file_size
+                )
+            digest = self.write_chunk(chunked_upload, chunk, digest=stored_digest)
+        except FileNotFoundError:
+            # The file was deleted by a concurrent abort request
             raise ChunkedUploadError(
-                status=http_status.HTTP_400_BAD_REQUEST,
-                detail='File has been written by another request',
-                size=file_size
+                status=http_status.HTTP_410_GONE,
+                detail='Upload has been aborted'
             )
-
-        try:
-            chunked_upload.append_chunk(chunk, save=False)
         except OSError as err:
-            if not chunked_upload.id and chunked_upload.file is not None:
-                chunked_upload.file.delete(save=False)
             if err.errno == errno.ENOSPC:
                 raise ChunkedUploadError(
                     status=http_status.HTTP_400_BAD_REQUEST,
@@ -286,12 +706,35 @@ class ChunkedUploadView(ChunkedUploadBaseView):
                 detail=f'Failed to write file (errno {err.errno})'
             )
 
+        duration = self.get_transfer_duration(request)
+        if not stored_digest and duration is not None:
+            chunked_upload.record_throughput(chunked_upload.offset - start, duration)
+        new = chunked_upload.id is None
         self._save(chunked_upload)
+        if new:
+            self.publish_event('created', chunked_upload, filename=chunked_upload.filename)
+        self.publish_event('chunk', chunked_upload)
 
-        return Response(
-            self.get_response_data(chunked_upload, request),
-            status=http_status.HTTP_200_OK
-        )
+        if self.pipelined_validation:
+            self.submit_chunk_validation(chunked_upload, start, digest=digest)
+
+        if (
+            self.extract_archives
+            and not digest
+            and is_plain_tar(chunked_upload.filename)
+        ):
+            self.extract_received_members(chunked_upload)
+
+        if self.wants_header_only_ack(request):
+            response = self.get_header_only_response(chunked_upload, request)
+        else:
+            response = Response(
+                self.get_response_data(chunked_upload, request),
+                status=http_status.HTTP_200_OK
+            )
+        if chunked_upload.node:
+            response[self.node_header] = chunked_upload.node
+        return response
 
 
 class ChunkedUploadCompleteView(ChunkedUploadBaseView):
@@ -300,11 +743,46 @@ class ChunkedUploadCompleteView(ChunkedUploadBaseView):
     define what to do when upload is complete.
     """
 
+    # See `ChunkedUploadView.pipelined_validation`. Completion is refused
+    # until all the chunks have been validated
+    pipelined_validation = SettingAttribute('PIPELINED_VALIDATION')
+
     def on_completion(self, chunked_upload, request):
         """
         Placeholder method to define what to do when upload is complete.
         """
 
+    def extract_archive(self, chunked_upload):
+        """
+        Extracts the uploaded archive (the extraction of a plain tar archive
+        is resumed where it stopped while receiving the chunks).
+        """
+        start = chunked_upload.extracted_offset if is_plain_tar(chunked_upload.filename) else 0
+        extractor = self.get_archive_extractor(chunked_upload)
+        try:
+            extractor.extract(chunked_upload.get_path(), chunked_upload.filename, start=start)
+        except ChunkedUploadError as err:
+            self.reject(chunked_upload, err)
+            raise
+        chunked_upload.extracted_offset = chunked_upload.offset
+
+    def check_validation(self, chunked_upload):
+        """
+        Check that the chunks have been validated (pipelined validation).
+        """
+        if chunked_upload.rejected:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='Upload has been rejected',
+                reason=chunked_upload.validation_error
+            )
+        if self.pipelined_validation and chunked_upload.validated_bytes < chunked_upload.offset:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_409_CONFLICT,
+                detail='Validation of chunks is in progress, retry later',
+                validated=chunked_upload.validated_bytes
+            )
+
     def is_valid_chunked_upload(self, chunked_upload):
         """
         Check if chunked upload is already complete.
@@ -339,7 +817,22 @@ class ChunkedUploadCompleteView(ChunkedUploadBaseView):
             upload_id=upload_id
         )
 
+        redirect = self.check_node(chunked_upload, request)
+        if redirect is not None:
+            return redirect
+
         self.is_valid_chunked_upload(chunked_upload)
+        self.check_validation(chunked_upload)
+
+        if chunked_upload.has_manifest():
+            # Deduplicated upload, the file is assembled from the chunk store
+            try:
+                chunked_upload.assemble(self.get_chunk_store(chunked_upload))
+            except OSError as err:
+                raise ChunkedUploadError(
+                    status=http_status.HTTP_400_BAD_REQUEST,
+                    detail=f'Failed to assemble file (errno {err.errno})'
+                )
 
         expected_size = request.POST.get('expected_size')
         if expected_size:
@@ -358,12 +851,495 @@ class ChunkedUploadCompleteView(ChunkedUploadBaseView):
                     size=file_size
                 )
 
+        if self.extract_archives and is_archive(chunked_upload.filename):
+            self.extract_archive(chunked_upload)
+
+        try:
+            # Move the file from the node-local staging to the storage
+            chunked_upload.consolidate(save=False)
+        except OSError as err:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail=f'Failed to move file to storage (errno {err.errno})'
+            )
+
         chunked_upload.status = COMPLETE
         chunked_upload.completed_on = timezone.now()
         self._save(chunked_upload)
         self.on_completion(chunked_upload, request)
+        self.publish_event('completed', chunked_upload)
 
         return Response(
             self.get_response_data(chunked_upload, request),
             status=http_status.HTTP_200_OK
         )
+
+
+class ChunkedUploadReserveView(ChunkedUploadBaseView):
+    """
+    Creates several empty uploads at once (`count` field), with a single
+    insert query. Their chunks are then sent to `ChunkedUploadView` with
+    their `upload_id`, without the cost of the creation of the upload on
+    the first chunk. Reserved uploads which are not used expire as usual.
+    """
+
+    count_field = 'count'
+    # Max number of uploads reserved in a request
+    max_count = 100
+
+    def get_count(self, request):
+        """
+        Returns the number of uploads to reserve.
+        """
+        try:
+            count = int(request.POST.get(self.count_field, 1))
+        except ValueError:
+            count = 0
+        if not 1 <= count <= self.max_count:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='Invalid number of uploads (between 1 and %s)' % self.max_count
+            )
+        return count
+
+    def reserve(self, count, request):
+        """
+        Creates the empty files of the uploads, then the uploads with
+        `bulk_create` (so `pre_save`, `save` and `post_save` are not called).
+        Returns the created uploads.
+        """
+        attrs = self.get_extra_attrs(request)
+        chunked_uploads = []
+        try:
+            for _index in range(count):
+                chunked_upload = self.model(**attrs)
+                chunked_upload.node = upload_settings.NODE_NAME or ''
+                chunked_upload.create_file()
+                chunked_uploads.append(chunked_upload)
+            return self.model.objects.bulk_create(chunked_uploads)
+        except Exception as err:
+            for chunked_upload in chunked_uploads:
+                chunked_upload.delete_file()
+            if isinstance(err, OSError):
+                raise ChunkedUploadError(
+                    status=http_status.HTTP_400_BAD_REQUEST,
+                    detail=f'Failed to create file (errno {err.errno})'
+                )
+            raise
+
+    def get_response_data(self, chunked_uploads, request):
+        """
+        Data for the response. Should return a dictionary-like object.
+        """
+        return {
+            'uploads': [
+                {
+                    'upload_id': chunked_upload.upload_id,
+                    'expires': chunked_upload.expires_on_iso,
+                }
+                for chunked_upload in chunked_uploads
+            ]
+        }
+
+    def _post(self, request, *args, **kwargs):
+        self.validate(request)
+
+        chunked_uploads = self.reserve(self.get_count(request), request)
+        for chunked_upload in chunked_uploads:
+            self.publish_event('created', chunked_upload, filename='')
+
+        return Response(
+            self.get_response_data(chunked_uploads, request),
+            status=http_status.HTTP_200_OK
+        )
+
+
+class ChunkedUploadAbortView(ChunkedUploadBaseView):
+    """
+    Aborts uploads in progress: one or several uploads (`upload_id` field,
+    repeated or with comma separated ids), or all the uploads in progress of
+    the user (`all` field). Uploads and their files are deleted immediately,
+    or only expired if `deferred_deletion` is True (they are then deleted by
+    the cleaning commands).
+    """
+
+    all_field = 'all'
+    # Max number of upload ids in a request
+    max_upload_ids = 1000
+    deferred_deletion = False
+
+    def get_abort_queryset(self, request):
+        """
+        Returns the queryset of the uploads to abort.
+        """
+        queryset = self.get_queryset(request).filter(status=UPLOADING)
+        if request.POST.get(self.all_field, '').lower() in ('1', 'true', 'yes'):
+            if not (
+                hasattr(self.model, self.user_field_name)
+                and hasattr(request, 'user')
+                and request.user.is_authenticated
+            ):
+                raise ChunkedUploadError(
+                    status=http_status.HTTP_400_BAD_REQUEST,
+                    detail='Aborting all uploads requires an authenticated user'
+                )
+            return queryset
+
+        upload_ids = {
+            upload_id.strip()
+            for value in request.POST.getlist('upload_id')
+            for upload_id in value.split(',')
+            if upload_id.strip()
+        }
+        if not upload_ids:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='The "upload_id" is required'
+            )
+        if len(upload_ids) > self.max_upload_ids:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='Too many upload ids (max %s)' % self.max_upload_ids
+            )
+        return queryset.filter(upload_id__in=upload_ids)
+
+    def abort(self, queryset):
+        """
+        Deletes the uploads and their files. Uploads staged on another node
+        are only expired, their files are deleted by the cleaning commands
+        running on this node.
+        Returns the number of aborted uploads.
+        """
+        if self.deferred_deletion:
+            return queryset.expire()
+        expired = queryset.with_remote_files().expire()
+        return expired + sum(queryset.delete_with_files().values())
+
+    def get_response_data(self, count, request):
+        """
+        Data for the response. Should return a dictionary-like object.
+        """
+        return {
+            'aborted': count
+        }
+
+    def _post(self, request, *args, **kwargs):
+        self.validate(request)
+
+        queryset = self.get_abort_queryset(request)
+        bus = events.get_event_bus()
+        aborted = []
+        if bus is not None and getattr(bus, 'active', True):
+            aborted = list(queryset)
+        count = self.abort(queryset)
+        for chunked_upload in aborted:
+            self.publish_event('aborted', chunked_upload)
+
+        return Response(
+            self.get_response_data(count, request),
+            status=http_status.HTTP_200_OK
+        )
+
+
+class ChunkedUploadEventsView(ChunkedUploadBaseView):
+    """
+    Streams the events of the uploads of the user (or of the uploads given
+    with the `upload_id` GET parameter, comma separated ids) with Server-Sent
+    Events. The stream is closed after `max_duration` seconds, clients
+    reconnect automatically. Each stream holds a worker of the server.
+    """
+
+    # Seconds between keep-alive comments
+    keepalive_interval = 15
+    max_duration = 300
+    # Max number of events buffered for a slow client
+    max_pending = 1000
+
+    def get_event_filter(self, request):
+        """
+        Returns the function selecting the events sent to the client.
+        """
+        upload_ids = {
+            upload_id.strip()
+            for upload_id in request.GET.get('upload_id', '').split(',')
+            if upload_id.strip()
+        }
+        user_id = None
+        if (
+            hasattr(self.model, self.user_field_name)
+            and hasattr(request, 'user')
+            and request.user.is_authenticated
+        ):
+            user_id = request.user.pk
+        elif not upload_ids:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='The "upload_id" is required'
+            )
+
+        def event_filter(event):
+            if user_id is not None and event.get('user_id') != user_id:
+                return False
+            return not upload_ids or event.get('upload_id') in upload_ids
+
+        return event_filter
+
+    def format_event(self, event):
+        return 'event: %s\ndata: %s\n\n' % (event['type'], json.dumps(event))
+
+    def iter_events(self, bus, event_filter):
+        subscription = bus.subscribe(event_filter, max_pending=self.max_pending)
+        try:
+            yield ': connected\n\n'
+            end = time.monotonic() + self.max_duration
+            while (remaining := end - time.monotonic()) > 0:
+                batch = subscription.get(timeout=min(self.keepalive_interval, remaining))
+                if batch:
+                    yield ''.join(self.format_event(event) for event in batch)
+                else:
+                    yield ': keep-alive\n\n'
+        finally:
+            subscription.close()
+
+    def _get(self, request, *args, **kwargs):
+        self.validate(request)
+
+        bus = events.get_event_bus()
+        if bus is None or not hasattr(bus, 'subscribe'):
+            raise ChunkedUploadError(
+                status=http_status.HTTP_404_NOT_FOUND,
+                detail='Upload events are not available'
+            )
+        event_filter = self.get_event_filter(request)
+
+        response = StreamingHttpResponse(
+            self.iter_events(bus, event_filter), content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Disable the buffering of Nginx
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def get(self, request, *args, **kwargs):
+        """
+        Handle GET requests.
+        """
+        try:
+            self.check_permissions(request)
+            return self._get(request, *args, **kwargs)
+        except ChunkedUploadError as error:
+            return Response(error.data, status=error.status_code)
+
+
+class ChunkedUploadDownloadView(ChunkedUploadBaseView):
+    """
+    Serves the content of a chunked upload. Supports HTTP Range requests
+    (single and multiple ranges) and can delegate the delivery of completed
+    files to the web server (X-Accel-Redirect / X-Sendfile).
+    """
+
+    range_header = 'HTTP_RANGE'
+    range_pattern = re.compile(r'^(?P<start>\d*)-(?P<end>\d*)$')
+    # Requests with more ranges than this limit get the whole file
+    max_ranges = 16
+    # If `allow_uploading` is True, the bytes already written to an upload
+    # which is not complete yet can be read (for previews)
+    allow_uploading = False
+    # Header used to delegate the delivery to the web server, `None` to
+    # serve the file from Django
+    sendfile_header = SettingAttribute('SENDFILE_HEADER')
+    sendfile_url = SettingAttribute('SENDFILE_URL')
+    as_attachment = True
+    block_size = 64 * 1024
+
+    def is_valid_chunked_upload(self, chunked_upload):
+        """
+        Check if chunked upload can be read.
+        """
+        if chunked_upload.status != COMPLETE and not self.allow_uploading:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='Upload is not complete'
+            )
+
+    def get_readable_size(self, chunked_upload):
+        """
+        Amount of bytes that can be served. For uploads in progress, only the
+        bytes acknowledged to the client are served.
+        """
+        try:
+            size = Path(chunked_upload.get_path()).stat().st_size
+        except FileNotFoundError:
+            # The file was deleted (e.g. complete uploads kept by
+            # reconcile_uploads without their file)
+            raise ChunkedUploadError(
+                status=http_status.HTTP_410_GONE,
+                detail='File of upload is missing'
+            )
+        if chunked_upload.status != COMPLETE:
+            size = min(size, chunked_upload.offset)
+        return size
+
+    def get_content_type(self, chunked_upload):
+        content_type, _encoding = mimetypes.guess_type(chunked_upload.filename)
+        return content_type or 'application/octet-stream'
+
+    def parse_ranges(self, value, size):
+        """
+        Parse the value of a "Range" header. Returns a list of inclusive
+        (start, end) tuples, an empty list if no range is satisfiable or
+        `None` if the header must be ignored.
+        """
+        unit, _sep, ranges_spec = value.partition('=')
+        if unit.strip().lower() != 'bytes' or not ranges_spec:
+            return None
+        specs = ranges_spec.split(',')
+        if len(specs) > self.max_ranges:
+            return None
+        ranges = []
+        for spec in specs:
+            match = self.range_pattern.match(spec.strip())
+            if not match or match.group('start') == match.group('end') == '':
+                return None
+            if match.group('start') == '':
+                # Suffix range: last N bytes
+                length = int(match.group('end'))
+                if length == 0:
+                    continue
+                start = max(size - length, 0)
+                end = size - 1
+            else:
+                start = int(match.group('start'))
+                end = int(match.group('end')) if match.group('end') else size - 1
+                if start > end:
+                    return None
+                end = min(end, size - 1)
+            if start < size:
+                ranges.append((start, end))
+        return ranges
+
+    def iter_file(self, path, start, end):
+        """
+        Yields the bytes of the file between `start` and `end` (inclusive).
+        """
+        remaining = end - start + 1
+        with open(path, mode='rb') as file_obj:
+            file_obj.seek(start)
+            while remaining > 0:
+                data = file_obj.read(min(self.block_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def iter_multipart(self, path, ranges, size, content_type, boundary):
+        for start, end in ranges:
+            yield self.get_part_header(start, end, size, content_type, boundary)
+            yield from self.iter_file(path, start, end)
+        yield ('\r\n--%s--\r\n' % boundary).encode('ascii')
+
+    def get_part_header(self, start, end, size, content_type, boundary):
+        return (
+            '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %s-%s/%s\r\n\r\n'
+            % (boundary, content_type, start, end, size)
+        ).encode('ascii')
+
+    def get_sendfile_response(self, chunked_upload, content_type):
+        """
+        Response delegating the delivery of the file to the web server. The
+        web server handles the Range requests itself.
+        """
+        response = HttpResponse(content_type=content_type)
+        if self.sendfile_header.lower() == 'x-accel-redirect':
+            value = self.sendfile_url.rstrip('/') + '/' + quote(chunked_upload.file.name)
+        else:
+            value = chunked_upload.file.path
+        response[self.sendfile_header] = value
+        return response
+
+    def get_file_response(self, chunked_upload, request):
+        path = chunked_upload.get_path()
+        size = self.get_readable_size(chunked_upload)
+        content_type = self.get_content_type(chunked_upload)
+
+        if self.sendfile_header and chunked_upload.status == COMPLETE:
+            return self.get_sendfile_response(chunked_upload, content_type)
+
+        ranges = None
+        range_value = request.META.get(self.range_header)
+        if range_value:
+            ranges = self.parse_ranges(range_value, size)
+            if ranges == []:
+                response = HttpResponse(status=http_status.HTTP_416_RANGE_NOT_SATISFIABLE)
+                response['Content-Range'] = 'bytes */%s' % size
+                return response
+
+        if not ranges:
+            if chunked_upload.status == COMPLETE:
+                # FileResponse can use the "wsgi.file_wrapper" of the server
+                response = FileResponse(open(path, mode='rb'), content_type=content_type)
+            else:
+                response = StreamingHttpResponse(
+                    self.iter_file(path, 0, size - 1), content_type=content_type
+                )
+                response['Content-Length'] = str(size)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            response = StreamingHttpResponse(
+                self.iter_file(path, start, end),
+                content_type=content_type,
+                status=http_status.HTTP_206_PARTIAL_CONTENT,
+            )
+            response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            boundary = uuid.uuid4().hex
+            length = len(('\r\n--%s--\r\n' % boundary).encode('ascii'))
+            for start, end in ranges:
+                length += len(self.get_part_header(start, end, size, content_type, boundary))
+                length += end - start + 1
+            response = StreamingHttpResponse(
+                self.iter_multipart(path, ranges, size, content_type, boundary),
+                content_type='multipart/byteranges; boundary=%s' % boundary,
+                status=http_status.HTTP_206_PARTIAL_CONTENT,
+            )
+            response['Content-Length'] = str(length)
+        return response
+
+    def _get(self, request, *args, **kwargs):
+        self.validate(request)
+
+        upload_id = kwargs.get('upload_id') or request.GET.get('upload_id')
+        if not upload_id:
+            raise ChunkedUploadError(
+                status=http_status.HTTP_400_BAD_REQUEST,
+                detail='The "upload_id" is required'
+            )
+
+        chunked_upload = get_object_or_404(
+            self.get_queryset(request),
+            upload_id=upload_id
+        )
+
+        redirect = self.check_node(chunked_upload, request)
+        if redirect is not None:
+            return redirect
+
+        self.is_valid_chunked_upload(chunked_upload)
+
+        response = self.get_file_response(chunked_upload, request)
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = content_disposition_header(
+            self.as_attachment, chunked_upload.filename
+        )
+        return response
+
+    def get(self, request, *args, **kwargs):
+        """
+        Handle GET requests.
+        """
+        try:
+            self.check_permissions(request)
+            return self._get(request, *args, **kwargs)
+        except ChunkedUploadError as error:
+            return Response(error.data, status=error.status_code)
@@ -0,0 +1,524 @@
+"""
+Soak test of the upload views: many concurrent clients upload files in
+chunks to a local server running `ChunkedUploadView` and
+`ChunkedUploadCompleteView`, with injected faults (client disconnects,
+duplicated chunks sent concurrently, ENOSPC errors and slow disks). Every
+completed file is checked byte for byte and the throughput and error rates
+are reported per interval.
+
+Usage:
+
+    python -m tests.soak --clients 200 --uploads 5 --file-size 4000000
+
+The standalone run uses a SQLite database (WAL mode) in a temporary
+directory. To test with another database, configure Django and call
+`run_soak()`.
+"""
+import argparse
+import errno
+import hashlib
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+
+@dataclass
+class SoakOptions:
+    clients: int = 50
+    uploads: int = 3  # Number of uploads per client
+    file_size: int = 1_000_000
+    chunk_size: int = 100_000
+    disconnect_rate: float = 0.02
+    duplicate_rate: float = 0.02
+    enospc_rate: float = 0.02
+    slow_rate: float = 0.02
+    slow_delay: float = 0.2  # Seconds
+    max_retries: int = 20  # Per chunk
+    interval: float = 1  # Seconds, for the report curves
+    seed: int = 0
+
+
+@dataclass
+class SoakResult:
+    completed: int = 0
+    failed: int = 0
+    corrupted: int = 0
+    duration: float = 0
+    # (start time, requests, acknowledged bytes, {error kind: count})
+    curves: list = field(default_factory=list)
+    errors: dict = field(default_factory=dict)
+    leaks: dict = field(default_factory=dict)
+
+    @property
+    def ok(self):
+        return not (self.failed or self.corrupted or any(self.leaks.values()))
+
+
+class Faults:
+    """
+    Random faults injected by the server views, shared by all the threads.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.lock = threading.Lock()
+
+    def draw(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+
+_faults = None
+
+
+class FaultyChunk:
+    """
+    Wraps an uploaded chunk to simulate a slow disk or a full disk (an
+    ENOSPC error is raised after writing half of the data).
+    """
+
+    def __init__(self, chunk, slow_delay=0, enospc=False):
+        self.chunk = chunk
+        self.name = chunk.name
+        self.size = chunk.size
+        self.slow_delay = slow_delay
+        self.enospc = enospc
+
+    def chunks(self, chunk_size=None):
+        written = 0
+        for data in self.chunk.chunks(chunk_size):
+            if self.slow_delay:
+                time.sleep(self.slow_delay)
+            if self.enospc and written + len(data) > self.size // 2:
+                yield data[:self.size // 2 - written]
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+            written += len(data)
+            yield data
+
+
+def get_views():
+    from chunked_upload.views import ChunkedUploadCompleteView, ChunkedUploadView
+
+    class FaultyUploadView(ChunkedUploadView):
+
+        def write_chunk(self, chunked_upload, chunk, digest=None):
+            options = _faults.options
+            slow_delay = options.slow_delay if _faults.draw(options.slow_rate) else 0
+            enospc = _faults.draw(options.enospc_rate)
+            if slow_delay or enospc:
+                chunk = FaultyChunk(chunk, slow_delay=slow_delay, enospc=enospc)
+            super().write_chunk(chunked_upload, chunk, digest=digest)
+
+    return FaultyUploadView, ChunkedUploadCompleteView
+
+
+def __getattr__(name):
+    # URLs of the soak server (this module is used as ROOT_URLCONF)
+    if name == 'urlpatterns':
+        from django.urls import path
+
+        upload_view, complete_view = get_views()
+        return [
+            path('upload/', upload_view.as_view()),
+            path('complete/', complete_view.as_view()),
+        ]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def start_server():
+    """
+    Starts a threaded WSGI server on a free local port.
+    Returns the server and its port.
+    """
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    class SoakServer(ThreadedWSGIServer):
+        request_queue_size = 1024
+
+    server = SoakServer(('127.0.0.1', 0), QuietRequestHandler, allow_reuse_address=False)
+    server.set_app(WSGIHandler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def encode_multipart(fields, file_name, file_data):
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in fields.items():
+        lines.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        )
+    lines.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"'
+        '\r\nContent-Type: application/octet-stream\r\n\r\n'
+    )
+    body = ''.join(lines).encode() + file_data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class Recorder:
+    """
+    Collects the requests, acknowledged bytes and errors per interval.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.errors = {}
+
+    def record(self, acked=0, error=None):
+        index = int((time.monotonic() - self.start) / self.interval)
+        with self.lock:
+            bucket = self.buckets.setdefault(index, [0, 0, {}])
+            bucket[0] += 1
+            bucket[1] += acked
+            if error:
+                bucket[2][error] = bucket[2].get(error, 0) + 1
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def get_curves(self):
+        last = max(self.buckets, default=-1)
+        return [
+            (index * self.interval, *self.buckets.get(index, (0, 0, {})))
+            for index in range(last + 1)
+        ]
+
+
+class SoakClient:
+    """
+    Simulated client uploading files chunk by chunk. Rejected chunks are
+    resent from the offset known by the server.
+    """
+
+    def __init__(self, port, options, recorder, rng):
+        self.port = port
+        self.options = options
+        self.recorder = recorder
+        self.random = rng
+
+    def request(self, path, fields, file_data=None, headers=None, disconnect=False):
+        """
+        Sends a POST request. Returns (status, JSON content), or `None` if
+        the client disconnected.
+        """
+        if file_data is None:
+            body = '&'.join(f'{key}={value}' for key, value in fields.items()).encode()
+            content_type = 'application/x-www-form-urlencoded'
+        else:
+            body, content_type = encode_multipart(fields, 'soak.bin', file_data)
+        headers = dict(headers or {}, **{'Content-Type': content_type})
+        if disconnect:
+            # Send only a part of the body then close the connection
+            sock = socket.create_connection(('127.0.0.1', self.port), timeout=60)
+            try:
+                head = f'POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                head += f'Content-Length: {len(body)}\r\n'
+                head += ''.join(f'{key}: {value}\r\n' for key, value in headers.items())
+                sock.sendall(head.encode() + b'\r\n' + body[:self.random.randrange(len(body))])
+            finally:
+                sock.close()
+            return None
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        try:
+            connection.request('POST', path, body=body, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        finally:
+            connection.close()
+        try:
+            return response.status, json.loads(content)
+        except ValueError:
+            return response.status, {'detail': content[:200].decode(errors='replace')}
+
+    def send_chunk(self, upload_id, data, offset, disconnect=False):
+        chunk = data[offset:offset + self.options.chunk_size]
+        fields = {'upload_id': upload_id} if upload_id else {}
+        content_range = f'bytes {offset}-{offset + len(chunk) - 1}/{len(data)}'
+        return self.request(
+            '/upload/', fields, chunk,
+            headers={'Content-Range': content_range},
+            disconnect=disconnect,
+        )
+
+    def get_error_kind(self, status, content):
+        detail = str(content.get('detail', ''))
+        if 'space' in detail:
+            return 'enospc'
+        if 'another request' in detail:
+            return 'concurrent_write'
+        if 'Offsets do not match' in detail:
+            return 'offset_mismatch'
+        if "doesn't match headers" in detail:
+            return 'truncated_chunk'
+        return f'http_{status} ({detail[:60]})'
+
+    def upload(self, data):
+        """
+        Uploads a file. Returns the upload id, or `None` if the upload
+        failed.
+        """
+        options = self.options
+        upload_id = None
+        offset = 0
+        retries = 0
+        while offset < len(data):
+            if retries > options.max_retries:
+                self.recorder.record(error='too_many_retries')
+                return None
+            if self.random.random() < options.disconnect_rate:
+                try:
+                    self.send_chunk(upload_id, data, offset, disconnect=True)
+                except OSError:
+                    pass
+                self.recorder.record(error='disconnect')
+                retries += 1
+                continue
+
+            if upload_id and self.random.random() < options.duplicate_rate:
+                # Same chunk sent twice at the same time (retry race)
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    results = list(executor.map(
+                        lambda _index: self.send_chunk(upload_id, data, offset), range(2)
+                    ))
+            else:
+                results = [self.send_chunk(upload_id, data, offset)]
+
+            expected = min(offset + options.chunk_size, len(data))
+            accepted = 0
+            server_offset = None
+            for status, content in results:
+                if status == 200:
+                    accepted += 1
+                    upload_id = content['upload_id']
+                    if content['offset'] != expected:
+                        self.recorder.record(error='wrong_offset')
+                        return None
+                    self.recorder.record(acked=expected - offset)
+                else:
+                    self.recorder.record(error=self.get_error_kind(status, content))
+                    server_offset = content.get('offset', server_offset)
+            if accepted > 1:
+                self.recorder.record(error='duplicate_accepted')
+                return None
+            if accepted:
+                offset = expected
+                retries = 0
+            else:
+                if server_offset is not None:
+                    # Resume from the offset known by the server
+                    offset = server_offset
+                retries += 1
+                time.sleep(0.01 * retries)
+
+        status, content = self.request(
+            '/complete/', {'upload_id': upload_id, 'expected_size': len(data)}
+        )
+        if status != 200:
+            self.recorder.record(error=self.get_error_kind(status, content))
+            return None
+        self.recorder.record()
+        return upload_id
+
+    def run(self, uploads):
+        """
+        Uploads random files. Returns a list of (upload id, SHA-256 digest).
+        """
+        results = []
+        for _index in range(uploads):
+            data = self.random.randbytes(self.options.file_size)
+            upload_id = self.upload(data)
+            results.append((upload_id, hashlib.sha256(data).hexdigest()))
+        return results
+
+
+def count_fds():
+    """
+    Number of open file descriptors, ignoring the SQLite database files
+    (SQLite defers closing them while other connections hold locks).
+    """
+    from django.db import connection
+
+    database = str(connection.settings_dict['NAME'])
+    count = 0
+    try:
+        fds = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+    for fd in fds:
+        try:
+            target = os.readlink(f'/proc/self/fd/{fd}')
+        except OSError:
+            continue
+        if connection.vendor != 'sqlite' or not target.startswith(database):
+            count += 1
+    return count
+
+
+def check_leaks(model, upload_ids):
+    """
+    Returns the number of files without upload, of uploads without file
+    and of uploads which are neither complete nor aborted by a client.
+    """
+    from chunked_upload.constants import COMPLETE
+    from chunked_upload.models import get_upload_root
+
+    storage = model._meta.get_field('file').storage
+    root = storage.path(get_upload_root())
+    names = set(model.objects.values_list('file', flat=True))
+    orphans = 0
+    for dir_path, _dir_names, file_names in os.walk(root):
+        for file_name in file_names:
+            name = os.path.relpath(os.path.join(dir_path, file_name), storage.path(''))
+            if name not in names:
+                orphans += 1
+    missing = sum(1 for name in names if name and not storage.exists(name))
+    incomplete = model.objects.filter(upload_id__in=upload_ids).exclude(status=COMPLETE).count()
+    return {'orphan_files': orphans, 'missing_files': missing, 'incomplete_uploads': incomplete}
+
+
+def run_soak(options):
+    """
+    Runs the soak test. Django must be configured, with this module as
+    ROOT_URLCONF and the database migrated.
+    """
+    from chunked_upload.models import ChunkedUpload
+
+    global _faults
+    _faults = Faults(options)
+    server, port = start_server()
+    recorder = Recorder(options.interval)
+    fds_before = count_fds()
+    start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=options.clients) as executor:
+            clients = [
+                SoakClient(port, options, recorder, random.Random(options.seed + index))
+                for index in range(options.clients)
+            ]
+            futures = [executor.submit(client.run, options.uploads) for client in clients]
+            results = [item for future in futures for item in future.result()]
+    finally:
+        server.shutdown()
+        server.server_close()
+    result = SoakResult(duration=time.monotonic() - start)
+
+    for upload_id, digest in results:
+        if upload_id is None:
+            result.failed += 1
+            continue
+        chunked_upload = ChunkedUpload.objects.get(upload_id=upload_id)
+        hasher = hashlib.sha256()
+        with open(chunked_upload.get_path(), mode='rb') as file_obj:
+            while data := file_obj.read(1024 * 1024):
+                hasher.update(data)
+        if hasher.hexdigest() == digest:
+            result.completed += 1
+        else:
+            result.corrupted += 1
+
+    result.curves = recorder.get_curves()
+    result.errors = dict(recorder.errors)
+    result.leaks = check_leaks(ChunkedUpload, [upload_id for upload_id, _digest in results])
+    # Let the server threads end before counting file descriptors
+    time.sleep(0.5)
+    fds_after = count_fds()
+    if fds_before is not None and fds_after is not None:
+        result.leaks['file_descriptors'] = max(fds_after - fds_before, 0)
+    return result
+
+
+def print_report(result, interval, output):
+    output.write('time (s)  requests  MB/s      errors  error rate\n')
+    for start, requests, acked, errors in result.curves:
+        count = sum(errors.values())
+        rate = count / requests if requests else 0
+        output.write(
+            f'{start:<9g} {requests:<9} {acked / 1e6 / interval:<9.2f} {count:<7} {rate:.1%}\n'
+        )
+    output.write(f'Duration: {result.duration:.1f} s\n')
+    output.write(f'Completed uploads: {result.completed}\n')
+    output.write(f'Failed uploads: {result.failed}\n')
+    output.write(f'Corrupted uploads: {result.corrupted}\n')
+    output.write(f'Errors: {result.errors}\n')
+    output.write(f'Leaks: {result.leaks}\n')
+
+
+def configure(tmp_dir):
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(tmp_dir, 'db.sqlite3'),
+                'OPTIONS': {
+                    'timeout': 60,
+                    'transaction_mode': 'IMMEDIATE',
+                    'init_command': 'PRAGMA journal_mode=WAL;',
+                },
+            }
+        },
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'chunked_upload',
+        ],
+        STORAGES={
+            'default': {
+                'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                'OPTIONS': {'location': tmp_dir},
+            },
+        },
+        ROOT_URLCONF=__name__,
+        ALLOWED_HOSTS=['127.0.0.1'],
+        CHUNKED_UPLOAD_STORAGE='django.core.files.storage.default_storage',
+        LOGGING_CONFIG=None,
+    )
+    django.setup()
+    call_command('migrate', verbosity=0)
+    # Rejected requests are expected
+    logging.getLogger('django.request').setLevel(logging.ERROR)
+
+
+def main():
+    import sys
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    for name, default in SoakOptions.__dataclass_fields__.items():
+        parser.add_argument(
+            '--' + name.replace('_', '-'), type=type(default.default), default=default.default
+        )
+    options = SoakOptions(**vars(parser.parse_args()))
+
+    tmp_dir = tempfile.mkdtemp(prefix='chk-up-soak-')
+    try:
+        configure(tmp_dir)
+        result = run_soak(options)
+        print_report(result, options.interval, sys.stdout)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    sys.exit(0 if result.ok else 1)
+
+
+if __name__ == '__main__':
+    main()
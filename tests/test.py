@@ -1,9 +1,17 @@
 import datetime
+from decimal import Decimal
 import errno
+import gzip
+import hashlib
+import json
 from io import BytesIO
 from pathlib import Path
+import shutil
+import threading
 import time
 from unittest.mock import patch
+import zipfile
+import zlib
 
 import pytest
 
@@ -68,7 +76,9 @@ def test_views__single_chunk(request_factory, tmp_dir, user, headers):
     response = upload_view(request)
     content = get_response_json(response)
     assert response.status_code == 200, content
-    assert list(content.keys()) == ['upload_id', 'offset', 'expires']
+    assert list(content.keys()) == [
+        'upload_id', 'offset', 'expires', 'chunk_size', 'max_chunk_size'
+    ]
     upload_id = content['upload_id']
 
     # Call complete without size check
@@ -108,7 +118,9 @@ def test_views__multiple_chunks(request_factory, tmp_dir, user):
     response = upload_view(request)
     content = get_response_json(response)
     assert response.status_code == 200, content
-    assert list(content.keys()) == ['upload_id', 'offset', 'expires']
+    assert list(content.keys()) == [
+        'upload_id', 'offset', 'expires', 'chunk_size', 'max_chunk_size'
+    ]
     upload_id = content['upload_id']
 
     # Send chunk 2
@@ -123,7 +135,9 @@ def test_views__multiple_chunks(request_factory, tmp_dir, user):
     response = upload_view(request)
     content = get_response_json(response)
     assert response.status_code == 200, content
-    assert list(content.keys()) == ['upload_id', 'offset', 'expires']
+    assert list(content.keys()) == [
+        'upload_id', 'offset', 'expires', 'chunk_size', 'max_chunk_size'
+    ]
     assert content['upload_id'] == upload_id
 
     # Call complete with size check
@@ -167,7 +181,9 @@ def test_views__wrong_offset(request_factory, tmp_dir, user):
     response = upload_view(request)
     content = get_response_json(response)
     assert response.status_code == 200, content
-    assert list(content.keys()) == ['upload_id', 'offset', 'expires']
+    assert list(content.keys()) == [
+        'upload_id', 'offset', 'expires', 'chunk_size', 'max_chunk_size'
+    ]
     upload_id = content['upload_id']
 
     chk_ups = list(models.ChunkedUpload.objects.all())
@@ -281,18 +297,17 @@ def test_views__validation_error(request_factory, user):
     pytest.param(datetime.timedelta(microseconds=1), id='1 ms'),
 ])
 def test_cleaning(expiration):
+    from django.test import override_settings
+
     from chunked_upload import models
     from chunked_upload.constants import COMPLETE, UPLOADING
-    from chunked_upload.management.commands import delete_expired_uploads
-
-    if expiration:
-        delete_expired_uploads.EXPIRATION_DELTA = expiration
 
-    chk_ups = [
-        models.ChunkedUpload(filename='test.1', status=UPLOADING),
-        models.ChunkedUpload(filename='test.2', status=COMPLETE),
-    ]
-    models.ChunkedUpload.objects.bulk_create(chk_ups)
+    with override_settings(CHUNKED_UPLOAD_EXPIRATION_DELTA=expiration or datetime.timedelta(1)):
+        chk_ups = [
+            models.ChunkedUpload(filename='test.1', status=UPLOADING),
+            models.ChunkedUpload(filename='test.2', status=COMPLETE),
+        ]
+        models.ChunkedUpload.objects.bulk_create(chk_ups)
     time.sleep(0.1)
 
     run_management_command('delete_expired_uploads')
@@ -305,3 +320,1481 @@ def test_cleaning(expiration):
 
     for chk_up in chk_ups:
         chk_up.delete()
+
+
+def _upload_file(request_factory, user, data, complete=True):
+    from chunked_upload import models, views
+
+    fake_file = BytesIO(data)
+    fake_file.name = 'test-file.txt'
+    request = request_factory(user=user, method='post', data={'file': fake_file})
+    response = views.ChunkedUploadView.as_view()(request)
+    assert response.status_code == 200, response.content
+    upload_id = get_response_json(response)['upload_id']
+    if complete:
+        request = request_factory(user=user, method='post', data={'upload_id': upload_id})
+        response = views.ChunkedUploadCompleteView.as_view()(request)
+        assert response.status_code == 200, response.content
+    return models.ChunkedUpload.objects.get(upload_id=upload_id)
+
+
+@pytest.mark.parametrize('range_header, status, expected', [
+    pytest.param(None, 200, b'0123456789', id='no range'),
+    pytest.param('bytes=2-4', 206, b'234', id='single range'),
+    pytest.param('bytes=-3', 206, b'789', id='suffix range'),
+    pytest.param('bytes=8-', 206, b'89', id='open range'),
+    pytest.param('bytes=5-100', 206, b'56789', id='range over size'),
+    pytest.param('invalid', 200, b'0123456789', id='ignored range'),
+    pytest.param('bytes=20-30', 416, b'', id='unsatisfiable range'),
+])
+def test_views__download(request_factory, user, range_header, status, expected):
+    from chunked_upload import views
+
+    chk_up = _upload_file(request_factory, user, b'0123456789')
+    download_view = views.ChunkedUploadDownloadView.as_view()
+
+    headers = {'HTTP_RANGE': range_header} if range_header else {}
+    request = request_factory(user=user, data={'upload_id': chk_up.upload_id}, **headers)
+    response = download_view(request)
+    assert response.status_code == status
+    content = b''.join(response.streaming_content) if response.streaming else response.content
+    if status == 206:
+        assert response['Content-Range'].startswith('bytes ')
+    if status != 416:
+        assert content == expected
+    response.close()
+
+    chk_up.delete()
+
+
+def test_views__download_multiple_ranges(request_factory, user):
+    from chunked_upload import views
+
+    chk_up = _upload_file(request_factory, user, b'0123456789')
+    download_view = views.ChunkedUploadDownloadView.as_view()
+
+    request = request_factory(
+        user=user, data={'upload_id': chk_up.upload_id}, HTTP_RANGE='bytes=0-1, 7-8'
+    )
+    response = download_view(request)
+    assert response.status_code == 206
+    assert response['Content-Type'].startswith('multipart/byteranges; boundary=')
+    content = b''.join(response.streaming_content)
+    assert int(response['Content-Length']) == len(content)
+    assert b'Content-Range: bytes 0-1/10\r\n\r\n01\r\n' in content
+    assert b'Content-Range: bytes 7-8/10\r\n\r\n78\r\n' in content
+
+    chk_up.delete()
+
+
+def test_views__download_uploading(request_factory, user):
+    from chunked_upload import views
+
+    chk_up = _upload_file(request_factory, user, b'0123456789', complete=False)
+    # Bytes not acknowledged yet must not be served
+    with open(chk_up.file.path, mode='ab') as fo:
+        fo.write(b'abc')
+
+    request = request_factory(user=user, data={'upload_id': chk_up.upload_id})
+    response = views.ChunkedUploadDownloadView.as_view()(request)
+    assert response.status_code == 400
+
+    view = views.ChunkedUploadDownloadView.as_view(allow_uploading=True)
+    response = view(request)
+    assert response.status_code == 200
+    assert b''.join(response.streaming_content) == b'0123456789'
+
+    chk_up.delete()
+
+
+def test_views__download_missing_file(request_factory, user):
+    from chunked_upload import views
+
+    chk_up = _upload_file(request_factory, user, b'0123456789')
+    Path(chk_up.file.path).unlink()
+
+    request = request_factory(user=user, data={'upload_id': chk_up.upload_id})
+    response = views.ChunkedUploadDownloadView.as_view()(request)
+    content = get_response_json(response)
+    assert response.status_code == 410, content
+    assert content['detail'] == 'File of upload is missing'
+
+    chk_up.delete()
+
+
+def test_views__download_sendfile(request_factory, user):
+    from chunked_upload import views
+
+    chk_up = _upload_file(request_factory, user, b'0123456789')
+
+    request = request_factory(user=user, data={'upload_id': chk_up.upload_id})
+    view = views.ChunkedUploadDownloadView.as_view(sendfile_header='X-Accel-Redirect')
+    response = view(request)
+    assert response.status_code == 200
+    assert response['X-Accel-Redirect'] == '/protected/' + chk_up.file.name
+    assert response.content == b''
+
+    view = views.ChunkedUploadDownloadView.as_view(sendfile_header='X-Sendfile')
+    response = view(request)
+    assert response['X-Sendfile'] == chk_up.file.path
+
+    chk_up.delete()
+
+
+@pytest.mark.parametrize('encoding, compress', [
+    pytest.param('gzip', gzip.compress, id='gzip'),
+    pytest.param('deflate', zlib.compress, id='deflate'),
+    pytest.param(
+        'gzip', lambda data: gzip.compress(data[:5000]) + gzip.compress(data[5000:]),
+        id='gzip members'
+    ),
+])
+def test_views__compressed_chunks(request_factory, user, encoding, compress):
+    from chunked_upload import models, views
+
+    upload_view = views.ChunkedUploadView.as_view()
+    data = b''.join(b'line %d of a log file\n' % i for i in range(1000))
+
+    # Send chunk 1 (size checked with decompressed bytes)
+    fake_file = BytesIO(compress(data))
+    fake_file.name = 'test.log'
+    request = request_factory(
+        user=user,
+        method='post',
+        data={'file': fake_file},
+        HTTP_CONTENT_RANGE=f'bytes 0-{len(data) - 1}/{len(data) * 2}',
+        HTTP_CONTENT_ENCODING=encoding,
+    )
+    response = upload_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 200, content
+    assert content['offset'] == len(data)
+    upload_id = content['upload_id']
+
+    # Send chunk 2 with a wrong decompressed size
+    fake_file = BytesIO(compress(data))
+    fake_file.name = 'test.log'
+    request = request_factory(
+        user=user,
+        method='post',
+        data={'file': fake_file, 'upload_id': upload_id},
+        HTTP_CONTENT_RANGE=f'bytes {len(data)}-{len(data) * 2 - 2}/{len(data) * 2}',
+        HTTP_CONTENT_ENCODING=encoding,
+    )
+    response = upload_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 400, content
+
+    chk_up = models.ChunkedUpload.objects.get(upload_id=upload_id)
+    assert chk_up.offset == len(data)
+    assert Path(chk_up.file.path).read_bytes() == data
+
+    chk_up.delete()
+
+
+@pytest.mark.parametrize('data, encoding, status, expected_message', [
+    pytest.param(gzip.compress(b'\0' * 1_000_000), 'gzip', 400,
+                 'Decompression ratio exceeds the limit (100)', id='bomb'),
+    pytest.param(gzip.compress(b'test data')[:-4], 'gzip', 400, None, id='truncated'),
+    pytest.param(gzip.compress(b'test data') + b'garbage', 'gzip', 400, None, id='gzip trailing'),
+    pytest.param(gzip.compress(b'test data') + b'\x1f', 'gzip', 400, None, id='gzip truncated'),
+    pytest.param(zlib.compress(b'test data') + b'x', 'deflate', 400,
+                 'Failed to decompress chunk (Unexpected data after compressed data)',
+                 id='deflate trailing'),
+    pytest.param(b'test data', 'br', 415, 'Unsupported content encoding "br"', id='unsupported'),
+])
+def test_views__compressed_chunks_error(request_factory, user, data, encoding, status,
+                                        expected_message):
+    from chunked_upload import models, views
+
+    fake_file = BytesIO(data)
+    fake_file.name = 'test.bin'
+    request = request_factory(
+        user=user, method='post', data={'file': fake_file}, HTTP_CONTENT_ENCODING=encoding
+    )
+    response = views.ChunkedUploadView.as_view()(request)
+    content = get_response_json(response)
+    assert response.status_code == status, content
+    if expected_message:
+        assert content['detail'] == expected_message
+
+    assert models.ChunkedUpload.objects.all().count() == 0
+
+
+def test_views__compressed_chunks_zstd(request_factory, user):
+    zstandard = pytest.importorskip('zstandard')
+    from chunked_upload import models, views
+
+    data = b''.join(b'line %d of a log file\n' % i for i in range(1000))
+    compressed = zstandard.ZstdCompressor().compress(data)
+
+    def post(body):
+        fake_file = BytesIO(body)
+        fake_file.name = 'test.log'
+        request = request_factory(
+            user=user, method='post', data={'file': fake_file}, HTTP_CONTENT_ENCODING='zstd'
+        )
+        response = views.ChunkedUploadView.as_view()(request)
+        return response.status_code, get_response_json(response)
+
+    # Several frames
+    half = len(data) // 2
+    status, content = post(
+        zstandard.ZstdCompressor().compress(data[:half])
+        + zstandard.ZstdCompressor().compress(data[half:])
+    )
+    assert status == 200, content
+    chk_up = models.ChunkedUpload.objects.get(upload_id=content['upload_id'])
+    assert Path(chk_up.file.path).read_bytes() == data
+    chk_up.delete()
+
+    # Truncated body, trailing data
+    status, content = post(compressed[:-10])
+    assert status == 400, content
+    assert content['detail'] == 'Failed to decompress chunk (Compressed data is truncated)'
+    status, content = post(compressed + b'garbage')
+    assert status == 400, content
+    assert models.ChunkedUpload.objects.all().count() == 0
+
+
+def test_views__dedup(request_factory, tmp_dir, user):
+    from django.contrib.auth.models import User
+
+    from chunked_upload import models, views
+    from chunked_upload.exceptions import ChunkedUploadError
+
+    upload_view = views.ChunkedUploadView.as_view(dedup=True)
+    complete_view = views.ChunkedUploadCompleteView.as_view()
+    digest = hashlib.sha256(b'test data').hexdigest()
+
+    # No chunk is known
+    request = request_factory(user=user, method='post', data={'hashes': digest})
+    response = upload_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 200, content
+    assert content == {'known': []}
+
+    # Send chunk 1
+    fake_file = BytesIO(b'test data')
+    fake_file.name = 'dump.sql'
+    request = request_factory(
+        user=user, method='post', data={'file': fake_file}, HTTP_CONTENT_RANGE='bytes 0-8/18'
+    )
+    response = upload_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 200, content
+    upload_id = content['upload_id']
+
+    # Chunk is now known and can be sent by reference
+    request = request_factory(user=user, method='post', data={'hashes': f'{digest},unknown'})
+    response = upload_view(request)
+    assert get_response_json(response) == {'known': [digest]}
+
+    request = request_factory(
+        user=user,
+        method='post',
+        data={'chunk_hash': digest, 'upload_id': upload_id},
+        HTTP_CONTENT_RANGE='bytes 9-17/18',
+    )
+    response = upload_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 200, content
+    assert content['offset'] == 18
+
+    chk_up = models.ChunkedUpload.objects.get(upload_id=upload_id)
+    assert chk_up.get_manifest() == [(digest, 9), (digest, 9)]
+    assert chk_up.get_size() == 18
+    assert Path(chk_up.file.path).read_bytes() == b''
+
+    # Chunks of other users cannot be referenced
+    other_user = User.objects.create(username='other')
+    request = request_factory(user=other_user, method='post', data={'hashes': digest})
+    response = upload_view(request)
+    assert get_response_json(response) == {'known': []}
+    request = request_factory(
+        user=other_user,
+        method='post',
+        data={'chunk_hash': digest},
+        HTTP_CONTENT_RANGE='bytes 0-8/9',
+    )
+    response = upload_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 400, content
+    assert content['detail'] == 'Unknown chunk hash'
+
+    # Manifest entries are only added at the expected offset
+    with pytest.raises(ChunkedUploadError) as error:
+        chk_up.append_stored_chunk(digest, 9, start=9)
+    assert error.value.data['size'] == 18
+
+    # File is assembled on completion
+    data = {'upload_id': upload_id, 'expected_size': '18'}
+    request = request_factory(user=user, method='post', data=data)
+    response = complete_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 200, content
+
+    chk_up.refresh_from_db()
+    assert not chk_up.has_manifest()
+    assert Path(chk_up.file.path).read_bytes() == b'test datatest data'
+
+    chk_up.delete()
+    shutil.rmtree(tmp_dir / 'chunked_uploads/chunks')
+
+
+def test_reconcile_uploads(request_factory, tmp_dir, user):
+    import os
+
+    from chunked_upload import models
+
+    def make_old(path):
+        os.utime(path, (time.time() - 7200, time.time() - 7200))
+
+    ok = _upload_file(request_factory, user, b'test data')
+    make_old(ok.file.path)
+    drift = _upload_file(request_factory, user, b'test data', complete=False)
+    with open(drift.file.path, mode='ab') as fo:
+        fo.write(b'not acknowledged')
+    make_old(drift.file.path)
+    missing = _upload_file(request_factory, user, b'test data', complete=False)
+    Path(missing.file.path).unlink()
+    missing_complete = _upload_file(request_factory, user, b'test data')
+    Path(missing_complete.file.path).unlink()
+    orphan = tmp_dir / 'uploads/chunked/orphan.part'
+    orphan.write_bytes(b'test data')
+    make_old(orphan)
+    recent = tmp_dir / 'uploads/chunked/recent.part'
+    recent.write_bytes(b'test data')
+    # Manifests (deduplication) are orphans if their upload does not exist
+    orphan_manifest = tmp_dir / 'uploads/chunked/orphan.part.manifest'
+    orphan_manifest.touch()
+    make_old(orphan_manifest)
+    manifest = Path(ok.get_manifest_path())
+    manifest.touch()
+    make_old(manifest)
+
+    log = run_management_command('reconcile_uploads')
+    assert '2 orphan files found.' in log
+    assert '2 uploads without file found.' in log
+    assert '1 uploads with size mismatch found.' in log
+    assert orphan.exists()
+
+    # Complete uploads without file are not deleted by default
+    log = run_management_command('reconcile_uploads', '--fix')
+    assert '4 issues fixed.' in log
+    assert models.ChunkedUpload.objects.filter(pk=missing_complete.pk).exists()
+    assert not orphan.exists()
+    assert not orphan_manifest.exists()
+    assert manifest.exists()
+    assert recent.exists()
+    assert not models.ChunkedUpload.objects.filter(pk=missing.pk).exists()
+    assert Path(drift.file.path).read_bytes() == b'test data'
+
+    log = run_management_command('reconcile_uploads', '--fix', '--delete-missing-complete')
+    assert '0 orphan files found.' in log
+    assert '1 uploads without file found.' in log
+    assert '0 uploads with size mismatch found.' in log
+    assert '1 issues fixed.' in log
+    assert not models.ChunkedUpload.objects.filter(pk=missing_complete.pk).exists()
+
+    recent.unlink()
+    ok.delete()
+    assert not manifest.exists()
+    drift.delete()
+
+
+def test_reconcile_uploads__storage_root(tmp_dir):
+    import os
+
+    from django.core.management.base import CommandError
+    from django.test import override_settings
+
+    other = tmp_dir / 'avatars/me.png'
+    other.parent.mkdir()
+    other.write_bytes(b'not an upload')
+    empty_dir = tmp_dir / 'empty'
+    empty_dir.mkdir()
+    for path in (other, other.parent, empty_dir):
+        os.utime(path, (time.time() - 7200, time.time() - 7200))
+
+    # The storage root contains other files than the uploads
+    with override_settings(CHUNKED_UPLOAD_PATH='%Y/%m/%d'):
+        with pytest.raises(CommandError):
+            run_management_command('reconcile_uploads', '--fix')
+        run_management_command('delete_expired_uploads')
+        run_management_command('reap_expired_uploads')
+    assert other.exists()
+    assert empty_dir.exists()
+
+    # Unless the directory to scan is explicit
+    log = run_management_command('reconcile_uploads', '--path', 'avatars')
+    assert '1 orphan files found.' in log
+
+    shutil.rmtree(other.parent)
+    empty_dir.rmdir()
+
+
+def test_settings__override(request_factory, user):
+    from django.test import override_settings
+
+    from chunked_upload import settings, views
+
+    assert settings.MAX_BYTES is None
+    assert 'MAX_BYTES' in settings.upload_settings.__dict__  # Cached
+
+    fake_file = BytesIO(b'test data')
+    fake_file.name = 'test-file.txt'
+    request = request_factory(user=user, method='post', data={'file': fake_file})
+    with override_settings(CHUNKED_UPLOAD_MAX_BYTES=5):
+        assert settings.upload_settings.MAX_BYTES == 5
+        response = views.ChunkedUploadView.as_view()(request)
+    content = get_response_json(response)
+    assert response.status_code == 400, content
+    assert content['detail'] == 'Size of file exceeds the limit (5 bytes)'
+    assert settings.upload_settings.MAX_BYTES is None
+
+
+def test_response__encoder():
+    from django.core.serializers.json import DjangoJSONEncoder
+    from django.test import override_settings
+
+    from chunked_upload import settings
+    from chunked_upload.response import fast_encode, format_datetime, get_fast_encoder
+
+    for value in (
+        datetime.datetime(2013, 7, 18, 17, 56, 22, 186123, tzinfo=datetime.timezone.utc),
+        datetime.datetime(2013, 7, 18, 17, 56, 22, tzinfo=datetime.timezone.utc),
+        datetime.datetime(2013, 7, 18, 17, 56, 22, 186123),
+    ):
+        assert '"%s"' % format_datetime(value) == DjangoJSONEncoder().encode(value)
+
+    # The fast encoder is opt-in
+    data = {1: 'a'}
+    assert settings.upload_settings.ENCODER(data) == '{"1": "a"}'
+    with override_settings(CHUNKED_UPLOAD_ENCODER='chunked_upload.response.fast_encode'):
+        assert settings.upload_settings.ENCODER is fast_encode
+        assert json.loads(settings.upload_settings.ENCODER(data)) == {'1': 'a'}
+
+    data = {
+        'upload_id': 'abc',
+        'offset': 10,
+        'expires': datetime.datetime(2013, 7, 18, 1, 2, 3, 186123, tzinfo=datetime.timezone.utc),
+        'size': Decimal('1.5'),
+        1: 'a',
+    }
+    encoded = get_fast_encoder()(data)
+    assert json.loads(encoded) == json.loads(DjangoJSONEncoder().encode(data))
+
+
+def test_response__encoder_msgspec():
+    pytest.importorskip('msgspec')
+    from django.core.serializers.json import DjangoJSONEncoder
+
+    from chunked_upload.response import get_fast_encoder
+
+    get_fast_encoder.cache_clear()
+    try:
+        with patch.dict('sys.modules', {'orjson': None}):
+            encoder = get_fast_encoder()
+    finally:
+        get_fast_encoder.cache_clear()
+    assert encoder.__self__.__class__.__module__.startswith('msgspec')
+
+    data = {'upload_id': 'abc', 'offset': 10, 'size': Decimal('1.5'), 1: 'a'}
+    assert json.loads(encoder(data)) == json.loads(DjangoJSONEncoder().encode(data))
+    # Datetimes are encoded natively (with microseconds)
+    value = datetime.datetime(2013, 7, 18, 1, 2, 3, 186123, tzinfo=datetime.timezone.utc)
+    assert encoder({'expires': value}) == b'{"expires":"2013-07-18T01:02:03.186123Z"}'
+
+
+def test_views__header_only_ack(request_factory, user):
+    from chunked_upload import models, views
+
+    upload_view = views.ChunkedUploadView.as_view()
+
+    fake_file = BytesIO(b'test data')
+    fake_file.name = 'test-file.txt'
+    request = request_factory(
+        user=user,
+        method='post',
+        data={'file': fake_file},
+        HTTP_CONTENT_RANGE='bytes 0-8/14',
+        HTTP_PREFER='return=minimal',
+    )
+    response = upload_view(request)
+    assert response.status_code == 204
+    assert response.content == b''
+    assert response['Upload-Offset'] == '9'
+    upload_id = response['Upload-Id']
+
+    fake_file = BytesIO(b'12345')
+    fake_file.name = 'test-file.txt'
+    request = request_factory(
+        user=user,
+        method='post',
+        data={'file': fake_file, 'upload_id': upload_id},
+        HTTP_CONTENT_RANGE='bytes 9-13/14',
+    )
+    response = upload_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 200, content
+    assert content['offset'] == 14
+
+    models.ChunkedUpload.objects.get(upload_id=upload_id).delete()
+
+
+def test_admin__delete_with_files(request_factory, user):
+    from django.contrib import admin
+
+    from chunked_upload import models
+    from chunked_upload.constants import COMPLETE, UPLOADING
+
+    chk_ups = [
+        _upload_file(request_factory, user, b'test data'),
+        _upload_file(request_factory, user, b'test data'),
+        _upload_file(request_factory, user, b'test data', complete=False),
+    ]
+    paths = [Path(chk_up.file.path) for chk_up in chk_ups]
+
+    model_admin = admin.site._registry[models.ChunkedUpload]
+    request = request_factory(user=user)
+    queryset = model_admin.get_queryset(request)
+    assert model_admin.get_paginator(request, queryset, 100).count == 3
+
+    # Delete with files by batches
+    queryset = models.ChunkedUpload.objects.filter(pk__in=[chk_ups[0].pk, chk_ups[2].pk])
+    assert queryset.delete_with_files(batch_size=1) == {COMPLETE: 1, UPLOADING: 1}
+    assert [path.exists() for path in paths] == [False, True, False]
+
+    with patch.object(model_admin, 'message_user') as message_user:
+        model_admin.delete_with_files(request, models.ChunkedUpload.objects.all())
+    assert str(message_user.call_args[0][1]) == '1 uploads were deleted.'
+    assert not paths[1].exists()
+    assert models.ChunkedUpload.objects.count() == 0
+
+
+def test_sliding_expiration(request_factory, user):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import override_settings
+    from django.utils import timezone
+
+    from chunked_upload import models
+
+    with override_settings(
+        CHUNKED_UPLOAD_SLIDING_EXPIRATION=True,
+        CHUNKED_UPLOAD_EXPIRATION_DELTA=datetime.timedelta(hours=1),
+        CHUNKED_UPLOAD_MAX_EXPIRATION_DELTA=datetime.timedelta(hours=2),
+    ):
+        chk_up = _upload_file(request_factory, user, b'test data', complete=False)
+        models.ChunkedUpload.objects.filter(pk=chk_up.pk).update(
+            created_on=timezone.now() - datetime.timedelta(minutes=90),
+            expires_at=timezone.now() + datetime.timedelta(minutes=1),
+        )
+        chk_up.refresh_from_db()
+
+        chk_up.append_chunk(SimpleUploadedFile('chunk', b'12345'))
+        chk_up.refresh_from_db()
+        # Extended, but capped to MAX_EXPIRATION_DELTA after creation
+        assert chk_up.expires_at == chk_up.created_on + datetime.timedelta(hours=2)
+        assert not chk_up.expired
+
+        models.ChunkedUpload.objects.filter(pk=chk_up.pk).update(expires_at=timezone.now())
+        assert list(models.ChunkedUpload.objects.expired()) == [chk_up]
+
+    chk_up.delete()
+
+
+def test_reap_expired_uploads(request_factory, user):
+    from django.utils import timezone
+
+    from chunked_upload import models
+
+    chk_ups = [_upload_file(request_factory, user, b'test data') for _index in range(4)]
+    expired = chk_ups[:3]
+    models.ChunkedUpload.objects.filter(pk__in=[chk_up.pk for chk_up in expired]).update(
+        expires_at=timezone.now()
+    )
+
+    # Failures to delete files are logged, the other files are deleted
+    delete_upload_file = models.delete_upload_file
+
+    def fail_first(storage, name, staged=False):
+        if name == expired[0].file.name:
+            raise OSError(errno.EIO, 'I/O error')
+        delete_upload_file(storage, name, staged=staged)
+
+    with patch('chunked_upload.models.delete_upload_file', side_effect=fail_first):
+        log = run_management_command('reap_expired_uploads', '--batch-size', '2')
+    assert '3 expired uploads were deleted in total.' in log
+    assert list(models.ChunkedUpload.objects.all()) == [chk_ups[3]]
+    assert Path(expired[0].file.path).exists()
+    for chk_up in expired[1:]:
+        assert not Path(chk_up.file.path).exists()
+    Path(expired[0].file.path).unlink()
+
+    # Signal handlers are not set when the command is called from a thread
+    models.ChunkedUpload.objects.filter(pk=chk_ups[3].pk).update(expires_at=timezone.now())
+    logs = []
+    thread = threading.Thread(
+        target=lambda: logs.append(run_management_command('reap_expired_uploads'))
+    )
+    thread.start()
+    thread.join()
+    assert '1 expired uploads were deleted in total.' in logs[0]
+    assert not Path(chk_ups[3].file.path).exists()
+
+
+def test_views__node_staging(request_factory, tmp_dir, user):
+    from django.test import override_settings
+
+    from chunked_upload import views
+    from chunked_upload.constants import COMPLETE
+
+    staging_root = tmp_dir / 'staging'
+    with override_settings(
+        CHUNKED_UPLOAD_NODE_NAME='node-1',
+        CHUNKED_UPLOAD_STAGING_ROOT=str(staging_root),
+    ):
+        chk_up = _upload_file(request_factory, user, b'test data', complete=False)
+        assert chk_up.node == 'node-1'
+        assert chk_up.staged
+        assert Path(chk_up.get_path()).is_relative_to(staging_root)
+        assert Path(chk_up.get_path()).read_bytes() == b'test data'
+        assert not Path(chk_up.file.path).exists()
+
+    data = {'upload_id': chk_up.upload_id}
+    complete_view = views.ChunkedUploadCompleteView.as_view()
+    with override_settings(
+        CHUNKED_UPLOAD_NODE_NAME='node-2',
+        CHUNKED_UPLOAD_STAGING_ROOT=str(staging_root),
+    ):
+        # Not owned by this node
+        response = complete_view(request_factory(user=user, method='post', data=data))
+        content = get_response_json(response)
+        assert response.status_code == 409, content
+        assert content['node'] == 'node-1'
+
+        with override_settings(CHUNKED_UPLOAD_NODE_URLS={'node-1': 'http://node-1/'}):
+            request = request_factory(user=user, method='post', data=data)
+            response = complete_view(request)
+            assert response.status_code == 307
+            assert response['Location'] == 'http://node-1' + request.get_full_path()
+
+    with override_settings(
+        CHUNKED_UPLOAD_NODE_NAME='node-1',
+        CHUNKED_UPLOAD_STAGING_ROOT=str(staging_root),
+    ):
+        response = complete_view(request_factory(user=user, method='post', data=data))
+        assert response.status_code == 200, response.content
+
+    chk_up.refresh_from_db()
+    assert chk_up.status == COMPLETE
+    assert not chk_up.staged
+    assert Path(chk_up.file.path).read_bytes() == b'test data'
+    assert not list(staging_root.rglob('*.part'))
+
+    chk_up.delete()
+
+    # Staged files are only deleted by their node, other nodes expire uploads
+    settings_1 = {
+        'CHUNKED_UPLOAD_NODE_NAME': 'node-1', 'CHUNKED_UPLOAD_STAGING_ROOT': str(staging_root)
+    }
+    settings_2 = dict(settings_1, CHUNKED_UPLOAD_NODE_NAME='node-2')
+    with override_settings(**settings_1):
+        chk_up = _upload_file(request_factory, user, b'test data', complete=False)
+        path = Path(chk_up.get_path())
+    with override_settings(**settings_2):
+        queryset = views.ChunkedUpload.objects.filter(pk=chk_up.pk)
+        assert queryset.delete_with_files() == {}
+        chk_up.refresh_from_db()
+        assert chk_up.expired
+        log = run_management_command('delete_expired_uploads')
+        assert '0 incomplete uploads were deleted.' in log
+        assert path.exists()
+    with override_settings(**settings_1):
+        log = run_management_command('delete_expired_uploads')
+        assert '1 incomplete uploads were deleted.' in log
+        assert not path.exists()
+
+
+def test_sharded_upload_to(tmp_dir):
+    import os
+
+    from django.test import override_settings
+
+    from chunked_upload.models import ChunkedUpload, get_upload_dirs, prune_empty_dirs
+    from chunked_upload.settings import sharded_upload_to
+
+    chk_up = ChunkedUpload()
+    upload_id = chk_up.upload_id
+    with override_settings(CHUNKED_UPLOAD_SHARD_DEPTH=2):
+        name = sharded_upload_to(chk_up, 'test-file.txt')
+    parts = Path(name).parts
+    assert parts[-3:] == (upload_id[:2], upload_id[2:4], upload_id + '.part')
+
+    storage = ChunkedUpload._meta.get_field('file').storage
+    path = Path(storage.path(name))
+    path.parent.mkdir(parents=True)
+    dirs, exclude = get_upload_dirs(storage)
+    # Recently modified directories are kept
+    assert sum(prune_empty_dirs(root, exclude=exclude) for root in dirs) == 0
+    os.utime(path.parent, (0, 0))
+    os.utime(path.parent.parent, (0, 0))
+    assert sum(prune_empty_dirs(root, min_age=0, exclude=exclude) for root in dirs) >= 2
+    assert not path.parent.parent.exists()
+    assert Path(dirs[0]).exists()
+
+
+def test_views__pipelined_validation(request_factory, user):
+    import threading
+
+    from django.db import transaction
+    from django.test import override_settings
+
+    from chunked_upload import validation, views
+    from chunked_upload.exceptions import ChunkedUploadError
+
+    release = threading.Event()
+
+    class ScanningUploadView(views.ChunkedUploadView):
+        pipelined_validation = True
+
+        def validate_chunk_data(self, chunked_upload, chunk):
+            release.wait(5)
+            if b'virus' in chunk.read():
+                raise ChunkedUploadError(status=400, detail='Virus found')
+
+    upload_view = ScanningUploadView.as_view()
+    complete_view = views.ChunkedUploadCompleteView.as_view()
+
+    def send_chunk(data, start, upload_id=None):
+        fake_file = BytesIO(data)
+        fake_file.name = 'test-file.txt'
+        post_data = {'file': fake_file}
+        if upload_id:
+            post_data['upload_id'] = upload_id
+        request = request_factory(
+            user=user, method='post', data=post_data,
+            HTTP_CONTENT_RANGE=f'bytes {start}-{start + len(data) - 1}/20',
+        )
+        return upload_view(request)
+
+    def wait_validation(chk_up):
+        for _index in range(50):
+            chk_up.refresh_from_db()
+            if chk_up.rejected or chk_up.validated_bytes == chk_up.offset:
+                return
+            time.sleep(0.1)
+        raise AssertionError('Validation did not end')
+
+    with override_settings(CHUNKED_UPLOAD_PIPELINED_VALIDATION=True):
+        # Chunks are acknowledged before being validated
+        response = send_chunk(b'test ', 0)
+        assert response.status_code == 200, response.content
+        upload_id = get_response_json(response)['upload_id']
+        response = send_chunk(b'data', 5, upload_id=upload_id)
+        assert response.status_code == 200, response.content
+
+        request = request_factory(user=user, method='post', data={'upload_id': upload_id})
+        response = complete_view(request)
+        content = get_response_json(response)
+        assert response.status_code == 409, content
+
+        release.set()
+        chk_up = views.ChunkedUpload.objects.get(upload_id=upload_id)
+        wait_validation(chk_up)
+        assert chk_up.validated_bytes == 9
+        assert not chk_up.rejected
+
+        response = send_chunk(b'virus', 9, upload_id=upload_id)
+        assert response.status_code == 200, response.content
+        wait_validation(chk_up)
+        assert chk_up.rejected
+        assert chk_up.validated_bytes == 9
+
+        response = send_chunk(b'more', 14, upload_id=upload_id)
+        content = get_response_json(response)
+        assert response.status_code == 400, content
+        assert content['reason'] == 'Virus found'
+
+        request = request_factory(user=user, method='post', data={'upload_id': upload_id})
+        response = complete_view(request)
+        content = get_response_json(response)
+        assert response.status_code == 400, content
+
+        # Validation submitted once the request transaction is committed
+        with patch('chunked_upload.validation.submit') as submit_mock:
+            with transaction.atomic():
+                response = send_chunk(b'test ', 0)
+                assert response.status_code == 200, response.content
+                submit_mock.assert_not_called()
+        submit_mock.assert_called_once()
+        validation.submit(*submit_mock.call_args.args)
+        new_chk_up = views.ChunkedUpload.objects.get(
+            upload_id=get_response_json(response)['upload_id']
+        )
+        wait_validation(new_chk_up)
+        with transaction.atomic():
+            response = send_chunk(b'data', 5, upload_id=new_chk_up.upload_id)
+        wait_validation(new_chk_up)
+        assert new_chk_up.validated_bytes == 9
+
+    chk_up.delete()
+    new_chk_up.delete()
+
+
+def test_views__chunk_size(request_factory, user):
+    from django.test import override_settings
+
+    from chunked_upload import views
+    from chunked_upload.middleware import RequestStartMiddleware
+
+    upload_view = views.ChunkedUploadView.as_view()
+
+    with override_settings(
+        CHUNKED_UPLOAD_CHUNK_SIZE=1000,
+        CHUNKED_UPLOAD_MIN_CHUNK_SIZE=100,
+        CHUNKED_UPLOAD_MAX_CHUNK_SIZE=5000,
+    ):
+        chk_up = views.ChunkedUpload(filename='test-file.txt')
+        view = views.ChunkedUploadView()
+        assert view.get_chunk_size(chk_up, None) == 1000
+        # Adapted to the throughput, in multiples of the min size
+        chk_up.record_throughput(1000, 5)
+        assert view.get_chunk_size(chk_up, None) == 1000
+        chk_up.record_throughput(20, 1)
+        assert chk_up.throughput == 110
+        assert view.get_chunk_size(chk_up, None) == 500
+        chk_up.record_throughput(10000, 1)
+        assert view.get_chunk_size(chk_up, None) == 5000
+        chk_up.throughput = 1
+        assert view.get_chunk_size(chk_up, None) == 100
+
+        # The throughput is only measured if the start of the request is known
+        fake_file = BytesIO(b'test data')
+        fake_file.name = 'test-file.txt'
+        request = request_factory(user=user, method='post', data={'file': fake_file})
+        response = upload_view(request)
+        content = get_response_json(response)
+        assert response.status_code == 200, content
+        assert content['max_chunk_size'] == 5000
+        assert content['chunk_size'] == 1000
+        chk_up = views.ChunkedUpload.objects.get(upload_id=content['upload_id'])
+        assert chk_up.throughput is None
+        chk_up.delete()
+
+        fake_file.seek(0)
+        request = request_factory(user=user, method='post', data={'file': fake_file})
+        response = RequestStartMiddleware(upload_view)(request)
+        content = get_response_json(response)
+        assert response.status_code == 200, content
+        assert 100 <= content['chunk_size'] <= 5000
+        chk_up = views.ChunkedUpload.objects.get(upload_id=content['upload_id'])
+        assert chk_up.throughput > 0
+
+        # Chunks too big for the "Content-Length" are rejected before being read
+        fake_file = BytesIO(b'0' * 100000)
+        fake_file.name = 'test-file.txt'
+        request = request_factory(
+            user=user, method='post',
+            data={'file': fake_file, 'upload_id': chk_up.upload_id},
+            HTTP_CONTENT_RANGE='bytes 9-100008/100009',
+        )
+        response = upload_view(request)
+        content = get_response_json(response)
+        assert response.status_code == 400, content
+        assert content['max_chunk_size'] == 5000
+        assert '_files' not in vars(request)
+
+        fake_file = BytesIO(b'0' * 5001)
+        fake_file.name = 'test-file.txt'
+        request = request_factory(
+            user=user, method='post',
+            data={'file': fake_file, 'upload_id': chk_up.upload_id},
+            HTTP_CONTENT_RANGE='bytes 9-5009/6000',
+        )
+        response = upload_view(request)
+        content = get_response_json(response)
+        assert response.status_code == 400, content
+        assert content['max_chunk_size'] == 5000
+
+    chk_up.delete()
+
+
+def test_views__abort(request_factory, user):
+    from django.contrib.auth.models import User
+
+    from chunked_upload import views
+    from chunked_upload.constants import COMPLETE
+
+    abort_view = views.ChunkedUploadAbortView.as_view()
+
+    chk_ups = [
+        _upload_file(request_factory, user, b'test data', complete=False) for _index in range(4)
+    ]
+    complete = _upload_file(request_factory, user, b'test data')
+    other_user = User.objects.create(username='other')
+    other = _upload_file(request_factory, other_user, b'test data', complete=False)
+
+    request = request_factory(user=user, method='post', data={})
+    response = abort_view(request)
+    assert response.status_code == 400, response.content
+
+    # Batch abort
+    upload_ids = f'{chk_ups[0].upload_id},{chk_ups[1].upload_id},{other.upload_id}'
+    request = request_factory(user=user, method='post', data={'upload_id': upload_ids})
+    response = abort_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 200, content
+    assert content == {'aborted': 2}
+    for chk_up in chk_ups[:2]:
+        assert not views.ChunkedUpload.objects.filter(pk=chk_up.pk).exists()
+        assert not Path(chk_up.file.path).exists()
+
+    # Deferred deletion
+    view = views.ChunkedUploadAbortView.as_view(deferred_deletion=True)
+    request = request_factory(user=user, method='post', data={'upload_id': chk_ups[2].upload_id})
+    response = view(request)
+    assert get_response_json(response) == {'aborted': 1}
+    chk_ups[2].refresh_from_db()
+    assert chk_ups[2].expired
+    assert Path(chk_ups[2].file.path).exists()
+
+    # All uploads in progress of the user
+    request = request_factory(user=user, method='post', data={'all': 'true'})
+    response = abort_view(request)
+    assert get_response_json(response) == {'aborted': 2}
+    assert list(views.ChunkedUpload.objects.order_by('pk')) == [complete, other]
+    assert complete.status == COMPLETE
+
+    complete.delete()
+    other.delete()
+
+
+@pytest.mark.parametrize('dedup', [False, True], ids=['plain', 'dedup'])
+def test_views__abort_during_chunk(request_factory, tmp_dir, user, dedup):
+    from chunked_upload import views
+
+    upload_view = views.ChunkedUploadView.as_view(dedup=dedup)
+    chk_up = _upload_file(request_factory, user, b'test data', complete=False)
+    path = Path(chk_up.get_path())
+
+    def send_chunk():
+        fake_file = BytesIO(b'more data')
+        fake_file.name = 'test-file.txt'
+        request = request_factory(
+            user=user, method='post',
+            data={'file': fake_file, 'upload_id': chk_up.upload_id},
+            HTTP_CONTENT_RANGE='bytes 9-17/18',
+        )
+        return upload_view(request)
+
+    # The file is deleted by an abort request while the chunk is being
+    # received (before or after the size check): the file is not created again
+    get_size = views.ChunkedUpload.get_size
+
+    def abort_after_size_check(self):
+        size = get_size(self)
+        path.unlink()
+        return size
+
+    for abort_after_size in (False, True):
+        if abort_after_size:
+            path.write_bytes(b'test data')
+            with patch.object(views.ChunkedUpload, 'get_size', abort_after_size_check):
+                response = send_chunk()
+        else:
+            path.unlink()
+            response = send_chunk()
+        content = get_response_json(response)
+        assert response.status_code == 410, content
+        assert content['detail'] == 'Upload has been aborted'
+        assert not path.exists()
+        assert not Path(chk_up.get_manifest_path()).exists()
+
+    chk_up.delete()
+    if dedup:
+        shutil.rmtree(tmp_dir / 'chunked_uploads/chunks')
+
+
+def _make_tar(members):
+    import tarfile
+
+    buffer = BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_views__extract_tar(request_factory, user):
+    from django.test import override_settings
+
+    from chunked_upload import archive, views
+
+    # The last member is a zip archive, which makes the tar look like a zip
+    # archive (the end of central directory record is in the tar padding)
+    nested_zip = BytesIO()
+    with zipfile.ZipFile(nested_zip, mode='w') as zip_file:
+        zip_file.writestr('inner.txt', b'nested')
+    members = {
+        'a.txt': b'first file',
+        'dir/b.bin': bytes(range(256)) * 20,
+        'dir/' + 'c' * 120 + '.txt': b'long name',
+        'x.zip': nested_zip.getvalue(),
+    }
+    data = _make_tar(members)
+    assert zipfile.is_zipfile(BytesIO(data))
+    upload_view = views.ChunkedUploadView.as_view()
+    complete_view = views.ChunkedUploadCompleteView.as_view()
+
+    with override_settings(CHUNKED_UPLOAD_EXTRACT_ARCHIVES=True), \
+            patch.object(archive, 'SMALL_MEMBER_SIZE', 1000):
+        upload_id = None
+        positions = []
+        for start in range(0, len(data), 700):
+            chunk = data[start:start + 700]
+            fake_file = BytesIO(chunk)
+            fake_file.name = 'archive.tar'
+            post_data = {'file': fake_file}
+            if upload_id:
+                post_data['upload_id'] = upload_id
+            request = request_factory(
+                user=user, method='post', data=post_data,
+                HTTP_CONTENT_RANGE=f'bytes {start}-{start + len(chunk) - 1}/{len(data)}',
+            )
+            response = upload_view(request)
+            assert response.status_code == 200, response.content
+            upload_id = get_response_json(response)['upload_id']
+            chk_up = views.ChunkedUpload.objects.get(upload_id=upload_id)
+            positions.append(chk_up.extracted_offset)
+        # Members are extracted while the chunks are received
+        assert 0 < positions[0] < positions[-1]
+        assert positions == sorted(positions)
+        extract_dir = Path(chk_up.file.storage.path(chk_up.get_extract_dir()))
+        for name, content in members.items():
+            assert (extract_dir / name).read_bytes() == content
+
+        request = request_factory(user=user, method='post', data={'upload_id': upload_id})
+        response = complete_view(request)
+        assert response.status_code == 200, response.content
+
+    for name, content in members.items():
+        assert (extract_dir / name).read_bytes() == content
+    assert not (extract_dir / 'inner.txt').exists()
+
+    # Extracted files are not orphans, unlike the directory of a deleted upload
+    # (many directories are looked up without building a huge query)
+    orphan_dir = extract_dir.parent / 'deleted.extracted'
+    (orphan_dir / 'dir').mkdir(parents=True)
+    (orphan_dir / 'dir' / 'a.txt').write_bytes(b'orphan')
+    for index in range(1200):
+        (extract_dir.parent / f'deleted-{index}.extracted').mkdir()
+    log = run_management_command('reconcile_uploads', '--fix', '--min-age', '0')
+    assert '1201 orphan files found.' in log
+    assert not orphan_dir.exists()
+    assert not list(extract_dir.parent.glob('deleted-*'))
+    for name, content in members.items():
+        assert (extract_dir / name).read_bytes() == content
+
+    chk_up.delete()
+    assert not extract_dir.exists()
+
+
+def test_views__extract_tar_pipelined_validation(request_factory, user):
+    from django.test import override_settings
+
+    from chunked_upload import validation, views
+    from chunked_upload.exceptions import ChunkedUploadError
+
+    class ScanningUploadView(views.ChunkedUploadView):
+        pipelined_validation = True
+
+        def validate_chunk_data(self, chunked_upload, chunk):
+            if b'virus' in chunk.read():
+                raise ChunkedUploadError(status=400, detail='Virus found')
+
+    upload_view = ScanningUploadView.as_view()
+    data = _make_tar({'a.txt': b'clean', 'b.txt': b'virus'})
+    jobs = []
+
+    def send_chunk(start, end, upload_id=None):
+        fake_file = BytesIO(data[start:end])
+        fake_file.name = 'archive.tar'
+        post_data = {'file': fake_file}
+        if upload_id:
+            post_data['upload_id'] = upload_id
+        request = request_factory(
+            user=user, method='post', data=post_data,
+            HTTP_CONTENT_RANGE=f'bytes {start}-{end - 1}/{len(data)}',
+        )
+        response = upload_view(request)
+        assert response.status_code == 200, response.content
+        return views.ChunkedUpload.objects.get(upload_id=get_response_json(response)['upload_id'])
+
+    with override_settings(CHUNKED_UPLOAD_EXTRACT_ARCHIVES=True), \
+            patch.object(validation, 'submit', side_effect=lambda *args: jobs.append(args)):
+        # Members are only extracted once validated
+        chk_up = send_chunk(0, 1100)
+        extract_dir = Path(chk_up.file.storage.path(chk_up.get_extract_dir()))
+        assert not (extract_dir / 'a.txt').exists()
+        validation.validate_chunk(*jobs.pop(0))
+        chk_up = send_chunk(1100, len(data), upload_id=chk_up.upload_id)
+        assert (extract_dir / 'a.txt').read_bytes() == b'clean'
+        assert not (extract_dir / 'b.txt').exists()
+
+        # Extracted files are deleted when a chunk is rejected
+        validation.validate_chunk(*jobs.pop(0))
+        chk_up.refresh_from_db()
+        assert chk_up.validation_error == 'Virus found'
+        assert not extract_dir.exists()
+
+    chk_up.delete()
+
+
+@pytest.mark.parametrize('archive_format', ['zip', 'tar.gz'])
+def test_views__extract_archive(request_factory, user, archive_format):
+    import tarfile
+    import zipfile
+
+    from django.test import override_settings
+
+    from chunked_upload import views
+
+    def make_archive(members):
+        buffer = BytesIO()
+        if archive_format == 'zip':
+            with zipfile.ZipFile(buffer, mode='w') as archive:
+                for name, content in members.items():
+                    archive.writestr(name, content)
+        else:
+            with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+                for name, content in members.items():
+                    info = tarfile.TarInfo(name)
+                    info.size = len(content)
+                    tar.addfile(info, BytesIO(content))
+        return buffer.getvalue()
+
+    def upload(data):
+        fake_file = BytesIO(data)
+        fake_file.name = 'archive.' + archive_format
+        request = request_factory(user=user, method='post', data={'file': fake_file})
+        response = views.ChunkedUploadView.as_view()(request)
+        upload_id = get_response_json(response)['upload_id']
+        request = request_factory(user=user, method='post', data={'upload_id': upload_id})
+        response = views.ChunkedUploadCompleteView.as_view()(request)
+        return response, views.ChunkedUpload.objects.get(upload_id=upload_id)
+
+    with override_settings(
+        CHUNKED_UPLOAD_EXTRACT_ARCHIVES=True,
+        CHUNKED_UPLOAD_ARCHIVE_MAX_MEMBERS=2,
+    ):
+        response, chk_up = upload(make_archive({'a.txt': b'first', 'dir/b.txt': b'second'}))
+        assert response.status_code == 200, response.content
+        extract_dir = Path(chk_up.file.storage.path(chk_up.get_extract_dir()))
+        assert (extract_dir / 'a.txt').read_bytes() == b'first'
+        assert (extract_dir / 'dir/b.txt').read_bytes() == b'second'
+        chk_up.delete()
+
+        # Path traversal
+        response, chk_up = upload(make_archive({'a.txt': b'first', '../evil.txt': b'evil'}))
+        content = get_response_json(response)
+        assert response.status_code == 400, content
+        assert 'Unsafe path' in content['detail']
+        chk_up.refresh_from_db()
+        assert chk_up.rejected
+        assert not Path(chk_up.file.storage.path(chk_up.get_extract_dir())).exists()
+        assert not Path(chk_up.file.storage.path('evil.txt')).exists()
+        chk_up.delete()
+
+        # Too many files
+        response, chk_up = upload(make_archive({'a': b'1', 'b': b'2', 'c': b'3'}))
+        content = get_response_json(response)
+        assert response.status_code == 400, content
+        assert 'too many files' in content['detail']
+        chk_up.delete()
+
+
+def test_soak():
+    from django.test import override_settings
+
+    from chunked_upload.models import ChunkedUpload
+
+    from .soak import SoakOptions, run_soak
+
+    options = SoakOptions(
+        clients=8, uploads=2, file_size=50_000, chunk_size=10_000,
+        disconnect_rate=0.1, duplicate_rate=0.1, enospc_rate=0.1, slow_rate=0.05,
+        slow_delay=0.05,
+    )
+    with override_settings(ROOT_URLCONF='tests.soak'):
+        result = run_soak(options)
+    assert result.completed == 16, result
+    assert result.ok, result
+
+    ChunkedUpload.objects.all().delete_with_files()
+
+
+def test_views__profiling(request_factory, tmp_dir, user):
+    from django.test import override_settings
+
+    from chunked_upload import profiling, views
+    from chunked_upload.profiling import JSONLinesSink
+
+    path = tmp_dir / 'profiles.jsonl'
+    records = []
+
+    def sink(record):
+        records.append(record)
+        JSONLinesSink(path)(record)
+
+    with override_settings(CHUNKED_UPLOAD_PROFILING_SINK=sink):
+        # Header ignored for non staff users
+        _upload_file(request_factory, user, b'test data', complete=False)
+        fake_file = BytesIO(b'test data')
+        fake_file.name = 'test-file.txt'
+        request = request_factory(
+            user=user, method='post', data={'file': fake_file}, HTTP_X_UPLOAD_PROFILE='1'
+        )
+        views.ChunkedUploadView.as_view()(request)
+        assert records == []
+
+        user.is_staff = True
+        fake_file.seek(0)
+        request = request_factory(
+            user=user, method='post', data={'file': fake_file}, HTTP_X_UPLOAD_PROFILE='cprofile'
+        )
+        response = views.ChunkedUploadView.as_view()(request)
+        assert response.status_code == 200, response.content
+        assert len(records) == 1
+        record = records[0]
+        assert record['view'] == 'ChunkedUploadView'
+        assert record['status'] == 200
+        assert set(record['sections']) == {
+            'check_permissions', 'validate', 'validate_chunk_data', 'write_chunk', '_save'
+        }
+        assert record['calls']['_save'] == 1
+        assert sum(record['sections'].values()) <= record['duration']
+        assert record['functions']
+
+        # Sampling
+        upload_id = get_response_json(response)['upload_id']
+        user.is_staff = False
+        request = request_factory(user=user, method='post', data={'upload_id': upload_id})
+        with override_settings(CHUNKED_UPLOAD_PROFILING_SAMPLE_RATE=1):
+            response = views.ChunkedUploadCompleteView.as_view()(request)
+        assert response.status_code == 200, response.content
+        assert len(records) == 2
+        assert records[1]['view'] == 'ChunkedUploadCompleteView'
+        assert 'get_queryset' in records[1]['sections']
+        assert 'functions' not in records[1]
+
+        # cProfile is used by one request at a time, other requests only
+        # get the durations, and the wrappers are removed after the request
+        user.is_staff = True
+        fake_file.seek(0)
+        request = request_factory(
+            user=user, method='post', data={'file': fake_file}, HTTP_X_UPLOAD_PROFILE='cprofile'
+        )
+        view = views.ChunkedUploadView()
+        view.setup(request)
+        with profiling._cprofile_lock:
+            response = view.dispatch(request)
+        assert response.status_code == 200, response.content
+        assert records[2]['cprofile_skipped'] is True
+        assert 'functions' not in records[2]
+        assert 'write_chunk' in records[2]['sections']
+        assert not set(view.profiled_methods) & set(vars(view))
+
+        # Profiler failures do not fail the request
+        fake_file.seek(0)
+        request = request_factory(
+            user=user, method='post', data={'file': fake_file}, HTTP_X_UPLOAD_PROFILE='cprofile'
+        )
+        with patch('cProfile.Profile.enable', side_effect=ValueError):
+            response = views.ChunkedUploadView.as_view()(request)
+        assert response.status_code == 200, response.content
+        assert records[3]['cprofile_skipped'] is True
+        assert records[3]['duration'] > 0
+        assert not profiling._cprofile_lock.locked()
+        user.is_staff = False
+
+    log = run_management_command('upload_profile_report', str(path), '--top', '3')
+    assert '4 profiled requests.' in log
+    assert '(request)' in log
+    assert 'cumtime' in log
+    log = run_management_command(
+        'upload_profile_report', str(path), '--view', 'ChunkedUploadView', '--sort', 'p95'
+    )
+    assert '3 profiled requests.' in log
+    assert 'write_chunk' in log
+
+    for chunked_upload in views.ChunkedUpload.objects.all():
+        chunked_upload.delete()
+    path.unlink()
+
+
+def test_verification(request_factory, user):
+    from django.test import override_settings
+
+    from chunked_upload import verification
+
+    data = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 40
+    chk_up = _upload_file(request_factory, user, data)
+
+    assert chk_up.sniff_type() == 'image/png'
+    assert verification.sniff_type(b'RIFF\x00\x00\x00\x00WEBPVP8 ') == 'image/webp'
+    assert verification.sniff_type(b'\x00\x00\x00\x18ftypmp42') == 'video/mp4'
+    assert verification.sniff_type(b'plain text') is None
+
+    # Whole file hashed if the samples would cover it
+    expected = hashlib.sha256(len(data).to_bytes(8, 'big') + data).hexdigest()
+    assert chk_up.get_sampled_hash(samples=4, sample_size=4096) == expected
+    assert verification.get_sample_ranges(1000, 3, 10) == [(0, 10), (495, 505), (990, 1000)]
+    hasher = hashlib.sha256(len(data).to_bytes(8, 'big'))
+    for start, end in verification.get_sample_ranges(len(data), 3, 100):
+        hasher.update(data[start:end])
+    assert chk_up.get_sampled_hash(samples=3, sample_size=100) == hasher.hexdigest()
+
+    with override_settings(
+        CHUNKED_UPLOAD_VERIFICATION_BLOCK_SIZE=1000, CHUNKED_UPLOAD_VERIFICATION_WORKERS=3
+    ):
+        digests = b''.join(
+            hashlib.sha256(data[start:start + 1000]).digest()
+            for start in range(0, len(data), 1000)
+        )
+        tree_hash = hashlib.sha256(digests).hexdigest()
+        assert chk_up.get_tree_hash() == tree_hash
+
+        # Results are cached on the model
+        chk_up.refresh_from_db()
+        assert chk_up.verification['size'] == len(data)
+        assert chk_up.verification['type'] == 'image/png'
+        assert chk_up.verification['tree_hash:sha256:1000'] == tree_hash
+        with patch('chunked_upload.verification.tree_hash') as tree_hash_mock:
+            assert chk_up.get_tree_hash() == tree_hash
+        tree_hash_mock.assert_not_called()
+
+        # Cache cleared when the file changes
+        with open(chk_up.get_path(), mode='ab') as file_obj:
+            file_obj.write(b'extra')
+        assert chk_up.get_tree_hash() != tree_hash
+        assert 'type' not in chk_up.verification
+
+    Path(chk_up.get_path()).write_bytes(b'')
+    assert chk_up.get_tree_hash(save=False) == hashlib.sha256(b'').hexdigest()
+    chk_up.delete()
+
+
+def test_views__reserve(request_factory, user):
+    from chunked_upload import views
+
+    reserve_view = views.ChunkedUploadReserveView.as_view()
+
+    for count in ('0', '101', 'a'):
+        request = request_factory(user=user, method='post', data={'count': count})
+        response = reserve_view(request)
+        content = get_response_json(response)
+        assert response.status_code == 400, content
+        assert content['detail'] == 'Invalid number of uploads (between 1 and 100)'
+
+    request = request_factory(user=user, method='post', data={'count': '3'})
+    response = reserve_view(request)
+    content = get_response_json(response)
+    assert response.status_code == 200, content
+    upload_ids = [upload['upload_id'] for upload in content['uploads']]
+    assert len(set(upload_ids)) == 3
+    chk_ups = list(views.ChunkedUpload.objects.filter(upload_id__in=upload_ids))
+    assert len(chk_ups) == 3
+    for chk_up in chk_ups:
+        assert chk_up.user == user
+        assert chk_up.filename == ''
+        assert chk_up.file.name.endswith(f'{chk_up.upload_id}.part')
+        assert Path(chk_up.file.path).read_bytes() == b''
+
+    # Chunks sent to a reserved upload
+    fake_file = BytesIO(b'test data')
+    fake_file.name = 'test-file.txt'
+    request = request_factory(
+        user=user, method='post', data={'file': fake_file, 'upload_id': upload_ids[0]}
+    )
+    response = views.ChunkedUploadView.as_view()(request)
+    assert response.status_code == 200, response.content
+    request = request_factory(user=user, method='post', data={'upload_id': upload_ids[0]})
+    response = views.ChunkedUploadCompleteView.as_view()(request)
+    assert response.status_code == 200, response.content
+    chk_up = views.ChunkedUpload.objects.get(upload_id=upload_ids[0])
+    assert chk_up.filename == 'test-file.txt'
+    assert Path(chk_up.file.path).read_bytes() == b'test data'
+
+    # Files are deleted if the uploads cannot be created
+    with patch.object(views.ChunkedUpload.objects, 'bulk_create', side_effect=ValueError):
+        request = request_factory(user=user, method='post', data={'count': '2'})
+        with pytest.raises(ValueError):
+            reserve_view(request)
+    assert views.ChunkedUpload.objects.count() == 3
+
+    for chk_up in views.ChunkedUpload.objects.all():
+        chk_up.delete()
+
+
+def test_events(request_factory, user):
+    from django.contrib.auth.models import User
+
+    from chunked_upload import events, views
+
+    bus = events.get_event_bus()
+    received = []
+    bus.connect(received.extend)
+    try:
+        chk_up = _upload_file(request_factory, user, b'test data')
+        aborted = _upload_file(request_factory, user, b'test', complete=False)
+        request = request_factory(user=user, method='post', data={'upload_id': aborted.upload_id})
+        views.ChunkedUploadAbortView.as_view()(request)
+        views.ChunkedUpload.objects.filter(pk=chk_up.pk).expire()
+        run_management_command('reap_expired_uploads')
+        events.flush()
+    finally:
+        bus.disconnect(received.extend)
+
+    assert [(event['type'], event['upload_id'], event['offset']) for event in received] == [
+        ('created', chk_up.upload_id, 9),
+        ('chunk', chk_up.upload_id, 9),
+        ('completed', chk_up.upload_id, 9),
+        ('created', aborted.upload_id, 4),
+        ('chunk', aborted.upload_id, 4),
+        ('aborted', aborted.upload_id, 4),
+        ('expired', chk_up.upload_id, 9),
+    ]
+    assert all(event['user_id'] == user.pk for event in received)
+    assert received[0]['filename'] == 'test-file.txt'
+    assert not bus.active
+
+    # Server-Sent Events, filtered on the uploads of the user
+    events_view = views.ChunkedUploadEventsView.as_view(keepalive_interval=0.1, max_duration=1)
+    response = events_view(request_factory(user=user))
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'text/event-stream'
+    stream = iter(response.streaming_content)
+    assert next(stream) == b': connected\n\n'
+    other_user = User.objects.create(username='other-events')
+    _upload_file(request_factory, other_user, b'other data', complete=False)
+    chk_up = _upload_file(request_factory, user, b'test data', complete=False)
+    content = b''.join(stream).decode()
+    response.close()
+    messages = [message for message in content.split('\n\n') if message.startswith('event:')]
+    assert len(messages) == 2
+    assert messages[0].startswith('event: created\ndata: {')
+    data = json.loads(messages[1].split('\ndata: ')[1])
+    assert data['type'] == 'chunk'
+    assert data['upload_id'] == chk_up.upload_id
+    assert not bus.active
+
+    response = events_view(request_factory(user=None))
+    assert response.status_code == 403
+
+    for chk_up in views.ChunkedUpload.objects.all():
+        chk_up.delete()
+    other_user.delete()